@@ -0,0 +1,347 @@
+"""
+Benchmarks for asmfmt.
+
+Generates a deterministic corpus of Game Boy asm, formats it in a few different ways and reports the throughput,
+peak memory and time spent in each phase, as measured by the formatter's own stats. Each case runs in a fresh process, so the peak memory of one case
+does not hide behind the one before it. Cases with more than one job also report the peak memory of their largest worker process.
+
+With a baseline file, the run fails when a case has become slower than the baseline by more than the tolerance:
+
+    python BenchAsmfmt.py --save_baseline
+    python BenchAsmfmt.py
+
+Throughput depends on the machine, so the baseline is ignored by git rather than kept in the repository. Without one the run only warns that nothing
+was compared, unless a missing --baseline was asked for by name, which fails.
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    #Not available on Windows, peak memory is not reported there
+    resource = None
+
+import asmfmt
+
+DEFAULT_SIZES = '1K,64K,1M,8M'
+#Chunk size for the chunked single file cases
+CHUNK_SIZE = 256 * 1024
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+
+MNEMONICS = ['ld', 'ldh', 'add', 'adc', 'sub', 'sbc', 'and', 'xor', 'or', 'cp', 'inc', 'dec', 'push', 'pop',
+             'jr', 'jp', 'call', 'ret', 'rst', 'bit', 'set', 'res', 'swap', 'srl', 'rla', 'rrca', 'nop', 'halt']
+REGISTERS = ['a', 'b', 'c', 'd', 'e', 'h', 'l', 'af', 'bc', 'de', 'hl', '[hl]', '[hli]', '[de]', '[$ff00+c]']
+CONDITIONS = ['z', 'nz', 'c', 'nc']
+WORDS = ['the', 'player', 'sprite', 'tile', 'map', 'pointer', 'counter', 'flag', 'bank', 'timer', 'is', 'set',
+         'to', 'next', 'when', 'check', 'if', 'loop', 'until', 'done', 'screen', 'buffer', 'copy', 'clear', 'wait']
+
+def sentence(rng, low, high):
+    
+    words = rng.choices(WORDS, k=rng.randint(low, high))
+    return ' '.join(words).capitalize()
+
+def code_line(rng, indent):
+    
+    mnemonic = rng.choice(MNEMONICS)
+    
+    if mnemonic in ('jr', 'jp', 'call'):
+        operands = rng.choice(CONDITIONS) + ', .Label' + str(rng.randrange(1000)) if rng.random() < 0.5 else 'Routine' + str(rng.randrange(1000))
+    
+    elif mnemonic in ('nop', 'halt', 'ret', 'rla', 'rrca'):
+        operands = ''
+    
+    elif mnemonic in ('ld', 'add', 'adc', 'sub', 'sbc', 'and', 'xor', 'or', 'cp'):
+        operands = rng.choice(REGISTERS) + ', ' + rng.choice(REGISTERS + ['$%02x' % rng.randrange(256)])
+    
+    else:
+        operands = rng.choice(REGISTERS)
+    
+    return (indent + mnemonic + ' ' + operands).rstrip()
+
+def code_block(rng, lines):
+    """
+    A label followed by code, some of the lines carrying trailing comments with sloppy spacing
+    """
+    
+    lines.append('.Label%d:' % rng.randrange(1000))
+    indent = rng.choice(['\t', '    ', '  '])
+    
+    for i in range(rng.randint(3, 30)):
+        line = code_line(rng, indent)
+        
+        if rng.random() < 0.6:
+            line += ' ' * rng.randint(0, 6) + '; ' + sentence(rng, 2, 8)
+        
+        lines.append(line)
+
+def nested_block(rng, lines):
+    """
+    Deeply indented code, such as macro bodies and nested conditionals
+    """
+    
+    for depth in range(1, rng.randint(3, 9)):
+        for i in range(rng.randint(1, 4)):
+            line = code_line(rng, '\t' * depth)
+            
+            if rng.random() < 0.5:
+                line += ' ; ' + sentence(rng, 1, 5)
+            
+            lines.append(line)
+
+def comment_block(rng, lines):
+    """
+    A long block comment, bordered, half bordered or not bordered at all
+    """
+    
+    style = rng.random()
+    body = ['; ' + sentence(rng, 3, 14) for i in range(rng.randint(2, 25))]
+    
+    if style < 0.4:
+        width = max(len(line) for line in body) + 2
+        border = ';' + '-' * (width - 2) + ';'
+        body = [border] + [line.ljust(width - 1) + ';' for line in body] + [border]
+    
+    elif style < 0.6:
+        body = [';-----;'] + body
+    
+    lines.extend(body)
+
+def data_block(rng, lines):
+    """
+    A large db table, the kind of thing that makes up most of the bytes of a graphics or map file
+    """
+    
+    lines.append('Data%d::' % rng.randrange(1000))
+    
+    for i in range(rng.randint(16, 256)):
+        line = '\tdb ' + ', '.join('$%02x' % rng.randrange(256) for j in range(rng.choice([8, 16])))
+        
+        if rng.random() < 0.1:
+            line += ' ; ' + sentence(rng, 1, 4)
+        
+        lines.append(line)
+
+BLOCKS = [(code_block, 5), (nested_block, 2), (comment_block, 2), (data_block, 1)]
+
+def generate_corpus(size, seed=0, finalNewline=True):
+    """
+    Generate roughly size bytes of asm, always the same for the same arguments
+    """
+    
+    rng = random.Random(seed)
+    makers = [maker for maker, weight in BLOCKS for i in range(weight)]
+    lines = []
+    length = 0
+    
+    while length < size:
+        start = len(lines)
+        rng.choice(makers)(rng, lines)
+        lines.append('')
+        length += sum(len(line) + 1 for line in lines[start:])
+    
+    #Blocks are separated by blank lines, but the file doesn't end with one
+    text = '\n'.join(lines[:-1])
+    
+    return text + '\n' if finalNewline else text
+
+def write_corpus(directory, name, size, seed=0, finalNewline=True):
+    
+    path = os.path.join(directory, name)
+    
+    with open(path, 'w') as f:
+        f.write(generate_corpus(size, seed, finalNewline))
+    
+    return path
+
+def peak_rss(children=False):
+    """
+    Peak resident memory of this process in bytes, or None where it can't be measured. With children, the peak of the
+    largest of its child processes that have finished, such as the workers of a pool that was shut down, instead
+    """
+    
+    if resource is None:
+        return None
+    
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    
+    #Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def run_case(files, globalIndent, jobs, repeat, chunkSize=None):
+    """
+    Format files repeat times and return the fastest run. Runs in its own process
+    """
+    
+    outputs = [path + '.out' for path in files]
+    formatter = asmfmt.AsmFormatter(files, outputs, globalIndent=globalIndent, jobs=jobs, chunkSize=chunkSize)
+    numLines = 0
+    numBytes = 0
+    
+    for path in files:
+        numBytes += os.path.getsize(path)
+        
+        with open(path) as f:
+            numLines += sum(1 for line in f)
+    
+    best = None
+    
+    for i in range(repeat):
+        
+        start = time.perf_counter()
+        results = formatter.format_files()
+        elapsed = time.perf_counter() - start
+        
+        for result in results:
+            if result.error is not None:
+                raise RuntimeError(f"{result.inputFile}: {result.error}")
+        
+        if best is None or elapsed < best:
+            best = elapsed
+    
+    #Collecting stats slows the formatter down a little, so the phases come from a separate run
+    phases = asmfmt.FileStats()
+    formatter.stats = True
+    
+    for result in formatter.format_files():
+        phases.merge(result.stats)
+    
+    for path in outputs:
+        os.remove(path)
+    
+    return {
+        'lines': numLines,
+        'bytes': numBytes,
+        'seconds': best,
+        'lines_per_sec': numLines / best if best else float('inf'),
+        'peak_rss': peak_rss(),
+        'peak_rss_workers': peak_rss(children=True),
+        'phases': phases.phases,
+    }
+
+def build_cases(directory, sizes, manyFiles, jobs):
+    """
+    Write the corpus and return the cases to run as (name, files, globalIndent, jobs, chunkSize)
+    """
+    
+    cases = []
+    
+    for size in sizes:
+        path = write_corpus(directory, 'single_%d.asm' % size, size, seed=size)
+        cases.append(('single-%s' % format_size(size), [path], False, 1, None))
+        cases.append(('global_indent-%s' % format_size(size), [path], True, 1, None))
+        
+        #The same file split into chunks across the workers, once it is big enough to make a few
+        if jobs > 1 and size >= 4 * CHUNK_SIZE:
+            cases.append(('chunked-%s-j%d' % (format_size(size), jobs), [path], True, jobs, CHUNK_SIZE))
+    
+    #A file without a final newline, which takes a different path at the end of the file
+    path = write_corpus(directory, 'no_newline.asm', 64 * 1024, seed=1, finalNewline=False)
+    cases.append(('no_final_newline-64K', [path], False, 1, None))
+    
+    manyDir = os.path.join(directory, 'many')
+    os.mkdir(manyDir)
+    many = [write_corpus(manyDir, 'file_%d.asm' % i, 4 * 1024, seed=i) for i in range(manyFiles)]
+    cases.append(('many-%dx4K' % manyFiles, many, False, 1, None))
+    
+    if jobs > 1:
+        cases.append(('many-%dx4K-j%d' % (manyFiles, jobs), many, False, jobs, None))
+    
+    return cases
+
+def format_size(size):
+    
+    for unit, scale in (('G', 1024 ** 3), ('M', 1024 ** 2), ('K', 1024)):
+        if size >= scale and size % scale == 0:
+            return '%d%s' % (size // scale, unit)
+    
+    return str(size)
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+    Return a message for each case that is slower than the baseline by more than tolerance
+    """
+    
+    regressions = []
+    
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        
+        floor = baseline[name] * (1 - tolerance)
+        
+        if result['lines_per_sec'] < floor:
+            regressions.append('%s: %.0f lines/sec, baseline %.0f' % (name, result['lines_per_sec'], baseline[name]))
+    
+    return regressions
+
+def parse_args(args):
+    
+    parser = argparse.ArgumentParser(description='Benchmark asmfmt on a generated corpus')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='Comma separated sizes of the single file cases, up to 50M (default %(default)s)')
+    parser.add_argument('--many', type=int, default=200, help='Number of files in the many file cases')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help='Workers for the parallel many file case')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per case, the fastest is reported')
+    parser.add_argument('--baseline', help='Baseline file of lines/sec per case (default bench_baseline.json next to this script)')
+    parser.add_argument('--save_baseline', action='store_true', help='Store this run as the baseline instead of comparing against it')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Fraction of the baseline throughput a case may lose before failing')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    
+    return parser.parse_args(args)
+
+def main(argv):
+    
+    args = parse_args(argv)
+    sizes = [asmfmt.parse_size(size) for size in args.sizes.split(',') if size.strip()]
+    results = {}
+    
+    #Spawn, so that a case doesn't start with the memory of the process that forked it
+    context = multiprocessing.get_context('spawn')
+    
+    with tempfile.TemporaryDirectory() as directory:
+        for name, files, globalIndent, jobs, chunkSize in build_cases(directory, sizes, args.many, args.jobs):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                results[name] = executor.submit(run_case, files, globalIndent, jobs, args.repeat, chunkSize).result()
+            
+            if not args.json:
+                result = results[name]
+                rss = '%.1f MB' % (result['peak_rss'] / 1024 ** 2) if result['peak_rss'] else '-'
+                workerRss = '%.1f MB' % (result['peak_rss_workers'] / 1024 ** 2) if result['peak_rss_workers'] else '-'
+                phases = ' '.join('%s=%.3fs' % phase for phase in result['phases'].items())
+                print('%-24s %10d lines %8.3fs %12.0f lines/sec %10s %10s  %s' % (name, result['lines'], result['seconds'], result['lines_per_sec'], rss, workerRss, phases))
+    
+    if args.json:
+        print(json.dumps(results, indent=2))
+    
+    baselineFile = args.baseline or DEFAULT_BASELINE
+    
+    if args.save_baseline:
+        with open(baselineFile, 'w') as f:
+            json.dump({name: result['lines_per_sec'] for name, result in results.items()}, f, indent=2)
+        
+        return 0
+    
+    if not os.path.exists(baselineFile):
+        print(f"no baseline at {baselineFile}, so nothing was compared. Make one with --save_baseline", file=sys.stderr)
+        return 1 if args.baseline else 0
+    
+    with open(baselineFile) as f:
+        baseline = json.load(f)
+    
+    regressions = compare_to_baseline(results, baseline, args.tolerance)
+    
+    for regression in regressions:
+        print('slower than baseline: ' + regression, file=sys.stderr)
+    
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,10 +1,21 @@
 import argparse
+import asyncio
+from contextlib import redirect_stderr
 import filecmp
+import io
+from itertools import accumulate
+import math
 import os
+import random
 import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
 
 import asmfmt
+import BenchAsmfmt
 
 class TestFormatMethods(unittest.TestCase):
     
@@ -40,7 +51,7 @@ class TestFormatMethods(unittest.TestCase):
         """
         result = filecmp.cmp(output, ref)
         
-        if result:
+        if result and output not in self.successfulTestFiles:
             self.successfulTestFiles.append(output)
         
         self.assertTrue(result)
@@ -56,7 +67,7 @@ class TestFormatMethods(unittest.TestCase):
         else:
             args = asmfmt.parse_args([inputFile, '-o', outputFile])
         
-        self.formatter = asmfmt.AsmFormatter(args.input, args.output, args.global_indent)
+        self.formatter = asmfmt.AsmFormatter(args.input, args.output, globalIndent=args.global_indent)
         self.formatter.format_files()
         
         self.compare_and_track_files(outputFile, refFile)
@@ -116,6 +127,25 @@ class TestFormatMethods(unittest.TestCase):
         inp = '1_5_code_comment.txt'
         self.run_single_file_case(inp)
     
+    def test_code_comment_string_literal(self):
+        """
+        Tests that semicolons inside string and character literals are not mistaken for the start of a comment
+        
+        Input: Two lines of code with comments, both containing a ; inside a literal
+        Output: The comments are aligned on the ; after the literals
+        """
+        
+        inp = '1_6_code_comment.txt'
+        self.run_single_file_case(inp)
+        
+        #Many literals of both kinds, with semicolons and the other quote inside them, before and after the first ;
+        lines = ['\tdb "a", \'b\', "c;", "it\'s", \';\', "\\";" ; comment', '\tdb ' + ', '.join(['"x"', "'y'"] * 500) + ' ; comment', '\tdb "a;" , \'b']
+        
+        for line in lines:
+            expected = line.rfind(' ; ') + 1 if ' ; ' in line else -1
+            self.assertEqual(asmfmt.find_comment_start(line), expected, line)
+            self.assertEqual(asmfmt.find_comment_start(line.encode(), chars=asmfmt.BYTES_CHARS), expected, line)
+    
     def test_block_comment(self):
         """
         Tests the formatting of block comments
@@ -172,6 +202,17 @@ class TestFormatMethods(unittest.TestCase):
         inp = '2_5_block_comment.txt'
         self.run_single_file_case(inp)
         
+    def test_lone_border_block_comment(self):
+        """
+        Tests the formatting of comment borders that are a block comment on their own
+        
+        Input: A border on its own before some code, and another on the last line of the file
+        Output: The first border gets a bottom border, and the last is left as it is
+        """
+        
+        inp = '2_6_block_comment.txt'
+        self.run_single_file_case(inp)
+        
     def test_fmt_in_place(self):
         """
         Tests the formatting of a document in place. 
@@ -191,16 +232,1047 @@ class TestFormatMethods(unittest.TestCase):
         
         args = asmfmt.parse_args([modInPlaceFile])
 
-        self.formatter = asmfmt.AsmFormatter(args.input, args.output, args.global_indent)
+        self.formatter = asmfmt.AsmFormatter(args.input, args.output, globalIndent=args.global_indent)
         self.formatter.format_files()
         
         self.compare_and_track_files(modInPlaceFile, refFile)
+
+    def test_format_string(self):
+        """
+        Tests formatting source held in a string
+        
+        Input: The text of a file with code comments, and the text of a file with a block comment
+        Output: The same text as the reference files
+        """
+        
+        for name, globalIndent in [('1_4_code_comment.txt', True), ('2_1_block_comment.txt', False)]:
+            inputFile, _, refFile = self.get_output_names(name)
+            
+            with open(inputFile, 'r') as f:
+                text = f.read()
+            
+            with open(refFile, 'r') as f:
+                ref = f.read()
+            
+            self.assertEqual(asmfmt.format_string(text, global_indent=globalIndent), ref)
+    
+    def test_line_ranges(self):
+        """
+        Tests formatting only the groups that touch a range of lines
+        
+        Input: A file with a code group and a block comment, with a range covering one line of the comment
+        Output: Only the block comment is formatted, and every other line is left as is
+        """
+        
+        inputFile, _, refFile = self.get_output_names('3_1_modify_in_place.txt')
+        
+        with open(inputFile, 'r') as f:
+            lines = f.readlines()
+        
+        with open(refFile, 'r') as f:
+            refLines = f.readlines()
+        
+        self.formatter = asmfmt.AsmFormatter([])
+        state, formatted = self.formatter.format_text(''.join(lines), [(5, 5)])
+        
+        expected = ''.join(lines[:3] + refLines[3:7] + lines[5:])
+        
+        self.assertEqual(formatted, expected)
+        self.assertEqual(state.linesChanged, 4)
+        
+        ranges = asmfmt.parse_diff_ranges('--- a/bank.asm\n+++ b/bank.asm\n@@ -3 +3,2 @@\n@@ -10,2 +11,0 @@\n')
+        self.assertEqual(ranges, {'bank.asm': [(3, 4), (11, 12)]})
+    
+    def test_ranges_from_diff(self):
+        """
+        Tests picking the files to format out of a diff
+        
+        Input: A diff of an asm file, a python file and an asm file in an excluded directory, read from a subdirectory
+        of the repository, and from outside any repository
+        Output: Ranges for every file resolved against the top of the repository, but only the asm file that isn't excluded to format
+        """
+        
+        diffText = ''.join(f"--- a/{path}\n+++ b/{path}\n@@ -1 +1 @@\n" for path in ('src/bank.asm', 'tools/build.py', 'vendor/lib.asm'))
+        
+        with tempfile.TemporaryDirectory() as workDir:
+            
+            workDir = os.path.realpath(workDir)
+            subDir = os.path.join(workDir, 'src')
+            os.mkdir(subDir)
+            
+            lineRanges, files = asmfmt.ranges_from_diff(diffText, exclude=['vendor'], directory=workDir)
+            
+            self.assertEqual(lineRanges[os.path.join(workDir, 'tools', 'build.py')], [(1, 1)])
+            self.assertEqual(files, [os.path.join(workDir, 'src', 'bank.asm')])
+            
+            if shutil.which('git') is None:
+                return
+            
+            asmfmt.run_git(['init', '-q'], workDir)
+            lineRanges, files = asmfmt.ranges_from_diff(diffText, exclude=['vendor'], directory=subDir)
+            
+            self.assertEqual(files, [os.path.join(workDir, 'src', 'bank.asm')])
+            self.assertEqual(len(lineRanges), 3)
+    
+    def test_parallel_jobs(self):
+        """
+        Tests the formatting of several files across a process pool.
+
+        Input: Several files, formatted with two jobs
+        Output: Each output matches its reference file, and every file has a result in input order
+        """
+
+        names = ['1_1_code_comment.txt', '1_3_code_comment.txt', '2_1_block_comment.txt', '2_3_block_comment.txt']
+        cases = [self.get_output_names(name) for name in names]
+
+        args = asmfmt.parse_args([case[0] for case in cases] + ['-o'] + [case[1] for case in cases] + ['-j', '2'])
+
+        self.formatter = asmfmt.AsmFormatter(args.input, args.output, globalIndent=args.global_indent, jobs=args.jobs)
+        results = self.formatter.format_files()
+
+        self.assertEqual([result.inputFile for result in results], args.input)
+        self.assertTrue(all(result.error is None for result in results))
+
+        for inputFile, outputFile, refFile in cases:
+            self.compare_and_track_files(outputFile, refFile)
+
+    def test_missing_file_is_reported(self):
+        """
+        Tests that a file that cannot be read is reported in its result, without stopping the other files
+
+        Input: A missing file followed by a valid one
+        Output: An error for the missing file, and a formatted second file
+        """
+
+        inputFile, outputFile, refFile = self.get_output_names('1_1_code_comment.txt')
+        missing = os.path.join(os.path.dirname(__file__), 'test_files', 'does_not_exist.txt')
+
+        self.formatter = asmfmt.AsmFormatter([missing, inputFile], [outputFile + '.missing', outputFile])
+        results = self.formatter.format_files()
+
+        self.assertIsInstance(results[0].error, OSError)
+        self.assertIsNone(results[1].error)
+        self.compare_and_track_files(outputFile, refFile)
+
+    def test_output_count_mismatch(self):
+        """
+        Tests that inputs and output files that don't pair up are rejected rather than some files being skipped
+        
+        Input: Two inputs with one output, and one input with two outputs, from the command line and the library
+        Output: A usage error from the command line and a ValueError from the library, with nothing written
+        """
+        
+        inputFile, outputFile, refFile = self.get_output_names('1_1_code_comment.txt')
+        
+        with tempfile.TemporaryDirectory() as workDir:
+            outputs = [os.path.join(workDir, 'a.asm'), os.path.join(workDir, 'b.asm')]
+            
+            for inputs, given in (([inputFile, inputFile], outputs[:1]), ([inputFile], outputs)):
+                
+                with redirect_stderr(io.StringIO()) as err, self.assertRaises(SystemExit):
+                    asmfmt.parse_args(inputs + ['-o'] + given)
+                
+                self.assertIn('output files', err.getvalue())
+                
+                with self.assertRaises(ValueError):
+                    asmfmt.AsmFormatter(inputs, given).format_files()
+            
+            self.assertEqual(os.listdir(workDir), [])
+
+    def test_cache_skips_formatted_files(self):
+        """
+        Tests that a file an in-place run left unchanged is skipped by the next run that uses the same cache
+        
+        Input: An already formatted file, formatted in place twice with a cache
+        Output: The first run formats it and finds no change, the second run skips it
+        """
+        
+        inp = '1_2_code_comment.txt'
+        testFilePath = os.path.join(os.path.dirname(__file__), 'test_files')
+        
+        with tempfile.TemporaryDirectory() as workDir:
+            workFile = os.path.join(workDir, inp)
+            shutil.copy2(os.path.join(testFilePath, inp), workFile)
+            cachePath = os.path.join(workDir, 'cache.json')
+            
+            firstRun = asmfmt.AsmFormatter([workFile], cache=asmfmt.FormatCache(cachePath))
+            results = firstRun.format_files()
+            firstRun.cache.save()
+            
+            self.assertFalse(results[0].skipped)
+            self.assertFalse(results[0].changed)
+            
+            secondRun = asmfmt.AsmFormatter([workFile], cache=asmfmt.FormatCache(cachePath))
+            results = secondRun.format_files()
+            
+            self.assertTrue(results[0].skipped)
+            
+            #A different set of options must not reuse the entry
+            globalRun = asmfmt.AsmFormatter([workFile], globalIndent=True, cache=asmfmt.FormatCache(cachePath))
+            results = globalRun.format_files()
+            
+            self.assertFalse(results[0].skipped)
+
+    
+    def test_check_and_diff_do_not_write(self):
+        """
+        Tests that check and diff mode report changes without touching the file
+        
+        Input: A file that needs formatting, checked with a diff
+        Output: The file is reported as changed, the diff applies to the reference file, and the input is untouched
+        """
+        
+        inputFile, outputFile, refFile = self.get_output_names('1_1_code_comment.txt')
+        
+        with open(inputFile, 'r') as f:
+            original = f.read()
+        
+        self.formatter = asmfmt.AsmFormatter([inputFile], check=True, diff=True)
+        results = self.formatter.format_files()
+        
+        self.assertTrue(results[0].changed)
+        self.assertIn('+cp a, $20                 ; Is the pointer on the first book?', results[0].diff)
+        
+        with open(inputFile, 'r') as f:
+            self.assertEqual(f.read(), original)
+    
+    def test_unchanged_file_is_not_rewritten(self):
+        """
+        Tests that formatting in place leaves a file alone when the output would be the same as the input
+        
+        Input: An already formatted file with an old modification time
+        Output: The same file, with the same modification time
+        """
+        
+        inp = '1_2_code_comment.txt'
+        testFilePath = os.path.join(os.path.dirname(__file__), 'test_files')
+        
+        with tempfile.TemporaryDirectory() as workDir:
+            workFile = os.path.join(workDir, inp)
+            shutil.copy2(os.path.join(testFilePath, inp), workFile)
+            os.utime(workFile, (0, 0))
+            
+            self.formatter = asmfmt.AsmFormatter([workFile])
+            results = self.formatter.format_files()
+            
+            self.assertFalse(results[0].changed)
+            self.assertEqual(os.stat(workFile).st_mtime, 0)
+            self.assertEqual(os.listdir(workDir), [inp])
+
+    
+    def test_discover_files(self):
+        """
+        Tests the search of a directory tree for files to format
+        
+        Input: A repository with asm files, other files, excluded files and files ignored by .gitignore and info/exclude,
+        and a worktree of it where .git is a file
+        Output: Only the asm files that are not excluded or ignored, in name order, from the repository and from the worktree
+        """
+        
+        with tempfile.TemporaryDirectory() as workDir:
+            os.makedirs(os.path.join(workDir, '.git', 'info'))
+            os.makedirs(os.path.join(workDir, '.git', 'worktrees', 'wt'))
+            
+            for name in ['src/main.asm', 'src/data.inc', 'src/notes.txt', 'src/gfx/tiles.z80', 'build/out.asm', 'src/map.gen.asm', 'vendor/lib.asm', 'src/scratch.asm',
+                         'wt/src/main.asm', 'wt/src/scratch.asm']:
+                path = os.path.join(workDir, *name.split('/'))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                open(path, 'w').close()
+            
+            with open(os.path.join(workDir, '.gitignore'), 'w') as f:
+                f.write('build/\n*.gen.asm\nwt/\n')
+            
+            with open(os.path.join(workDir, '.git', 'info', 'exclude'), 'w') as f:
+                f.write('scratch.asm\n')
+            
+            #A worktree's .git file points at its own git directory, which points back at the shared one
+            with open(os.path.join(workDir, 'wt', '.git'), 'w') as f:
+                f.write('gitdir: ../.git/worktrees/wt\n')
+            
+            with open(os.path.join(workDir, '.git', 'worktrees', 'wt', 'commondir'), 'w') as f:
+                f.write('../..\n')
+            
+            found = asmfmt.discover_files([workDir], exclude=['vendor'])
+            names = [os.path.relpath(path, workDir).replace(os.sep, '/') for path in found]
+            
+            self.assertEqual(names, ['src/data.inc', 'src/gfx/tiles.z80', 'src/main.asm'])
+            
+            found = asmfmt.discover_files([os.path.join(workDir, 'wt', 'src')])
+            names = [os.path.relpath(path, workDir).replace(os.sep, '/') for path in found]
+            
+            self.assertEqual(names, ['wt/src/main.asm'])
+    
+    def test_watch_formats_changed_files(self):
+        """
+        Tests that the watcher formats a file once it changes, and not again because of its own write
+        
+        Input: A watched directory with an unformatted file, which is then edited
+        Output: The file is left alone until edited, then formatted once
+        """
+        
+        with tempfile.TemporaryDirectory() as workDir:
+            path = os.path.join(workDir, 'main.asm')
+            
+            with open(path, 'w') as f:
+                f.write('ld a, b ; one\nxor a ; two')
+            
+            watcher = asmfmt.Watcher(asmfmt.AsmFormatter([]), lambda: asmfmt.discover_files([workDir]), debounce=0)
+            watcher.known = watcher.snapshot()
+            self.assertEqual(watcher.poll(), [])
+            
+            with open(path, 'w') as f:
+                f.write('ld a, [hl] ; one\nxor a ; two')
+            
+            results = watcher.poll()
+            self.assertEqual([result.changed for result in results], [True])
+            self.assertEqual(watcher.poll(), [])
+            
+            with open(path) as f:
+                self.assertEqual(f.read(), 'ld a, [hl] ; one\nxor a      ; two')
+    
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'needs unix sockets')
+    def test_daemon_round_trip(self):
+        """
+        Tests formatting text through the daemon
+        
+        Input: A text request, a request for the edits to a text, a request for a missing file and a malformed request
+        Output: The formatted text, the edits, and an error for the other two
+        """
+        
+        with tempfile.TemporaryDirectory() as workDir:
+            socketPath = os.path.join(workDir, 'asmfmt.sock')
+            server = asmfmt.daemon_server(socketPath)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            
+            try:
+                response = asmfmt.request_format(socketPath, {'text': 'ld a, b ; one\nxor a ; two'})
+                self.assertEqual(response, {'text': 'ld a, b ; one\nxor a   ; two', 'changed': True})
+                
+                response = asmfmt.request_format(socketPath, {'text': 'ld a, b ; one\nxor a ; two', 'edits': True})
+                self.assertEqual(response, {'edits': [{'range': {'start': {'line': 1, 'character': 6}, 'end': {'line': 1, 'character': 6}}, 'newText': '  '}], 'changed': True})
+                
+                response = asmfmt.request_format(socketPath, {'path': os.path.join(workDir, 'missing.asm')})
+                self.assertIn('error', response)
+                
+                response = asmfmt.request_format(socketPath, {})
+                self.assertIn('error', response)
+            
+            finally:
+                server.shutdown()
+                server.server_close()
+    
+    def test_daemon_socket_path(self):
+        """
+        Tests that the daemon only ever removes a stale socket at its path
+        
+        Input: A daemon pointed at a regular file, at a socket a server is listening on, and at a socket nothing is listening on
+        Output: An error for the first two with both left in place, and the stale socket removed
+        """
+        
+        with tempfile.TemporaryDirectory() as workDir:
+            
+            sourceFile = os.path.join(workDir, 'victim.asm')
+            
+            with open(sourceFile, 'w') as f:
+                f.write('ld a, b\n')
+            
+            with redirect_stderr(io.StringIO()) as err:
+                self.assertEqual(asmfmt.run_daemon(sourceFile), 1)
+            
+            self.assertIn('not a socket', err.getvalue())
+            
+            with open(sourceFile) as f:
+                self.assertEqual(f.read(), 'ld a, b\n')
+            
+            socketPath = os.path.join(workDir, 'asmfmt.sock')
+            
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as listening:
+                listening.bind(socketPath)
+                listening.listen(1)
+                
+                with self.assertRaises(OSError):
+                    asmfmt.remove_stale_socket(socketPath)
+                
+                self.assertTrue(os.path.exists(socketPath))
+            
+            #Closed without being removed, like the socket of a daemon that was killed
+            asmfmt.remove_stale_socket(socketPath)
+            self.assertFalse(os.path.exists(socketPath))
+    
+    def test_stats(self):
+        """
+        Tests the stats collected for each file and in total
+        
+        Input: A file with two code lines and a comment, formatted once to an output file and once in check mode
+        Output: Line and group counts, lines modified and phase timings for both, the file only rewritten by the first
+        """
+        
+        with tempfile.TemporaryDirectory() as workDir:
+            inputFile = os.path.join(workDir, 'main.asm')
+            outputFile = os.path.join(workDir, 'out.asm')
+            
+            with open(inputFile, 'w') as f:
+                f.write('ld a, b ; one\nxor a ; two\n\n; note\n')
+            
+            written = asmfmt.AsmFormatter([inputFile], [outputFile], stats=True).format_files()[0]
+            checked = asmfmt.AsmFormatter([inputFile], check=True, stats=True).format_files()[0]
+            
+            for result in (written, checked):
+                self.assertEqual(result.stats.lines, {'code': 2, 'comment': 1, 'blank': 1, 'other': 0})
+                self.assertEqual(result.stats.groups, {'code': 1, 'comment': 1, 'other': 0})
+                self.assertEqual(result.stats.linesModified, 4)
+                self.assertIn('lex', result.stats.phases)
+                self.assertEqual(result.stats.bytesRead, os.path.getsize(inputFile))
+            
+            self.assertTrue(written.stats.rewritten)
+            self.assertEqual(written.stats.bytesWritten, os.path.getsize(outputFile))
+            self.assertFalse(checked.stats.rewritten)
+            
+            report = asmfmt.stats_report([written, checked])
+            self.assertEqual(report['total']['lines_modified'], 8)
+            self.assertEqual(report['total']['rewritten'], 1)
+            self.assertEqual(len(report['files']), 2)
+    
+    def test_bytes_engine(self):
+        """
+        Tests that the bytes engine formats files exactly as the text engine does, and is not used for files it can't handle
+        
+        Input: Every test file, a file with non ASCII text, and a file with \\r\\n line endings
+        Output: The same output from both engines
+        """
         
+        with tempfile.TemporaryDirectory() as workDir:
+            
+            special = {'non_ascii.asm': 'ld a, "é" ; accent\nxor a ; x\n'.encode('utf-8'), 'crlf.asm': b'ld a, b ; x\r\nxor a ; y\r\n'}
+            testFilePath = os.path.join(os.path.dirname(__file__), 'test_files')
+            inputs = [os.path.join(testFilePath, name) for name in sorted(os.listdir(testFilePath))]
+            
+            for name, content in special.items():
+                inputs.append(os.path.join(workDir, name))
+                
+                with open(inputs[-1], 'wb') as f:
+                    f.write(content)
+            
+            for inputFile in inputs:
+                for globalIndent in (False, True):
+                    
+                    outputs = []
+                    
+                    for bytesMode in (True, False):
+                        outputs.append(os.path.join(workDir, f"out_{bytesMode}"))
+                        result = asmfmt.AsmFormatter([inputFile], [outputs[-1]], globalIndent=globalIndent, bytesMode=bytesMode).format_files()[0]
+                        self.assertIsNone(result.error)
+                    
+                    self.assertTrue(filecmp.cmp(*outputs, shallow=False), inputFile)
+            
+            self.assertEqual(list(asmfmt.iter_line_runs(b'\tdb 1\n\tdb 2\n\tld a ; x\n\n\n\tdb 3')), [b'\tdb 1\n\tdb 2\n', b'\tld a ; x\n', b'\n\n', b'\tdb 3'])
+    
+    def test_write_back(self):
+        """
+        Tests replacing files in place in batches
+        
+        Input: Unformatted files with different permissions, formatted with every fsync policy, and a batch whose input vanishes
+        Output: Formatted files that keep their permissions, and an error for the input that vanished
+        """
+        
+        inp, outputFile, refFile = self.get_output_names('1_1_code_comment.txt')
+        
+        with tempfile.TemporaryDirectory() as workDir:
+            
+            for fsync in asmfmt.WriteBack.POLICIES:
+                files = []
+                
+                for mode in (0o644, 0o755, 0o600):
+                    files.append(os.path.join(workDir, f"{fsync}_{mode:o}.asm"))
+                    shutil.copyfile(inp, files[-1])
+                    os.chmod(files[-1], mode)
+                
+                results = asmfmt.AsmFormatter(files, fsync=fsync).format_files()
+                
+                self.assertEqual([result.changed for result in results], [True] * 3)
+                
+                for path, mode in zip(files, (0o644, 0o755, 0o600)):
+                    self.assertTrue(filecmp.cmp(path, refFile, shallow=False))
+                    
+                    if os.name == 'posix':
+                        self.assertEqual(os.stat(path).st_mode & 0o777, mode)
+            
+            writeBack = asmfmt.WriteBack()
+            missing = os.path.join(workDir, 'missing', 'gone.asm')
+            fd, tmpPath = tempfile.mkstemp(dir=workDir)
+            os.close(fd)
+            
+            with writeBack.batch() as errors:
+                writeBack.add(tempfile.mkstemp(dir=workDir), files[0])
+                writeBack.pending.append((tmpPath, missing))
+            
+            self.assertEqual(list(errors), [missing])
+            
+            #No temp files are left behind
+            self.assertTrue(all(name.endswith('.asm') for name in os.listdir(workDir)))
+    
+    def test_project_indent(self):
+        """
+        Tests aligning comments to one indent level across every file, with cached scans
+        
+        Input: Two files with code of different widths, formatted twice, then again after adding a file with wider code
+        Output: Every file aligned to the widest code. The second run scans and formats nothing, and the third
+        only scans the new file, but reformats every file to the new indent
+        """
+        
+        with tempfile.TemporaryDirectory() as workDir:
+            
+            def write(name, text):
+                path = os.path.join(workDir, name)
+                with open(path, 'w') as f:
+                    f.write(text)
+                return path
+            
+            def run(files, jobs=1):
+                formatter = asmfmt.AsmFormatter(files, jobs=jobs, cache=cache, projectIndent=True)
+                scanned = []
+                
+                #Workers can't be handed a lambda, so scans are only tracked in this process
+                if jobs == 1:
+                    scanFile = formatter._scan_file
+                    formatter._scan_file = lambda path: scanned.append(path) or scanFile(path)
+                
+                return ([result.changed for result in formatter.format_files()], scanned)
+            
+            def read(path):
+                with open(path) as f:
+                    return f.read()
+            
+            files = [write('a.asm', 'ld a, b ; one\nxor a ; two'), write('b.asm', 'ld hl, wLongerName ; long')]
+            cache = asmfmt.FormatCache(os.path.join(workDir, 'cache.json'))
+            
+            self.assertEqual(run(files), ([True, False], files))
+            self.assertEqual(read(files[0]), 'ld a, b            ; one\nxor a              ; two')
+            self.assertEqual(read(files[1]), 'ld hl, wLongerName ; long')
+            
+            self.assertEqual(run(files), ([False, False], []))
+            
+            files.append(write('c.asm', 'ld hl, wMuchLongerName ; longer'))
+            self.assertEqual(run(files), ([True, True, False], [files[2]]))
+            self.assertEqual(read(files[1]), 'ld hl, wLongerName     ; long')
+            
+            #The pool gives the same result as a single process
+            cache = None
+            write('b.asm', 'ld hl, wLongerName ; long')
+            self.assertEqual(run(files, jobs=2)[0], [False, True, False])
+            self.assertEqual(read(files[1]), 'ld hl, wLongerName     ; long')
+    
+    def test_format_many(self):
+        """
+        Tests the asyncio API
+        
+        Input: Copies of an unformatted file, formatted with format_many, some from an async generator, and with a missing file
+        Output: Results in input order for format_many, every file formatted, and an error for the missing file
+        """
+        
+        inp, outputFile, refFile = self.get_output_names('1_1_code_comment.txt')
+        
+        with tempfile.TemporaryDirectory() as workDir:
+            files = []
+            
+            for i in range(6):
+                files.append(os.path.join(workDir, f"{i}.asm"))
+                shutil.copyfile(inp, files[-1])
+            
+            missing = os.path.join(workDir, 'missing.asm')
+            
+            async def generate():
+                for path in files[3:]:
+                    await asyncio.sleep(0)
+                    yield path
+            
+            async def run():
+                results = await asmfmt.format_many(files[:3] + [missing], limit=2)
+                streamed = [result async for result in asmfmt.iter_format_many(generate())]
+                return (results, streamed)
+            
+            results, streamed = asyncio.run(run())
+            
+            self.assertEqual([result.inputFile for result in results], files[:3] + [missing])
+            self.assertEqual([result.changed for result in results[:3]], [True] * 3)
+            self.assertIsInstance(results[3].error, FileNotFoundError)
+            self.assertEqual(sorted(result.inputFile for result in streamed), files[3:])
+            
+            for path in files:
+                self.assertTrue(filecmp.cmp(path, refFile, shallow=False))
+            
+            #Two runs with the project indent share a formatter, and each gets the indent of its own files
+            wide = os.path.join(workDir, 'wide.asm')
+            narrow = os.path.join(workDir, 'narrow.asm')
+            
+            with open(wide, 'w') as f:
+                f.write('ld hl, wLongerName ; long\nxor a ; x\n')
+            with open(narrow, 'w') as f:
+                f.write('ld a, b ; one\nxor a ; two\n')
+            
+            formatter = asmfmt.AsmFormatter([], projectIndent=True)
+            
+            async def run_both():
+                return await asyncio.gather(asmfmt.format_many([wide], formatter=formatter), asmfmt.format_many([narrow], formatter=formatter))
+            
+            asyncio.run(run_both())
+            
+            self.assertIsNone(formatter.projectLineLen)
+            
+            with open(wide) as f:
+                self.assertEqual(f.read(), 'ld hl, wLongerName ; long\nxor a              ; x\n')
+            with open(narrow) as f:
+                self.assertEqual(f.read(), 'ld a, b ; one\nxor a   ; two\n')
+    
+    @unittest.skipUnless(shutil.which('git'), 'needs git')
+    def test_staged(self):
+        """
+        Tests formatting the files staged in git
+        
+        Input: A repository with a staged unformatted file, a staged formatted file, a staged file that isn't asm,
+        and a staged unformatted file with unstaged changes, checked and then fixed
+        Output: Check mode finds the two unformatted files and changes nothing. Fixing stages and writes the formatted
+        version of the first, and reports the one with unstaged changes without touching it
+        """
+        
+        with tempfile.TemporaryDirectory() as workDir:
+            contents = {'a.asm': 'ld a, b ; one\nxor a ; two\n', 'b.asm': 'ld a, b ; one\n', 'c.txt': 'ld a, b ; one\nxor a ; two\n', 'd.asm': 'xor a ; x\nld a, b ; y\n'}
+            
+            for name, text in contents.items():
+                with open(os.path.join(workDir, name), 'w') as f:
+                    f.write(text)
+            
+            asmfmt.run_git(['init', '-q'], workDir)
+            asmfmt.run_git(['add', '.'], workDir)
+            
+            with open(os.path.join(workDir, 'd.asm'), 'a') as f:
+                f.write('nop\n')
+            
+            checker = asmfmt.AsmFormatter([], check=True)
+            results = asmfmt.format_staged(checker, workDir)
+            
+            self.assertEqual([(result.inputFile, result.changed) for result in results], [('a.asm', True), ('b.asm', False), ('d.asm', True)])
+            self.assertEqual(asmfmt.run_git(['show', ':a.asm'], workDir).decode(), contents['a.asm'])
+            
+            results = asmfmt.format_staged(asmfmt.AsmFormatter([]), workDir)
+            formatted = 'ld a, b ; one\nxor a   ; two\n'
+            
+            self.assertEqual([result.error is None for result in results], [True, True, False])
+            self.assertEqual(asmfmt.run_git(['show', ':a.asm'], workDir).decode(), formatted)
+            self.assertEqual(asmfmt.run_git(['show', ':d.asm'], workDir).decode(), contents['d.asm'])
+            
+            with open(os.path.join(workDir, 'a.asm')) as f:
+                self.assertEqual(f.read(), formatted)
+            
+            self.assertEqual([result.changed for result in asmfmt.format_staged(checker, workDir, ['a.asm', 'b.asm'])], [False, False])
+    
+    def test_text_edits(self):
+        """
+        Tests the edits formatting makes, and their Language Server Protocol form
+        
+        Input: Code whose comments need aligning, a comment group at the end of the text without a newline, and a line with an emoji in it
+        Output: Spaces inserted before the comment, borders inserted as lines, the missing newline added together with the
+        bottom border, and UTF-16 columns in the LSP edits
+        """
+        
+        text = 'ld a, b ; one\nxor a ; two\n; c\n; d'
+        state, edits = asmfmt.AsmFormatter([]).text_edits(text)
+        
+        self.assertEqual([edit.as_tuple() for edit in edits], [(1, 6, 1, 6, '  '), (2, 0, 2, 0, ';--;\n'), (2, 3, 2, 3, ';'), (3, 3, 3, 3, ';\n;--;\n')])
+        self.assertEqual(state.linesChanged, 5)
+        self.assertEqual(asmfmt.AsmFormatter([]).text_edits('ld a, b ; one\n')[1], [])
+        
+        text = 'ld a, "\U0001F600" ; one\nld a, b ; two\n'
+        state, edits = asmfmt.AsmFormatter([]).text_edits(text)
         
+        self.assertEqual([edit.as_tuple() for edit in edits], [(1, 8, 1, 8, '  ')])
+        self.assertEqual(asmfmt.lsp_text_edits(text, edits), [{'range': {'start': {'line': 1, 'character': 8}, 'end': {'line': 1, 'character': 8}}, 'newText': '  '}])
         
+        state, edits = asmfmt.AsmFormatter([], rules=['code_comment', 'trailing_whitespace']).text_edits('ld a, \U0001F600 ; x  \n')
+        self.assertEqual(asmfmt.lsp_text_edits('ld a, \U0001F600 ; x  \n', edits)[0]['range'], {'start': {'line': 0, 'character': 12}, 'end': {'line': 0, 'character': 14}})
+    
+    def test_rules(self):
+        """
+        Tests turning rules on and off, and that every rule runs in the same pass with its own stats
+        
+        Input: Badly spaced code with comments, formatted with the default rules, every rule, no rules and conflicting rules
+        Output: Each rule's changes only when it is on, the file unchanged with no rules, and an error for the conflict
+        """
+        
+        text = '  Label:  LD  a ,b ; load  \n\txor A\n\t; note\t\n'
+        
+        self.assertEqual(asmfmt.format_string(text), '  Label:  LD  a ,b ; load  \n\txor A\n\t;------;\n\t; note\t;\n\t;------;\n')
+        
+        everything = asmfmt.AsmFormatter([], stats=True, rules=asmfmt.select_rules(enable=asmfmt.RULES))
+        state, formatted = everything.format_text(text)
+        
+        self.assertEqual(formatted, 'Label:  ld a, b ; load\n\txor A\n\t;-----;\n\t; note;\n\t;-----;\n')
+        self.assertEqual(set(state.stats.rules), set(asmfmt.RULES))
+        self.assertEqual(state.stats.rules['operand_spacing'][1], 1)
+        self.assertEqual(state.stats.rules['trailing_whitespace'][1], 2)
+        
+        self.assertEqual(asmfmt.AsmFormatter([], rules=[]).format_text(text)[1], text)
+        self.assertEqual(asmfmt.AsmFormatter([], rules=[asmfmt.MnemonicCaseRule(upper=True)]).format_text(text)[1], text.replace('xor', 'XOR'))
+        self.assertEqual(asmfmt.select_rules(disable=['block_comment']), ['code_comment'])
+        
+        with self.assertRaises(ValueError):
+            asmfmt.AsmFormatter([], rules=['code_comment', asmfmt.CodeCommentRule()])
+        
+        with self.assertRaises(ValueError):
+            asmfmt.select_rules(enable=['no_such_rule'])
+    
+    def test_opcode_lint(self):
+        """
+        Tests checking instructions against the snapshot of the instruction table
+        
+        Input: Valid instructions in the different ways rgbds lets them be written, and instructions with operands that no form
+        of them takes, linted as text, as a file formatted in chunks, and through the CLI's reporting
+        Output: A problem for each bad line only, with its line number, and the text left as it was
+        """
         
+        good = ['\tld a, [hli]', '\tldi a, [hl]', '\tld hl, sp + 5', '\tld [$ff00+c], a', '\tldh a, [$ff44]', '\tadd b', '\tsub a, [hl]',
+                '\tadd sp, -2', '\tjp [hl]', '\tjr nz, .loop', '\trst $38', '\tbit 7, [hl]', '\tstop', '\tret', '\tld a, \\1', '\tdb 1, 2']
+        bad = ['\tld [de], 5', '\tadd hl, a', '\tinc [bc]', '\tpush sp', '\tld a,', '\tnop a']
+        text = '\n'.join(good + bad) + '\n'
         
+        index = asmfmt.InstructionIndex.load()
+        self.assertIs(index, asmfmt.InstructionIndex.load())
+        self.assertIn(('A', '[HL+]'), index.shapes['LD'])
+        self.assertEqual(asmfmt.operand_shape(' [ HLD ] '), '[HL-]')
         
+        linter = asmfmt.AsmFormatter([], rules=asmfmt.select_rules(enable=['opcode_lint']))
+        state, formatted = linter.format_text(text)
+        
+        self.assertEqual(formatted, text)
+        self.assertEqual([lineNumber for lineNumber, message in state.problems], list(range(len(good) + 1, len(good) + len(bad) + 1)))
+        self.assertEqual(state.problems[0][1], 'ld does not take [DE], n')
+        self.assertEqual(state.problems[4][1], 'ld is missing an operand')
+        self.assertEqual(asmfmt.AsmFormatter([]).format_text(text)[0].problems, [])
+        self.assertIn(':rules=code_comment,block_comment,opcode_lint=', linter.options_signature())
+        
+        with tempfile.TemporaryDirectory() as workDir:
+            
+            inputFile = os.path.join(workDir, 'lint.asm')
+            
+            with open(inputFile, 'w') as f:
+                f.write(text * 200)
+            
+            chunked = asmfmt.AsmFormatter([inputFile], [inputFile + '.out'], jobs=2, rules=linter.rules, chunkSize=1024)
+            result = chunked.format_files()[0]
+            
+            self.assertEqual(result.problems, linter.format_text(text * 200)[0].problems)
+            self.assertEqual(len(result.problems), len(bad) * 200)
+            
+            with redirect_stderr(io.StringIO()) as err:
+                self.assertTrue(asmfmt.report_results([result], False, False))
+            
+            self.assertTrue(err.getvalue().startswith(f"{inputFile}:{len(good) + 1}: ld does not take [DE], n\n"))
+    
+    def test_symbol_index(self):
+        """
+        Tests building a symbol index from the formatting pass, and keeping it up to date as files change
+        
+        Input: A file with includes, sections, labels and constants after comments that gain borders, formatted in place
+        with a symbol index and a cache, whole and in chunks, then again unchanged, after a touch and after an edit
+        Output: The symbols numbered by the lines of the formatted file, the same from chunks, and files only indexed again
+        when their contents change
+        """
+        
+        text = ('INCLUDE "hardware.inc"\n; Entry point\nSECTION "Main", ROM0\nMain::\n.loop: jr .loop\n; Constants\n'
+                'NUM_THINGS EQU 5\nDEF MAX_HP = 10\n\tsrl a\nPlayer.hp: db 1\n')
+        
+        with tempfile.TemporaryDirectory() as workDir:
+            
+            inputFile = os.path.join(workDir, 'main.asm')
+            indexPath = os.path.join(workDir, 'symbols.json')
+            cachePath = os.path.join(workDir, 'cache.json')
+            
+            with open(inputFile, 'w') as f:
+                f.write(text)
+            
+            def run():
+                index = asmfmt.SymbolIndex(indexPath)
+                formatter = asmfmt.AsmFormatter([inputFile], cache=asmfmt.FormatCache(cachePath), symbols=index)
+                result = formatter.format_files()[0]
+                formatter.cache.save()
+                index.save()
+                return result
+            
+            self.assertFalse(run().skipped)
+            
+            index = asmfmt.SymbolIndex(indexPath)
+            symbols = index.file_symbols(inputFile)
+            
+            with open(inputFile) as f:
+                lines = f.read().splitlines()
+            
+            self.assertEqual([(name, kind) for name, line, kind in symbols], [('hardware.inc', 'include'), ('Main', 'section'), ('Main', 'label'), ('.loop', 'local'),
+                                                                              ('NUM_THINGS', 'constant'), ('MAX_HP', 'constant'), ('Player.hp', 'label')])
+            self.assertTrue(all(name in lines[line - 1] for name, line, kind in symbols))
+            self.assertEqual(index.definitions('MAX_HP'), [(inputFile, lines.index('DEF MAX_HP = 10') + 1, 'constant')])
+            self.assertEqual(index.includes(inputFile), [('hardware.inc', 1)])
+            self.assertEqual(index.included_by(os.path.join(workDir, 'hardware.inc')), [(inputFile, 1)])
+            self.assertTrue(index.is_current(inputFile))
+            
+            #The first run changed the file, so only the second finds it formatted, and the third skips it
+            self.assertFalse(run().skipped)
+            self.assertTrue(run().skipped)
+            
+            os.utime(inputFile, ns=(0, 0))
+            self.assertTrue(run().skipped)
+            
+            with open(inputFile, 'a') as f:
+                f.write('wCount = 3\n')
+            
+            self.assertFalse(run().skipped)
+            self.assertEqual(asmfmt.SymbolIndex(indexPath).definitions('wCount'), [(inputFile, len(lines) + 1, 'constant')])
+            
+            #Chunks find the same symbols as the whole file, numbered the same
+            with open(inputFile, 'w') as f:
+                f.write(text * 100)
+            
+            toOutput = asmfmt.AsmFormatter([inputFile], [inputFile + '.out'], symbols=asmfmt.SymbolIndex(indexPath))
+            self.assertIsNone(toOutput.format_files()[0].symbols)
+            
+            checked = asmfmt.AsmFormatter([inputFile], check=True, symbols=asmfmt.SymbolIndex(indexPath))
+            self.assertIsNone(checked.format_files()[0].symbols)
+            
+            shutil.copy(inputFile, inputFile + '.copy')
+            expected = asmfmt.AsmFormatter([inputFile + '.copy'], symbols=asmfmt.SymbolIndex(indexPath)).format_files()[0].symbols
+            chunked = asmfmt.AsmFormatter([inputFile], jobs=2, chunkSize=256, symbols=asmfmt.SymbolIndex(indexPath)).format_files()[0]
+            
+            self.assertEqual(len(expected), 700)
+            self.assertEqual(chunked.symbols, expected)
+            self.assertTrue(filecmp.cmp(inputFile, inputFile + '.copy', shallow=False))
+    
+    def test_chunked_file(self):
+        """
+        Tests splitting big files into chunks that are formatted in parallel
+        
+        Input: A generated file, a file that is one long comment group and a file with \\r\\n line endings, formatted in chunks
+        to output files with and without a global indent, and then in place
+        Output: Chunks that cover each file and are cut between groups, and the same bytes as formatting each file whole
+        """
+        
+        with tempfile.TemporaryDirectory() as workDir:
+            
+            contents = {
+                'generated.asm': BenchAsmfmt.generate_corpus(64 * 1024, seed=3).encode(),
+                'comment.asm': ''.join('; line %d\n' % i for i in range(3000)).encode(),
+                'crlf.asm': BenchAsmfmt.generate_corpus(16 * 1024, seed=4).replace('\n', '\r\n').encode(),
+            }
+            inputs = []
+            
+            for name, content in contents.items():
+                inputs.append(os.path.join(workDir, name))
+                
+                with open(inputs[-1], 'wb') as f:
+                    f.write(content)
+            
+            chunked = asmfmt.AsmFormatter([], jobs=2, chunkSize=4096)
+            spans = chunked._chunk_spans(inputs[0])
+            
+            self.assertGreater(len(spans), 4)
+            self.assertEqual((spans[0][0], spans[-1][1]), (0, len(contents['generated.asm'])))
+            self.assertTrue(all(spans[i][1] == spans[i + 1][0] for i in range(len(spans) - 1)))
+            
+            #Every chunk starts on the first line of a group
+            lines = contents['generated.asm'].decode().splitlines(True)
+            groupStarts = set(accumulate([0] + [len(records) for group, records in chunked._get_candidate_groups(chunked._lex_lines(lines))]))
+            lineStarts = dict((offset, i) for i, offset in enumerate(accumulate([0] + [len(line) for line in lines])))
+            self.assertTrue(all(lineStarts[start] in groupStarts for start, end in spans))
+            
+            self.assertIsNone(chunked._chunk_spans(inputs[1]))
+            self.assertIsNone(chunked._chunk_spans(inputs[2]))
+            
+            for globalIndent in (False, True):
+                whole = [path + '.whole' for path in inputs]
+                parts = [path + '.chunked' for path in inputs]
+                
+                asmfmt.AsmFormatter(inputs, whole, globalIndent=globalIndent).format_files()
+                results = asmfmt.AsmFormatter(inputs, parts, globalIndent=globalIndent, jobs=2, chunkSize=4096, stats=True).format_files()
+                
+                self.assertEqual([result.error for result in results], [None] * 3)
+                self.assertEqual(results[0].stats.files, 1)
+                
+                for wholeFile, chunkedFile in zip(whole, parts):
+                    self.assertTrue(filecmp.cmp(wholeFile, chunkedFile, shallow=False), chunkedFile)
+            
+            results = asmfmt.AsmFormatter(inputs, jobs=2, chunkSize=4096, globalIndent=True).format_files()
+            
+            self.assertEqual([result.changed for result in results], [True, True, True])
+            
+            for path in inputs:
+                self.assertTrue(filecmp.cmp(path, path + '.whole', shallow=False), path)
+    
+    def test_bench_corpus(self):
+        """
+        Tests the benchmark corpus generator
+        
+        Input: Two corpora generated with the same seed and size, with and without a final newline
+        Output: Identical text of at least the requested size, with the final newline as asked, that formats without errors
+        """
+        
+        text = BenchAsmfmt.generate_corpus(8 * 1024, seed=7)
+        
+        self.assertEqual(text, BenchAsmfmt.generate_corpus(8 * 1024, seed=7))
+        self.assertGreaterEqual(len(text), 8 * 1024)
+        self.assertTrue(text.endswith('\n'))
+        self.assertFalse(BenchAsmfmt.generate_corpus(8 * 1024, seed=7, finalNewline=False).endswith('\n'))
+        self.assertNotEqual(asmfmt.format_string(text), text)
+        self.assertEqual(asmfmt.parse_size('64K'), 64 * 1024)
+
+
+class TestFormatProperties(unittest.TestCase):
+    """
+    Properties that should hold for any input, checked against generated asm rather than fixed files
+    """
+    
+    SEEDS = 1500
+    
+    INDENTS = ['', ' ', '  ', '\t', '\t\t', ' \t', '\t ']
+    CODE = ['ld a, b', 'xor a', 'jr nz, .loop', '.loop:', 'Label::', 'db $01, $02', 'ld [hl+], a',
+            'db "a;b", 0', "cp ';'", 'db "\\"";', 'db "unterminated', 'LD  a ,b', 'Label: Ld a,[hl]', 'ld a,', "cp ','", 'push   bc']
+    COMMENTS = ['; c', '; a longer comment', ';', ';; escaped', ';;', '; a ;', ';x;', ';---;', ';----------------;']
+    SPACING = ['', ' ', '   ', '\t', ' \t ']
+    
+    def random_line(self, rng):
+        
+        indent = rng.choice(self.INDENTS)
+        kind = rng.randrange(10)
+        
+        if kind < 2:
+            return ''
+        
+        if kind < 3:
+            return indent
+        
+        if kind < 5:
+            return indent + rng.choice(self.COMMENTS) + rng.choice(['', ' ', '\t'])
+        
+        code = indent + rng.choice(self.CODE)
+        
+        if kind < 8:
+            return code + rng.choice(self.SPACING) + rng.choice(self.COMMENTS)
+        
+        return code + rng.choice(['', ' '])
+    
+    def random_asm(self, rng):
+        """
+        A short random file, which may or may not end with a newline
+        """
+        
+        text = '\n'.join(self.random_line(rng) for i in range(rng.randint(0, 30)))
+        
+        return text + '\n' if rng.random() < 0.5 else text
+    
+    def test_idempotent(self):
+        """
+        Tests that formatting formatted asm changes nothing
+        
+        Input: Random asm with blank lines, mixed tabs and spaces, borders, escaped comments, quotes and missing final newlines
+        Output: The same text when the output is formatted again, with and without a global indent, with the default rules and with every rule
+        """
+        
+        formatters = [asmfmt.AsmFormatter([], globalIndent=globalIndent, rules=rules) for globalIndent in (False, True) for rules in (None, list(asmfmt.RULES))]
+        
+        for seed in range(self.SEEDS):
+            text = self.random_asm(random.Random(seed))
+            
+            for formatter in formatters:
+                once = formatter.format_text(text)[1]
+                
+                with self.subTest(seed=seed, globalIndent=formatter.globalIndent, rules=formatter.options_signature(), text=text):
+                    self.assertEqual(formatter.format_text(once)[1], once)
+    
+    def test_edits_match_formatting(self):
+        """
+        Tests that applying the edits of a text gives the same result as formatting it
+        
+        Input: Random asm, with the default rules and with every rule, for the whole text and for a range of lines
+        Output: The formatted text, from edits that are in order and don't overlap
+        """
+        
+        formatters = [asmfmt.AsmFormatter([], globalIndent=globalIndent, rules=rules) for globalIndent in (False, True) for rules in (None, list(asmfmt.RULES))]
+        
+        for seed in range(self.SEEDS // 3):
+            rng = random.Random(seed)
+            text = self.random_asm(rng)
+            first = rng.randint(1, 20)
+            
+            for formatter in formatters:
+                for ranges in (None, [(first, first + rng.randint(0, 5))]):
+                    state, edits = formatter.text_edits(text, ranges)
+                    spans = [((edit.startLine, edit.startColumn), (edit.endLine, edit.endColumn)) for edit in edits]
+                    
+                    with self.subTest(seed=seed, rules=formatter.options_signature(), ranges=ranges, text=text):
+                        self.assertEqual(asmfmt.apply_edits(text, edits), formatter.format_text(text, ranges)[1])
+                        self.assertTrue(all(start <= end for start, end in spans))
+                        self.assertTrue(all(spans[i][1] < spans[i + 1][0] for i in range(len(spans) - 1)))
+    
+    def test_final_newline_preserved(self):
+        """
+        Tests that formatting neither adds nor removes a final newline
+        
+        Input: Random asm without comments, with and without a final newline
+        Output: Text that ends with a newline exactly when the input did
+        """
+        
+        for seed in range(200):
+            rng = random.Random(seed)
+            text = '\n'.join(rng.choice(self.INDENTS) + rng.choice(self.CODE[:7]) for i in range(rng.randint(1, 10)))
+            
+            for ending in ('', '\n'):
+                with self.subTest(seed=seed, ending=ending):
+                    self.assertEqual(asmfmt.format_string(text + ending).endswith('\n'), ending == '\n')
+    
+    def time_format(self, text, repeat=3):
+        
+        best = None
+        
+        for i in range(repeat):
+            start = time.perf_counter()
+            asmfmt.format_string(text)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        
+        return best
+    
+    def scaling_exponent(self, makeText, sizes):
+        """
+        Fit time = c * length ** k to the time taken to format makeText(size) for each size, and return k
+        """
+        
+        points = []
+        
+        for size in sizes:
+            text = makeText(size)
+            points.append((math.log(len(text)), math.log(max(self.time_format(text), 1e-7))))
+        
+        meanX = sum(x for x, y in points) / len(points)
+        meanY = sum(y for x, y in points) / len(points)
+        
+        return sum((x - meanX) * (y - meanY) for x, y in points) / sum((x - meanX) ** 2 for x, y in points)
+    
+    def test_linear_scaling(self):
+        """
+        Tests that the time taken to format grows no faster than the input, including on pathological inputs
+        
+        Input: Normal code, a single huge comment group, very long lines and lines full of quotes, each at several sizes
+        Output: A fitted exponent of time against size well below quadratic
+        """
+        
+        cases = {
+            'code': (lambda n: '\n'.join('\tld a, b ; line %d' % i for i in range(n)) + '\n', [1000, 4000, 16000]),
+            'comment_group': (lambda n: '\n'.join('; comment line %d' % i for i in range(n)) + '\n', [1000, 4000, 16000]),
+            'long_lines': (lambda n: ('ld a, b' + ' ' * n + '; ' + 'x' * n + '\n') * 100, [1000, 4000, 16000]),
+            'quotes': (lambda n: 'db ' + ', '.join('"a;b"' for i in range(n)) + ' ; end\n', [2000, 8000, 32000]),
+        }
+        
+        for name, (makeText, sizes) in cases.items():
+            with self.subTest(case=name):
+                self.assertLess(self.scaling_exponent(makeText, sizes), 1.5)
+
 
 if __name__ == '__main__':
     unittest.main()
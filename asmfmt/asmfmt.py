@@ -1,548 +1,4062 @@
 import argparse
-from copy import deepcopy
+from collections import deque
+from contextlib import contextmanager
+from fnmatch import fnmatchcase
+import io
+from itertools import islice, repeat
+import json
 import os
 #psutil is useful for debugging file issues
 #import psutil
 import re
-from shutil import move
+import stat
 import sys
 import tempfile
-from docutils.nodes import line
+import time
+
+#Bump this whenever a change to the formatter changes its output, so that cached results are thrown away
+FORMATTER_VERSION = '2'
+
+#File types that are picked up when walking a directory
+DEFAULT_EXTENSIONS = ('.asm', '.inc', '.z80')
+
+#Number of files handed to a worker process at a time
+BATCH_SIZE = 4
 
 class CodeGroup:
     
+    __slots__ = ('numRows', 'maxSemiColonIdx')
+    
     def __init__(self, numRows, maxSemicolonIdx):
         self.numRows = numRows
         self.maxSemiColonIdx = maxSemicolonIdx
 
 class CommentGroup:
     
+    __slots__ = ('numRows', 'maxLen', 'hasTopBorder', 'hasBottomBorder')
+    
     def __init__(self, numRows, maxLen):
         self.numRows = numRows
         self.maxLen = maxLen
         
         self.hasTopBorder = False
         self.hasBottomBorder = False
-        
-        self.whiteSpaceSig = None
 
-class AsmFormatter:
+class LineRecord:
+    """
+    Everything the formatter needs to know about one line, found by a single scan in lex_line. Positions are indexes into text,
+    which is a str, or ASCII bytes when the file is being formatted by the bytes engine (see format_asm_bytes). The bytes engine
+    also lexes runs of several lines of code without comments as one line, see iter_line_runs
     
-    def __init__(self, files, outputs=None, globalIndent = False):
-        self.input = files
-        self.output = outputs
-        self.currentInputFile = None
-        self.currentOutputFile = None
+    kind is the type of group the line can belong to: CommentGroup for a line that only holds a comment,
+    CodeGroup for code with or without a trailing comment (blank lines count as code), and None for anything else.
+    Lines of the last kind are passed through untouched.
+    """
+    
+    __slots__ = ('text', 'kind', 'indentEnd', 'codeEnd', 'commentStart', 'isBorder', 'hasNewline')
+    
+    def __init__(self, text, kind, indentEnd, codeEnd, commentStart, isBorder, hasNewline):
+        self.text = text
+        self.kind = kind
+        self.indentEnd = indentEnd           # End of the leading spaces and tabs
+        self.codeEnd = codeEnd               # End of the code, without trailing whitespace. 0 if there is no code
+        self.commentStart = commentStart     # Index of the ; that starts the comment, -1 if there is no comment
+        self.isBorder = isBorder             # The line is a comment border, like ;-----;
+        self.hasNewline = hasNewline
+
+commentBorder = re.compile(";-*;")           # Match a comment border, starting from its first ;
+
+class LexChars:
+    """
+    The characters the lexer looks for. There is one set for str lines and one for bytes lines, so the same scan works on either
+    """
+    
+    __slots__ = ('semiColon', 'doubleQuote', 'singleQuote', 'backslash', 'whiteSpace', 'newline', 'underscore', 'border')
+    
+    def __init__(self, semiColon, doubleQuote, singleQuote, backslash, whiteSpace, newline, underscore, border):
+        self.semiColon = semiColon
+        self.doubleQuote = doubleQuote
+        self.singleQuote = singleQuote
+        self.backslash = backslash           # What indexing a line gives for a backslash, which for bytes is an int
+        self.whiteSpace = whiteSpace
+        self.newline = newline
+        self.underscore = underscore
+        self.border = border
+
+STR_CHARS = LexChars(';', '"', "'", '\\', ' \t', '\n', '_', commentBorder)
+BYTES_CHARS = LexChars(b';', b'"', b"'", ord('\\'), b' \t', b'\n', b'_', re.compile(b";-*;"))
+
+def find_comment_start(line, start=0, chars=STR_CHARS):
+    """
+    Find the ; that starts the comment on a line, skipping any that are inside string or character literals.
+    Returns -1 if the line has no comment.
+    
+    A quote that is never closed is not treated as a literal, so an odd apostrophe can't hide a comment.
+    """
+    
+    semiColonIdx = line.find(chars.semiColon, start)
+    
+    if semiColonIdx == -1:
+        return -1
+    
+    #The next quote of each kind. Almost every line has none before the semicolon, and the semicolon is the comment.
+    #Each is only searched for again once a literal has been skipped past it, so the line is scanned once however many literals it has
+    doubleQuoteIdx = line.find(chars.doubleQuote, start, semiColonIdx)
+    singleQuoteIdx = line.find(chars.singleQuote, start, semiColonIdx)
+    searchedTo = semiColonIdx
+    
+    while semiColonIdx != -1:
         
-        self.globalIndent = globalIndent
+        #Quotes that weren't found were only looked for up to an earlier semicolon
+        if semiColonIdx > searchedTo:
+            if doubleQuoteIdx == -1:
+                doubleQuoteIdx = line.find(chars.doubleQuote, searchedTo)
+            if singleQuoteIdx == -1:
+                singleQuoteIdx = line.find(chars.singleQuote, searchedTo)
+            searchedTo = len(line)
         
-        self.codeNoComment = re.compile("^((?!;).)*$")         # Match if the line does not contain ; 
-        #self.codeAndComment = re.compile("^\s*(\w+,*\s*)+;")  # Match if the line contains some alphanumeric characters, followed by a ;
-        self.codeAndComment = re.compile("^\s*\w+.*;")         # Match if the line contains some alphanumeric characters, followed by a ;
-        self.noCodeComment = re.compile("^\s*;")               # Match if the line contains some whitespace, followed by a ;
-        self.commentBorder = re.compile("^\s*;-*;")            # Match if the line is a comment border 
-        self.leadingWhiteSpace = re.compile("^([ \t]*)")       # Match just the leading whitespace of a line.
+        if doubleQuoteIdx != -1 and doubleQuoteIdx < start:
+            doubleQuoteIdx = line.find(chars.doubleQuote, start)
         
-        self.globalLineLen = 0
-        self.commentLines  = {}
-        self.commentGroups = {}
-        self.codeLines     = {}
-        self.codeGroups    = {}
+        if singleQuoteIdx != -1 and singleQuoteIdx < start:
+            singleQuoteIdx = line.find(chars.singleQuote, start)
+        
+        if doubleQuoteIdx == -1 or (singleQuoteIdx != -1 and singleQuoteIdx < doubleQuoteIdx):
+            quoteIdx = singleQuoteIdx
+        else:
+            quoteIdx = doubleQuoteIdx
+        
+        if quoteIdx == -1 or quoteIdx > semiColonIdx:
+            return semiColonIdx
+        
+        closeIdx = find_closing_quote(line, quoteIdx, chars)
+        
+        if closeIdx == -1:
+            return semiColonIdx
         
+        start = closeIdx + 1
+        semiColonIdx = line.find(chars.semiColon, start) if closeIdx > semiColonIdx else semiColonIdx
+    
+    return -1
 
-    def format_files(self):
+def find_closing_quote(line, quoteIdx, chars=STR_CHARS):
+    """
+    Find the quote that closes the literal opened at quoteIdx, skipping backslash escapes. Returns -1 if it is never closed
+    """
+    
+    backslash = chars.backslash
+    quote = line[quoteIdx]
+    closeIdx = line.find(quote, quoteIdx + 1)
+    
+    while closeIdx != -1:
         
+        #An odd number of backslashes means this quote is escaped
+        escapes = 0
+        while line[closeIdx - 1 - escapes] == backslash:
+            escapes += 1
+        
+        if escapes % 2 == 0:
+            return closeIdx
+        
+        closeIdx = line.find(quote, closeIdx + 1)
+    
+    return -1
 
-        for i, inputFile in enumerate(self.input):
-            
-            self.currentInputFile = inputFile
-            if self.output:
-                self.currentOutputFile = self.output[i]
-                
-            else:
-                self.currentOutputFile = None
+#How much of a mapped file is copied at a time to check that it is ASCII
+ASCII_CHECK_CHUNK = 1 << 20
+
+def is_bytes_safe(buffer):
+    """
+    Whether a buffer can be formatted by the bytes engine. It must be ASCII, because the columns of other characters
+    are not their byte offsets, and have no carriage returns, which text mode turns into newlines
+    """
+    
+    if buffer.find(b'\r') != -1:
+        return False
+    
+    return all(buffer[i:i + ASCII_CHECK_CHUNK].isascii() for i in range(0, len(buffer), ASCII_CHECK_CHUNK))
+
+def is_ascii_compatible(encoding):
+    """
+    Whether an encoding stores ASCII text as the same bytes as ASCII does, so ASCII files can be formatted as bytes without decoding them
+    """
+    
+    sample = '\t ;"\'\\\n_-azAZ09'
+    
+    try:
+        return sample.encode(encoding) == sample.encode('ascii')
+    
+    except LookupError:
+        return False
+
+def as_str(text):
+    """
+    A line as a str, decoding it if it came from the bytes engine
+    """
+    
+    return text if isinstance(text, str) else text.decode('ascii')
+
+def like(text, original):
+    """
+    A rewritten line, encoded back to bytes if the line it replaces came from the bytes engine
+    """
     
-            self.format_asm(self.currentInputFile, self.currentOutputFile)
+    return text if isinstance(original, str) else text.encode('ascii')
+
+lineIndent = re.compile(b"[ \t]*")
+sameIndentRuns = {}
+
+def iter_line_runs(buffer):
+    """
+    Split an ASCII buffer into the pieces the bytes engine lexes: a line with a ; in it, or a run of consecutive lines
+    without one that all have the same leading whitespace.
+    
+    Lines without a ; are code with no comment, which is never changed, and a run of them with the same indent all belong
+    to the same code group. lex_line gives a run the record its first line would get (except for codeEnd), so the rest of
+    the formatter can treat it as one line, and it is found and copied with a few scans of the buffer rather than line by line.
+    This is what makes large data tables, which are mostly db lines without comments, cheap to format.
+    """
+    
+    pos = 0
+    size = len(buffer)
+    
+    while pos < size:
+        
+        semiColonIdx = buffer.find(b';', pos)
+        
+        if semiColonIdx == -1:
+            gapEnd = size
+        else:
+            gapEnd = buffer.rfind(b'\n', pos, semiColonIdx) + 1
+            if gapEnd == 0:
+                gapEnd = pos
+        
+        #Lines from pos to gapEnd have no ;
+        while pos < gapEnd:
+            
+            indent = lineIndent.match(buffer, pos, gapEnd).group()
             
-            #Make sure that we start with a clean slate, otherwise the formatter can get messed up
-            self.globalLineLen = 0
-            self.commentLines  = {}
-            self.commentGroups = {}
-            self.codeLines     = {}
-            self.codeGroups    = {}
-            self.currentInputFile = None
-            self.currentOutputFile = None
+            if indent not in sameIndentRuns:
+                sameIndentRuns[indent] = re.compile(b"(?:" + re.escape(indent) + b"(?![ \t])[^\n]*(?:\n|\\Z))+")
             
+            runEnd = sameIndentRuns[indent].match(buffer, pos, gapEnd).end()
+            
+            yield buffer[pos:runEnd]
+            pos = runEnd
         
-    def format_asm(self, inputFile, output):
-        """
-        Format an asm file to comply with the following standards
+        if semiColonIdx == -1:
+            break
         
-        1) if a comment is preceeded by code, that comment must be indented to the local or global comment level
-        2) If the comment is not proceeded by code, it must be surrounded like so
-    
-        ;-------------------;
-        ; This is a comment ;
-        ; nice, huh?        ;
-        ;-------------------;
+        lineEnd = buffer.find(b'\n', semiColonIdx)
+        lineEnd = size if lineEnd == -1 else lineEnd + 1
         
-        2.1) Must start with a ;-...-;
-        2.2) lines with text must start and end with a ;
-        2.3) must end with a ;-...-;
-        2.4) Whitespace before the leading semicolon, and after the semicolon but preceeding any text is preserved as is
-              
+        yield buffer[pos:lineEnd]
+        pos = lineEnd
+
+def continues_group(prev, record):
+    """
+    Whether the line of record belongs to the same group as the line before it, of prev. The test _get_candidate_groups makes
+    """
+    
+    return prev.kind is record.kind and (record.kind is None or prev.text[:prev.indentEnd] == record.text[:record.indentEnd])
+
+def shift_symbols(symbols, shifts):
+    """
+    Renumber (name, line number, kind) symbols, found in lines as they were read, by the lines as they were written.
+    shifts holds (index, count) for each place count lines were added before the line at index, in order
+    """
+    
+    shifted = []
+    shift = 0
+    i = 0
+    
+    for name, line, kind in symbols:
         
-        """
+        while i < len(shifts) and shifts[i][0] < line:
+            shift += shifts[i][1]
+            i += 1
         
-        if output:
-            outputFile = output
-            
-        else:
-            inputPath = os.path.abspath(os.path.dirname(inputFile))            
-            tmpFilePackage = tempfile.mkstemp(dir=inputPath)
-            outputFile = tmpFilePackage[1]         
+        shifted.append((name, line + shift, kind))
+    
+    return shifted
+
+def lex_line(line, chars=STR_CHARS):
+    """
+    Classify a line once, and record where its indent, code and comment are. Lines that are ASCII bytes are lexed with BYTES_CHARS
+    """
+    
+    indentEnd = len(line) - len(line.lstrip(chars.whiteSpace))
+    commentStart = find_comment_start(line, indentEnd, chars)
+    hasNewline = line.endswith(chars.newline)
+    
+    if commentStart == -1:
+        return LineRecord(line, CodeGroup, indentEnd, len(line.rstrip()), -1, False, hasNewline)
+    
+    if commentStart == indentEnd:
+        isBorder = chars.border.match(line, commentStart) is not None
+        return LineRecord(line, CommentGroup, indentEnd, 0, commentStart, isBorder, hasNewline)
+    
+    # Code will be anything before the comment
+    codeEnd = len(line[:commentStart].rstrip())
+    
+    #Only code that starts with an alphanumeric character is aligned, anything else (like .label: ; comment) is left alone
+    firstChar = line[indentEnd:indentEnd + 1]
+    kind = CodeGroup if firstChar.isalnum() or firstChar == chars.underscore else None
+    
+    return LineRecord(line, kind, indentEnd, codeEnd, commentStart, False, hasNewline)
 
+class FileState:
+    """
+    Everything that is specific to formatting one file. A new one is made for every call to format_asm,
+    so the formatter itself only holds settings and can be shared between files and worker processes.
+    """
+    
+    def __init__(self, inputFile, outputFile):
+        self.inputFile = inputFile
+        self.outputFile = outputFile
+        
+        self.globalLineLen = 0
         
-        self._find_features(inputFile)
-        self._get_candidate_comment_groups()
-        self._get_candidate_code_groups()
+        #Lines that were rewritten, plus any borders or newlines that were added
+        self.linesChanged = 0
         
-  
-        with open(inputFile, 'r') as f:
-            with open(outputFile, 'w') as o:
-                
-                fNumbered = enumerate(f)
-                for idx, line in fNumbered:
+        #The number of the line the line rules are on, counting from 1, and the (line number, message) of each problem the lint rules found
+        self.lineNumber = 0
+        self.problems = []
         
-                    """
-                    Rule 2 Implementation
-                    """
-                    
-                    if idx in self.commentGroups:
-                        
-                        group = self.commentGroups[idx]
-                        groupLine = line
-                        whiteSpace = line[:line.find(';'):]
-                        
-                        """
-                        Check to see if this line contains a newline. If not (such as if the comment is at the end of the file),
-                        then we need to set the offset differently
-                        """
-                        newLine = line.find('\n')
-                        newLineOffset = 1
-                        if newLine == -1:
-                            newLineOffset = 0
-
-                        #Subtract 1-newLineOffset from the maxlength because one character is already a semicolon, one might be a newline
-                        borderString = whiteSpace + ';' + '-' * (group.maxLen - 1 - newLineOffset - len(whiteSpace)) + ';\n'
-                        
-                        if not group.hasTopBorder:
-                            o.write(borderString)
-                            
-                            
-                        for i in range(group.numRows):
-                            
-                            if not self.is_comment_formatted(groupLine):
-                                groupLine = self.format_comment(groupLine, group.maxLen)
-                            
-                            o.write(groupLine)
-                            
-                            if i < group.numRows - 1:
-                                try:
-                                    idx, groupLine = fNumbered.__next__()
-                                
-                                #The last line of the file was a part of the comment group
-                                #So, we can end this function here
-                                except StopIteration as e:
-                                    
-                                    if not group.hasBottomBorder:
-                                        o.write(borderString) 
-                                    
-                                    f.close()
-                                    o.close()
-    
-                                    
-                                    if not output:
-                                        self.rename_and_remove_tempfile(tmpFilePackage)
-                                    
-                                    return
-                                
-                        if not group.hasBottomBorder:
-                            o.write(borderString)
-                        line = groupLine
-                        
-                        continue
+        #The (name, line number, kind) of each symbol found, when they are being collected for a SymbolIndex
+        self.symbols = None
+        
+        #A FileStats when the formatter is collecting them
+        self.stats = None
 
+class FileStats:
+    """
+    Timings and counters for formatting one file, collected when the formatter is made with stats on.
+    
+    phases holds the seconds spent in each phase that ran:
+    
+    scan: the extra pass over the file that finds the global indent
+    read: reading the whole file into memory, when it is formatted in memory
+    lex: splitting the lines into groups
+    write: writing out the groups
+    replace: moving the formatted file over the input, or removing it when nothing changed
+    
+    rules holds the seconds each FormatRule took and the lines it changed, as [seconds, lines]. Line rules run
+    during lex, and group rules during write, so their time is also part of those phases.
+    
+    Stats for several files are added together with merge.
+    """
+    
+    LINE_KINDS = ('code', 'comment', 'blank', 'other')
+    GROUP_KINDS = ('code', 'comment', 'other')
+    
+    def __init__(self):
+        self.phases = {}
+        self.bytesRead = 0
+        self.bytesWritten = 0
+        self.lines = dict.fromkeys(self.LINE_KINDS, 0)
+        self.groups = dict.fromkeys(self.GROUP_KINDS, 0)
+        self.linesModified = 0
+        self.rewritten = False
+        self.files = 1
+        self.rules = {}
+    
+    def add_time(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+    
+    def add_rule(self, name, seconds, lines):
+        
+        entry = self.rules.setdefault(name, [0.0, 0])
+        entry[0] += seconds
+        entry[1] += lines
+    
+    @contextmanager
+    def timed(self, phase):
+        
+        start = time.perf_counter()
+        
+        try:
+            yield
+        
+        finally:
+            self.add_time(phase, time.perf_counter() - start)
+    
+    def count_group(self, group, records):
+        
+        if isinstance(group, CodeGroup):
+            self.groups['code'] += 1
+            
+            for record in records:
+                
+                if isinstance(record.text, bytes) and record.commentStart == -1:
+                    #Possibly a run of lines from the bytes engine, see iter_line_runs. Blank lines in it are just the indent
+                    lines = record.text.split(b'\n')
+                    if record.hasNewline:
+                        lines.pop()
                     
-                    """
-                    Rule 1 Implementation
-                    """
-                    
-                    if idx in self.codeGroups:
-                        
-                        cGroup = self.codeGroups[idx]
-                        cGroupLine = line
-                        
-                        for i in range(cGroup.numRows):
-                    
-                            match = re.search(self.codeAndComment, cGroupLine)
-                            if match and not self.is_code_formatted(cGroupLine, cGroup):
-                                
-                                indentType = self.globalLineLen if self.globalIndent else cGroup.maxSemiColonIdx
-                                cGroupLine = self.pad_line_with_spaces(cGroupLine, indentType)
-                            
-                            o.write(cGroupLine)
-                                
-                                
-                            if i < cGroup.numRows - 1:
-                                try:
-                                    idx, cGroupLine = fNumbered.__next__()
-                                
-                                except StopIteration as e:
-                                    
-                                    #get rid of noeol warnings in vi
-                                    if not self.check_for_final_newline(inputFile):
-                                        o.write('\n')
-                                    
-                                    f.close()
-                                    o.close()
-            
-                                    if not output:
-                                        self.rename_and_remove_tempfile(tmpFilePackage)
-                                        return 
-                                    
-                            
-
-                #get rid of noeol warnings in vi
-                if not self.check_for_final_newline(inputFile):
-                    o.write('\n')
+                    blank = sum(1 for line in lines if len(line) == record.indentEnd)
+                    self.lines['blank'] += blank
+                    self.lines['code'] += len(lines) - blank
+                
+                elif record.codeEnd:
+                    self.lines['code'] += 1
+                
                 else:
-                    pass
+                    self.lines['blank'] += 1
         
+        elif isinstance(group, CommentGroup):
+            self.groups['comment'] += 1
+            self.lines['comment'] += len(records)
         
-        if not self.output:
-            self.rename_and_remove_tempfile(tmpFilePackage)
-            
-        return
+        else:
+            self.groups['other'] += 1
+            self.lines['other'] += len(records)
+    
+    def merge(self, other):
+        
+        for phase, seconds in other.phases.items():
+            self.add_time(phase, seconds)
+        
+        for kind in self.LINE_KINDS:
+            self.lines[kind] += other.lines[kind]
+        
+        for kind in self.GROUP_KINDS:
+            self.groups[kind] += other.groups[kind]
+        
+        for name, (seconds, lines) in other.rules.items():
+            self.add_rule(name, seconds, lines)
+        
+        self.bytesRead += other.bytesRead
+        self.bytesWritten += other.bytesWritten
+        self.linesModified += other.linesModified
+        self.rewritten += other.rewritten
+        self.files += other.files
     
-    def check_for_final_newline(self, inputFile):
+    def as_dict(self):
         """
-        Check if a file has a final newline, and return the result
+        The stats as a dict that can be dumped as JSON. Once merged, rewritten counts the files that were rewritten
         """
-        with open(inputFile, 'r') as f:
-            lines = f.readlines()
-            finalLine = lines[-1]
-            
-            newLine = finalLine.find('\n')
-            
-            if newLine == -1:
-                return True
-            else:
-                return False
-            
+        
+        return {
+            'phases': self.phases,
+            'bytes_read': self.bytesRead,
+            'bytes_written': self.bytesWritten,
+            'lines': self.lines,
+            'groups': self.groups,
+            'lines_modified': self.linesModified,
+            'rewritten': self.rewritten,
+            'rules': {name: {'seconds': seconds, 'lines': lines} for name, (seconds, lines) in self.rules.items()},
+        }
+
+class FormatResult:
+    """
+    The outcome of formatting one file. error is None on success, otherwise the exception that stopped the file
+    from being formatted.
     
-    def rename_and_remove_tempfile(self, tf):
+    changed is None when the file was not formatted (it failed, or was skipped because the cache already
+    knew it was formatted), otherwise whether the output differs from the input.
+    
+    diff holds a unified diff of the changes when the formatter was asked for one, and stats the FileStats
+    of the file when it was asked for those. problems holds the (line number, message) of each problem the lint
+    rules found.
+    
+    symbols holds the symbols found in the file when they are collected and the file is left as they describe it,
+    and fingerprint the file_fingerprint of the file they were found in.
+    """
+    
+    def __init__(self, inputFile, outputFile, error=None, changed=None, skipped=False, diff=None, stats=None, problems=(), symbols=None, fingerprint=None):
+        self.inputFile = inputFile
+        self.outputFile = outputFile
+        self.error = error
+        self.changed = changed
+        self.skipped = skipped
+        self.diff = diff
+        self.stats = stats
+        self.problems = problems
+        self.symbols = symbols
+        self.fingerprint = fingerprint
+
+class TextEdit:
+    """
+    One change to a text: the span from (startLine, startColumn) up to (endLine, endColumn) is replaced by text.
+    Lines and columns count from 0, columns are in characters, and a span with its start and end the same is an insertion.
+    A span that ends at the start of the next line takes the newline with it.
+    """
+    
+    __slots__ = ('startLine', 'startColumn', 'endLine', 'endColumn', 'text')
+    
+    def __init__(self, startLine, startColumn, endLine, endColumn, text):
+        self.startLine = startLine
+        self.startColumn = startColumn
+        self.endLine = endLine
+        self.endColumn = endColumn
+        self.text = text
+    
+    def __repr__(self):
+        return f"TextEdit({self.startLine}, {self.startColumn}, {self.endLine}, {self.endColumn}, {self.text!r})"
+    
+    def as_tuple(self):
+        return (self.startLine, self.startColumn, self.endLine, self.endColumn, self.text)
+
+class FormatCache:
+    """
+    A persistent record of file contents that are already formatted, so that they can be skipped without being parsed.
+    
+    Entries are keyed on a hash of the file contents and the formatter options. The whole cache is thrown away when it
+    was written by a different FORMATTER_VERSION, and only the maxEntries most recently used entries are kept on save.
+    
+    It also remembers the code width of file contents that were scanned for a project wide indent, see AsmFormatter.find_project_line_len
+    """
+    
+    def __init__(self, path, maxEntries=20000):
+        self.path = path
+        self.maxEntries = maxEntries
         
-        #tf is tuple returned by the tempfile mksftemp function.
-        #First index is a file descriptor, second is the filename
-        os.close(tf[0])
-        path = os.path.abspath(self.currentInputFile)
-        move(os.path.abspath(tf[1]), path)
+        #Each entry maps a key to the run it was last used in, which is what eviction goes by
+        self.entries = {}
+        self.run = 1
         
-    
-    def pad_line_with_spaces(self, line, indent):
-        idx = line.index(';')
-        code = line[:idx]
-        code += " " * (indent - len(code))
-        line = code + line[idx:]
+        #Maps a key to a [width, run] pair
+        self.widths = {}
         
-        return line
+        self.load()
     
-    def format_comment(self, line, length):
-        """
-        If a line has a newline char at the end, we want to strip that out. Otherwise,
-        leave the line as is. This is needed for the edgecase of a comment at the end of a file. 
-        """
-        linePortion = None
-        offset = 0
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
         
-        if line[-1] != '\n':
-            linePortion = line
-            offset = length - len(line) -1
-            
-        else:
-            linePortion = line[:-1]
-            offset = length - len(line)
+        except (OSError, ValueError):
+            return
+        
+        if not isinstance(data, dict) or data.get('version') != FORMATTER_VERSION:
+            return
         
-        return  linePortion + (offset * ' ') + ';\n'
+        self.entries = data.get('entries', {})
+        self.widths = data.get('widths', {})
+        self.run = data.get('run', 0) + 1
     
-    def is_code_formatted(self, line, cGroup):
+    def save(self):
         """
-        Identify if a line of code with a comment has possibly already been formatted by this tool.
-        
-        This function looks to see if the semicolon on a given line is at group.maxLen + 1. If so,
-        we assume that this string has already been formatted, and skip it
+        Write the cache back out, evicting the least recently used entries if it has grown past maxEntries
         """
         
-        semiColonIdx = line.find(';')
+        if len(self.entries) > self.maxEntries:
+            keep = sorted(self.entries.items(), key=lambda entry: entry[1], reverse=True)[:self.maxEntries]
+            self.entries = dict(keep)
         
-        if self.globalIndent:
-            return semiColonIdx == self.globalLineLen
-        else:
-            return semiColonIdx == cGroup.maxSemiColonIdx
+        if len(self.widths) > self.maxEntries:
+            keep = sorted(self.widths.items(), key=lambda entry: entry[1][1], reverse=True)[:self.maxEntries]
+            self.widths = dict(keep)
         
-    def is_comment_formatted(self, line):
-        """
-        Identifies if a comment has possibly already been formatted by this tool
+        data = {'version': FORMATTER_VERSION, 'run': self.run, 'entries': self.entries, 'widths': self.widths}
         
-        This functions checks for the existence of a second semicolon in a comment line. If this exists
-        it assumes that it has already been formatted by this tool.
+        #Write to a temp file first so that a killed run can't leave a truncated cache behind
+        cacheDir = os.path.dirname(os.path.abspath(self.path))
+        fd, tmpPath = tempfile.mkstemp(dir=cacheDir)
         
-        This also lets users escape this comment formatting, by using a double semicolon instead of just one
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        
+        os.replace(tmpPath, self.path)
+    
+    def key(self, inputFile, options):
+        """
+        Hash the contents of a file together with the options it is formatted with
         """
-        semiColonIdx = line.find(';')
-        secondSCIdx = line.find(';', semiColonIdx + 1)
         
-        return secondSCIdx != -1
+        import hashlib
+        
+        digest = hashlib.sha256(options.encode())
         
+        with open(inputFile, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
         
+        return digest.hexdigest()
     
-    def _find_features(self, file):
-        """
-        Finds all comment groups in the file, as well as the maximum length of all lines containing code
+    def is_formatted(self, key):
         
-        . A comment group will look like
+        if key in self.entries:
+            self.entries[key] = self.run
+            return True
         
-        ; Something 
-        ; like
-        ; this
+        return False
+    
+    def mark_formatted(self, key):
+        self.entries[key] = self.run
     
-        Identifying and formatting comment groups
+    def width(self, key):
+        """
+        The code width scanned from the contents with this key, or None if they haven't been scanned
+        """
         
-        All ; characters in a comment group must be at the same indent level. Different
-        indent levels will denote different comment groups
+        if key not in self.widths:
+            return None
         
-        A comment group is considered ended when
-        1) The next line contains code
-        2) The next line contains a differently indented comment group
+        self.widths[key][1] = self.run
+        return self.widths[key][0]
+    
+    def set_width(self, key, width):
+        self.widths[key] = [width, self.run]
 
-        """    
-        
-        with open(file, 'r') as f:
-            
+#Bump this whenever what the symbol index records changes, so that old indexes are thrown away
+SYMBOL_INDEX_VERSION = '1'
 
-            for idx, line in enumerate(f):
-                
-                """
-                Start by checking for comment groups because the logic works nicely. If its a comment, note down the location.
-                If not, then we can check for the length
-                """
-                
-                #TODO: test this out
-                #lineEscaped = re.escape(line)
-                
-                match = re.search(self.noCodeComment, line)
-                if match:
-                    
-                    #whitespace = re.match(self.leadingWhiteSpace, line)
-                    self.commentLines[idx] = line
-                        
-                
-                length = 0
-                
-                match = re.search(self.codeNoComment, line)
-                
-                if match:
-                    length = len(line.rstrip())
-                    self.codeLines[idx] = line
-                
-                match = re.search(self.codeAndComment, line)    
-                if match:
-                    length = len(line.split(';')[0].rstrip()) # Code will be anything before the first ; 
-                    self.codeLines[idx] = line
+#Where the symbol index is kept when no path is given
+DEFAULT_SYMBOL_INDEX = '.asmfmt_symbols.json'
 
-                if length > self.globalLineLen:
-                    self.globalLineLen = length
+def file_fingerprint(path):
+    """
+    The [mtime in ns, size, sha256 of the contents] of a file. The file is stat'ed before it is read, so a change
+    made while it is being read leaves a fingerprint whose mtime no longer matches
+    """
+    
+    import hashlib
+    
+    fileStat = os.stat(path)
+    digest = hashlib.sha256()
+    
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    
+    return [fileStat.st_mtime_ns, fileStat.st_size, digest.hexdigest()]
+
+class SymbolIndex:
+    """
+    A persistent index of the symbols defined in each file: labels, local labels, SECTIONs, constants (EQU, EQUS, SET,
+    =, RB, RW, RL and DEF), and the files each one INCLUDEs. It is filled in by the lexing pass of in-place formatting,
+    see SymbolRule, so building it costs no extra read of any file, and queries are answered from the index alone.
+    
+    Each file's entry holds the fingerprint of the contents its symbols were found in, see file_fingerprint. A file
+    whose mtime and size still match is current without being read, and one whose only change is its mtime is current
+    if its hash still matches. Only files that are not current are indexed again, which is what lets a run with a
+    FormatCache skip files that are both formatted and indexed.
+    
+    Symbols are (name, line, kind), with line counting from 1 in the file as it is after formatting, and kind one of
+    label, local, section, constant or include. The name of an include is the path as it is written in the source.
+    """
+    
+    KINDS = ('label', 'local', 'section', 'constant', 'include')
+    
+    def __init__(self, path):
+        self.path = path
         
+        #Maps the absolute path of each file to {'fingerprint': [mtime, size, hash], 'symbols': [[name, line, kind], ...]}
+        self.files = {}
         
-        #Add one extra space so that the semicolon is not immediately against the end of the code
-        self.globalLineLen += 1
-
-    def _get_candidate_comment_groups(self):
+        #Maps each name to the (path, line, kind) of its definitions, built on the first query
+        self.byName = None
+        
+        self.load()
+    
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        
+        except (OSError, ValueError):
+            return
+        
+        if not isinstance(data, dict) or data.get('version') != SYMBOL_INDEX_VERSION:
+            return
         
+        self.files = data.get('files', {})
+    
+    def save(self):
         """
-        Scan through the list of comment lines and construct a dictionary of CommentGroup objects
+        Write the index back out, dropping the files that no longer exist
         """
         
-        indices = list(self.commentLines.keys())
+        self.files = {path: entry for path, entry in self.files.items() if os.path.exists(path)}
+        data = {'version': SYMBOL_INDEX_VERSION, 'files': self.files}
+        
+        #Write to a temp file first so that a killed run can't leave a truncated index behind
+        indexDir = os.path.dirname(os.path.abspath(self.path))
+        fd, tmpPath = tempfile.mkstemp(dir=indexDir)
+        
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
         
+        os.replace(tmpPath, self.path)
+    
+    def is_current(self, path):
         """
-        If self.commentLines is empty, it means we did not identify any block comments, so we can skip this section.
+        Whether the symbols of a file are those of its contents now
         """
         
-        if not indices:
-            return
+        entry = self.files.get(os.path.abspath(path))
         
-        indices.sort()
+        if entry is None:
+            return False
         
-        startIdx = indices[0]
-        prevIdx = indices[0]
-        prevLine = self.commentLines[prevIdx]
-        group = CommentGroup(1,len(prevLine))
-        prevWhiteSpaceSig = re.match(self.leadingWhiteSpace, prevLine).group()
+        try:
+            fileStat = os.stat(path)
+        except OSError:
+            return False
         
-        match = re.match(self.commentBorder, prevLine)
+        mtime, size, digest = entry['fingerprint']
         
-        if match:
-            group.hasTopBorder = True
-
+        if (fileStat.st_mtime_ns, fileStat.st_size) == (mtime, size):
+            return True
         
-        for i in indices[1:]:
-            currentLine = self.commentLines[i]
-            whiteSpaceSig = re.match(self.leadingWhiteSpace, currentLine).group()
-            
+        if fileStat.st_size != size:
+            return False
+        
+        try:
+            fingerprint = file_fingerprint(path)
+        except OSError:
+            return False
+        
+        if fingerprint[2] != digest:
+            return False
+        
+        entry['fingerprint'] = fingerprint
+        return True
+    
+    def update(self, path, fingerprint, symbols):
+        
+        self.files[os.path.abspath(path)] = {'fingerprint': fingerprint, 'symbols': [list(symbol) for symbol in symbols]}
+        self.byName = None
+    
+    def file_symbols(self, path):
+        """
+        The (name, line, kind) of every symbol in a file, in order
+        """
+        
+        entry = self.files.get(os.path.abspath(path))
+        
+        return [tuple(symbol) for symbol in entry['symbols']] if entry else []
+    
+    def definitions(self, name):
+        """
+        The (path, line, kind) of every definition of a label, section or constant
+        """
+        
+        if self.byName is None:
+            self.byName = {}
             
-            if i == prevIdx + 1 and whiteSpaceSig == prevWhiteSpaceSig:
-                
-                """
-                The lines are consecutive and have the same amount of whitespace. So we can add this line
-                to the current commentGroup, and update the maximum line length if necessary
+            for path, entry in self.files.items():
+                for symbolName, line, kind in entry['symbols']:
+                    if kind != 'include':
+                        self.byName.setdefault(symbolName, []).append((path, line, kind))
+        
+        return self.byName.get(name, [])
+    
+    def includes(self, path):
+        """
+        The (included path, line) of every INCLUDE in a file
+        """
+        
+        return [(name, line) for name, line, kind in self.file_symbols(path) if kind == 'include']
+    
+    def included_by(self, target):
+        """
+        The (path, line) of every INCLUDE of target, matching includes written as target or as any trailing part of its path
+        """
+        
+        target = os.path.normpath(target)
+        found = []
+        
+        for path, entry in self.files.items():
+            for name, line, kind in entry['symbols']:
+                
+                if kind != 'include':
+                    continue
+                
+                name = os.path.normpath(name)
+                
+                if target == name or target.endswith(os.sep + name):
+                    found.append((path, line))
+        
+        return found
+
+class WriteBack:
+    """
+    Moves formatted temp files over the inputs they replace, with os.replace so that an input is always either
+    the old or the new version, never a partial one. The temp file gets the permissions of the input first,
+    since mkstemp creates it readable by its owner only.
+    
+    fsync is the durability policy:
+    
+    none: leave flushing to the OS
+    file: fsync each temp file before it replaces its input, so a crash can't leave an input empty or truncated
+    batch: as file, and once a batch is replaced, fsync each directory it touched once, so the renames themselves are durable
+    
+    Inside a with batch() block, replacements are collected and made together when the block ends, with any
+    errors collected in the dict it gives. Outside one, each temp file replaces its input straight away and errors are raised.
+    """
+    
+    POLICIES = ('none', 'file', 'batch')
+    
+    def __init__(self, fsync='none'):
+        
+        if fsync not in self.POLICIES:
+            raise ValueError(f"unknown fsync policy {fsync}, expected one of {', '.join(self.POLICIES)}")
+        
+        self.fsync = fsync
+        self.pending = None
+    
+    def add(self, tf, inputFile):
+        """
+        Replace inputFile with the temp file tf, a (file descriptor, path) pair from mkstemp. Closes the descriptor
+        """
+        
+        fd, tmpPath = tf
+        
+        try:
+            mode = stat.S_IMODE(os.stat(inputFile).st_mode)
+            
+            if hasattr(os, 'fchmod'):
+                os.fchmod(fd, mode)
+            else:
+                os.chmod(tmpPath, mode)
+            
+            if self.fsync != 'none':
+                os.fsync(fd)
+        
+        except:
+            os.close(fd)
+            os.remove(tmpPath)
+            raise
+        
+        os.close(fd)
+        
+        if self.pending is None:
+            self._replace([(tmpPath, inputFile)])
+        else:
+            self.pending.append((tmpPath, inputFile))
+    
+    @contextmanager
+    def batch(self):
+        
+        self.pending = []
+        errors = {}
+        
+        try:
+            yield errors
+        
+        finally:
+            pending = self.pending
+            self.pending = None
+            self._replace(pending, errors)
+    
+    def _replace(self, pending, errors=None):
+        """
+        Make the replacements in pending. Without an errors dict to record them in, the first error is raised
+        """
+        
+        directories = set()
+        
+        for tmpPath, inputFile in pending:
+            
+            try:
+                os.replace(tmpPath, inputFile)
+                directories.add(os.path.dirname(os.path.abspath(inputFile)))
+            
+            except OSError as e:
+                os.remove(tmpPath)
+                
+                if errors is None:
+                    raise
+                errors[inputFile] = e
+        
+        if self.fsync == 'batch':
+            for directory in directories:
+                fsync_directory(directory)
+
+def fsync_directory(directory):
+    """
+    fsync a directory, so that renames in it are durable. Does nothing where directories can't be opened, like Windows
+    """
+    
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    
+    except OSError:
+        return
+    
+    try:
+        os.fsync(fd)
+    
+    finally:
+        os.close(fd)
+
+class FormatRule:
+    """
+    A formatting rule. Every enabled rule runs in the same single pass over the file, so adding a rule doesn't add
+    another read of the file or another lexing of its lines.
+    
+    A rule works either on one line at a time or on a whole group at a time:
+    
+    Line rules set kinds to the kinds of line (CodeGroup, CommentGroup or None, see LineRecord) they look at, and
+    implement format_line. They run as each line is lexed, in the order they were enabled, before the line is put
+    in a group, so groups (and the global indent) are always built from the rewritten lines.
+    
+    Group rules set kinds to the kinds of group (CodeGroup or CommentGroup) they rewrite, and implement format_group.
+    They run as each group is written out, and only one enabled group rule can rewrite each kind of group.
+    
+    Lint rules are line rules that set lints and implement check_line instead of format_line. They never change a line,
+    and what they find is collected in FileState.problems with the number of the line. Rules that set collects are
+    the same, but implement collect_line and gather whatever they like into the FileState, see SymbolRule.
+    
+    name is how the rule is enabled and disabled. A rule is made available by name with register_rule, and a rule
+    that is used with more than one job has to be importable by the worker processes.
+    """
+    
+    name = None
+    kinds = ()
+    
+    #Whether the rule is a line rule or a group rule
+    perLine = True
+    
+    #Whether the rule is a lint rule, or a rule that collects something from each line
+    lints = False
+    collects = False
+    
+    def signature(self):
+        """
+        The rule and any settings that change what it does, for cache keys
+        """
+        
+        return self.name
+    
+    def format_line(self, line, record):
+        """
+        Return line, a str holding record.text, with the rule applied. Positions in record are still valid for line
+        """
+        
+        return line
+    
+    def check_line(self, line, record):
+        """
+        Return a message for each problem found in line, a str holding record.text
+        """
+        
+        return ()
+    
+    def collect_line(self, line, record, state):
+        """
+        Gather what the rule collects from line, a str holding record.text, into state. state.lineNumber is the number of the line
+        """
+    
+    def format_group(self, formatter, o, group, records, state):
+        """
+        Write the records of a group to o with the rule applied, adding the lines changed to state.linesChanged.
+        
+        A group rule writes one line for each record, in order, and may add whole lines before the first record
+        and after the last. It returns how many it added as (before, after), or None if it added none, which is
+        what lets the changes be given as edits, see AsmFormatter.text_edits
+        """
+        
+        o.writelines(record.text for record in records)
+
+#Every rule that can be enabled by name, see register_rule
+RULES = {}
+
+#The rules that are enabled unless others are asked for: the two rules the formatter has always applied
+DEFAULT_RULES = ('code_comment', 'block_comment')
+
+def register_rule(rule):
+    """
+    Make a FormatRule class available by its name. Can be used as a class decorator
+    """
+    
+    RULES[rule.name] = rule
+    return rule
+
+def select_rules(enable=(), disable=()):
+    """
+    The names of the rules to run: the default rules, plus those in enable, minus those in disable
+    """
+    
+    names = list(DEFAULT_RULES)
+    
+    for name in list(enable) + list(disable):
+        if name not in RULES:
+            raise ValueError(f"unknown rule {name}, expected one of {', '.join(RULES)}")
+    
+    names.extend(name for name in enable if name not in names)
+    
+    return [name for name in names if name not in disable]
+
+@register_rule
+class CodeCommentRule(FormatRule):
+    """
+    Rule 1: comments after code are aligned to the local or global comment level
+    """
+    
+    name = 'code_comment'
+    kinds = (CodeGroup,)
+    perLine = False
+    
+    def format_group(self, formatter, o, group, records, state):
+        return formatter._write_code_group(o, group, records, state)
+
+@register_rule
+class BlockCommentRule(FormatRule):
+    """
+    Rule 2: comments on their own lines are surrounded by a border
+    """
+    
+    name = 'block_comment'
+    kinds = (CommentGroup,)
+    perLine = False
+    
+    def format_group(self, formatter, o, group, records, state):
+        return formatter._write_comment_group(o, group, records, state)
+
+@register_rule
+class TrailingWhitespaceRule(FormatRule):
+    """
+    Strip spaces and tabs from the end of every line
+    """
+    
+    name = 'trailing_whitespace'
+    kinds = (CodeGroup, CommentGroup, None)
+    
+    def format_line(self, line, record):
+        
+        newline = '\n' if record.hasNewline else ''
+        body = line[:-1] if newline else line
+        
+        return body.rstrip(' \t') + newline
+
+#The instructions of the Game Boy CPU
+MNEMONICS = frozenset(['adc', 'add', 'and', 'bit', 'call', 'ccf', 'cp', 'cpl', 'daa', 'dec', 'di', 'ei', 'halt', 'inc',
+                       'jp', 'jr', 'ld', 'ldd', 'ldh', 'ldi', 'nop', 'or', 'pop', 'push', 'res', 'ret', 'reti', 'rl', 'rla',
+                       'rlc', 'rlca', 'rr', 'rra', 'rrc', 'rrca', 'rst', 'sbc', 'scf', 'set', 'sla', 'sra', 'srl', 'stop',
+                       'sub', 'swap', 'xor'])
+
+#An optional label, then a word that may be a mnemonic, then anything after it
+instructionPattern = re.compile(r"((?:[A-Za-z_.][\w.@#$]*::?[ \t]*)?)([A-Za-z]+)(?=[ \t]|$)(.*)", re.DOTALL)
+labelPattern = re.compile(r"[A-Za-z_.][\w.@#$]*::?(?=[ \t]|$)")
+
+def split_instruction(line, record):
+    """
+    Split the code of a line into its label (with the whitespace after it), mnemonic and operands.
+    Returns None if the code is not an instruction
+    """
+    
+    if not record.codeEnd or record.kind is CommentGroup:
+        return None
+    
+    match = instructionPattern.match(line, record.indentEnd, record.codeEnd)
+    
+    if match is None or match.group(2).lower() not in MNEMONICS:
+        return None
+    
+    return match.groups()
+
+def split_operands(operands):
+    """
+    Split operands on the commas between them, ignoring commas in string and character literals
+    """
+    
+    pieces = []
+    start = 0
+    pos = 0
+    
+    while pos < len(operands):
+        
+        char = operands[pos]
+        
+        if char in '"\'':
+            closeIdx = find_closing_quote(operands, pos)
+            pos = len(operands) if closeIdx == -1 else closeIdx + 1
+            continue
+        
+        if char == ',':
+            pieces.append(operands[start:pos])
+            start = pos + 1
+        
+        pos += 1
+    
+    pieces.append(operands[start:])
+    
+    return pieces
+
+@register_rule
+class MnemonicCaseRule(FormatRule):
+    """
+    Write every instruction mnemonic in lower case, or upper case
+    """
+    
+    name = 'mnemonic_case'
+    kinds = (CodeGroup, None)
+    
+    def __init__(self, upper=False):
+        self.upper = upper
+    
+    def signature(self):
+        return self.name + ('=upper' if self.upper else '')
+    
+    def format_line(self, line, record):
+        
+        parts = split_instruction(line, record)
+        
+        if parts is None:
+            return line
+        
+        label, mnemonic, operands = parts
+        mnemonic = mnemonic.upper() if self.upper else mnemonic.lower()
+        
+        return line[:record.indentEnd] + label + mnemonic + operands + line[record.codeEnd:]
+
+@register_rule
+class OperandSpacingRule(FormatRule):
+    """
+    Separate an instruction's mnemonic from its operands with one space, and its operands from each other with a comma and one space
+    """
+    
+    name = 'operand_spacing'
+    kinds = (CodeGroup, None)
+    
+    def format_line(self, line, record):
+        
+        parts = split_instruction(line, record)
+        
+        if parts is None or not parts[2].strip():
+            return line
+        
+        label, mnemonic, operands = parts
+        operands = ', '.join(operand.strip(' \t') for operand in split_operands(operands)).rstrip(' ')
+        
+        return line[:record.indentEnd] + label + mnemonic + ' ' + operands + line[record.codeEnd:]
+
+@register_rule
+class LabelAlignmentRule(FormatRule):
+    """
+    Move lines that start with a label to the first column
+    """
+    
+    name = 'label_alignment'
+    kinds = (CodeGroup, None)
+    
+    def format_line(self, line, record):
+        
+        if record.indentEnd and record.codeEnd and labelPattern.match(line, record.indentEnd, record.codeEnd):
+            return line[record.indentEnd:]
+        
+        return line
+
+#The registers and conditions an operand can name, as they are written in the instruction table. C is both
+REGISTERS = frozenset(['A', 'B', 'C', 'D', 'E', 'H', 'L', 'AF', 'BC', 'DE', 'HL', 'SP'])
+CONDITIONS = frozenset(['Z', 'NZ', 'C', 'NC'])
+
+#Other ways rgbds lets the inside of a memory operand be written, and the names they have in the table
+MEMORY_ALIASES = {'HLI': 'HL+', 'HLD': 'HL-', '$FF00+C': 'C'}
+
+#The instructions that also take their A, r forms as just r
+ALU_MNEMONICS = ('ADD', 'ADC', 'SUB', 'SBC', 'AND', 'XOR', 'OR', 'CP')
+
+#A snapshot of gbdb's instruction table, written by gbdb/ExportOpcodes.py
+OPCODES_SNAPSHOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sm83_opcodes.json')
+
+class InstructionIndex:
+    """
+    Every operand shape each instruction takes, keyed by mnemonic, built from a snapshot of gbdb's instruction table
+    so that checking a line is a dict lookup and a set lookup, and nothing ever connects to the DB.
+    
+    The shape of an operand is the register or condition it names, or n for any number, label or expression, in []
+    when it is a memory operand, so ld a, [wCount] is LD with the shape ('A', '[n]'). SP plus an offset is SP+n.
+    """
+    
+    #Indexes that have been loaded, by snapshot path. Each process loads a snapshot once
+    loaded = {}
+    
+    def __init__(self, rows, digest=None):
+        
+        #A hash of the snapshot, so cache keys change when the table does
+        self.digest = digest
+        
+        operations = {}
+        
+        for code, mnemonic, name, order, immediate, action in rows:
+            
+            #The CB prefix and the unused opcodes aren't instructions that can be written
+            if mnemonic == 'PREFIX' or mnemonic.startswith('ILLEGAL'):
+                continue
+            
+            operands = operations.setdefault((code, mnemonic), [])
+            
+            if name is None:
+                continue
+            
+            shape = name if name in REGISTERS or name in CONDITIONS else 'n'
+            shape += action or ''
+            operands.append((order, shape if immediate else f"[{shape}]"))
+        
+        self.shapes = {}
+        
+        for (code, mnemonic), operands in operations.items():
+            
+            shape = [name for order, name in sorted(operands)]
+            
+            #LD HL, SP + e8 has the offset as an operand of its own in the table
+            if 'SP+' in shape:
+                idx = shape.index('SP+')
+                shape[idx:idx + 2] = ['SP+n']
+            
+            self.shapes.setdefault(mnemonic, set()).add(tuple(shape))
+        
+        self.add_aliases()
+    
+    def add_aliases(self):
+        """
+        Add the other ways rgbds lets instructions be written
+        """
+        
+        for mnemonic in ALU_MNEMONICS:
+            self.shapes[mnemonic] |= {shape[1:] for shape in self.shapes[mnemonic] if len(shape) == 2 and shape[0] == 'A'}
+        
+        for mnemonic, operand in (('LDI', '[HL+]'), ('LDD', '[HL-]')):
+            self.shapes[mnemonic] = {tuple('[HL]' if name == operand else name for name in shape) for shape in self.shapes['LD'] if operand in shape}
+        
+        self.shapes['LD'] |= {shape for shape in self.shapes['LDH'] if '[C]' in shape}
+        self.shapes['JP'].add(('[HL]',))
+        self.shapes['STOP'].add(())
+    
+    @classmethod
+    def load(cls, path=OPCODES_SNAPSHOT):
+        """
+        The index for a snapshot, which is only read and built the first time it is asked for
+        """
+        
+        if path not in cls.loaded:
+            import hashlib
+            
+            with open(path, 'rb') as f:
+                data = f.read()
+            
+            snapshot = json.loads(data)
+            columns = snapshot['columns']
+            order = [columns.index(column) for column in ('code', 'mnemonic', 'operand_name', 'op_order', 'op_immediate', 'operand_action_symbol')]
+            rows = ([row[i] for i in order] for row in snapshot['rows'])
+            
+            cls.loaded[path] = cls(rows, hashlib.sha256(data).hexdigest()[:16])
+        
+        return cls.loaded[path]
+    
+    def check(self, mnemonic, shape):
+        """
+        Return a message if no form of the instruction takes operands of this shape, otherwise None
+        """
+        
+        shapes = self.shapes.get(mnemonic.upper())
+        
+        if shapes is None or shape in shapes:
+            return None
+        
+        return f"{mnemonic} does not take {', '.join(shape) if shape else 'no operands'}"
+
+def operand_shape(operand):
+    """
+    The shape of an operand as it is written in source, see InstructionIndex. Returns None for operands whose
+    shape isn't known until they are assembled, such as macro arguments and interpolated symbols
+    """
+    
+    operand = operand.strip(' \t').upper()
+    
+    if '\\' in operand or '{' in operand:
+        return None
+    
+    if operand.startswith('[') and operand.endswith(']'):
+        inner = ''.join(operand[1:-1].split())
+        inner = MEMORY_ALIASES.get(inner, inner)
+        
+        return f"[{inner}]" if inner in REGISTERS or inner in ('HL+', 'HL-') else '[n]'
+    
+    if operand in REGISTERS or operand in CONDITIONS:
+        return operand
+    
+    if ''.join(operand.split())[:3] in ('SP+', 'SP-'):
+        return 'SP+n'
+    
+    return 'n'
+
+@register_rule
+class OpcodeLintRule(FormatRule):
+    """
+    Report instructions whose operands don't fit any form the instruction has in the SM83 instruction table.
+    Only checks lines, never changes them
+    """
+    
+    name = 'opcode_lint'
+    kinds = (CodeGroup, None)
+    lints = True
+    
+    def __init__(self, snapshot=OPCODES_SNAPSHOT):
+        self.snapshot = snapshot
+    
+    def signature(self):
+        return f"{self.name}={InstructionIndex.load(self.snapshot).digest}"
+    
+    def check_line(self, line, record):
+        
+        parts = split_instruction(line, record)
+        
+        if parts is None:
+            return ()
+        
+        label, mnemonic, operands = parts
+        shape = []
+        
+        for operand in split_operands(operands) if operands.strip(' \t') else ():
+            
+            operandShape = operand_shape(operand)
+            
+            if operandShape is None:
+                return ()
+            
+            if not operand.strip(' \t'):
+                return (f"{mnemonic} is missing an operand",)
+            
+            shape.append(operandShape)
+        
+        message = InstructionIndex.load(self.snapshot).check(mnemonic, tuple(shape))
+        
+        return () if message is None else (message,)
+
+#The directives that define symbols, matched at the start of the code of a line
+symbolPattern = re.compile(r"""
+    SECTION(?:[ \t]+(?:UNION|FRAGMENT))?[ \t]+"(?P<section>[^"]*)"
+  | INCLUDE[ \t]+"(?P<include>[^"]*)"
+  | (?:(?:RE)?DEF[ \t]+)?(?P<constant>[A-Za-z_][\w@#$]*)(?:[ \t]+(?:EQUS?|SET|RB|RW|RL)(?![\w@#$])|[ \t]*=(?!=))
+""", re.IGNORECASE | re.VERBOSE)
+
+class SymbolRule(FormatRule):
+    """
+    Collect the symbols each line defines into FileState.symbols, for a SymbolIndex. Never changes a line.
+    The formatter runs it after every other line rule when it is given a SymbolIndex, so it isn't enabled by name
+    """
+    
+    name = 'symbols'
+    kinds = (CodeGroup, None)
+    collects = True
+    
+    def collect_line(self, line, record, state):
+        
+        if not record.codeEnd:
+            return
+        
+        start = record.indentEnd
+        label = labelPattern.match(line, start, record.codeEnd)
+        
+        if label is not None:
+            name = label.group().rstrip(':')
+            state.symbols.append((name, state.lineNumber, 'local' if name.startswith('.') else 'label'))
+            
+            #A label can be followed by code on the same line
+            start = label.end()
+            start += len(line[start:record.codeEnd]) - len(line[start:record.codeEnd].lstrip(' \t'))
+        
+        match = symbolPattern.match(line, start, record.codeEnd)
+        
+        if match is not None:
+            kind = match.lastgroup
+            state.symbols.append((match.group(kind), state.lineNumber, kind))
+
+class AsmFormatter:
+    
+    def __init__(self, files, outputs=None, globalIndent = False, jobs = 1, cache = None, check = False, diff = False, lineRanges = None, stats = False, encoding = 'utf-8', bytesMode = True, fsync = 'none', projectIndent = False, rules = None, chunkSize = None, symbols = None):
+        self.input = files
+        self.output = outputs
+        
+        #With projectIndent, the global indent is the same for every input rather than found for each file
+        self.globalIndent = globalIndent or projectIndent
+        self.projectIndent = projectIndent
+        self.jobs = jobs
+        
+        #The project wide global indent, found at the start of each run when projectIndent is on, and the width of each file
+        self.projectLineLen = None
+        self.projectWidths = {}
+        
+        #In check and diff mode files are only formatted in memory, and nothing is ever written
+        self.check = check
+        self.diff = diff
+        
+        #When set, a dict of file paths to lists of (first, last) line numbers, counting from 1. Only the groups that touch
+        #those lines are formatted, and files that are not in the dict are left alone
+        self.lineRanges = None
+        if lineRanges is not None:
+            self.lineRanges = {self.normalise_path(path): ranges for path, ranges in lineRanges.items()}
+        
+        #A FormatCache. Only used when formatting in place, and only ever touched by this process, never by the workers
+        self.cache = cache
+        
+        #Collect a FileStats for every file formatted
+        self.stats = stats
+        
+        #The encoding of the input and output files
+        self.encoding = encoding
+        
+        #Format files in place or to an output file with the bytes engine when they allow it, see format_asm_bytes
+        self.bytesMode = bytesMode and is_ascii_compatible(encoding)
+        
+        #Replaces inputs with their formatted versions, see WriteBack for the fsync policies
+        self.writeBack = WriteBack(fsync)
+        
+        #With more than one job, files formatted to an output or in place that are bigger than this many bytes are split into
+        #chunks of about this size, which are formatted in parallel. See _submit_chunks
+        self.chunkSize = chunkSize
+        
+        #A SymbolIndex, updated with the symbols of every file formatted in place. Like the cache, it is only ever touched by this process
+        self.symbolIndex = symbols
+        self.indexSymbols = symbols is not None
+        
+        #The FormatRules to run, given by name or as rule objects. None runs DEFAULT_RULES
+        self.set_rules(DEFAULT_RULES if rules is None else rules)
+    
+    def set_rules(self, rules):
+        """
+        Enable the given rules, and only those. Line rules run in the order they are given
+        """
+        
+        self.rules = []
+        self.lineRules = []
+        self.groupRules = {}
+        
+        for rule in rules:
+            
+            if isinstance(rule, str):
+                if rule not in RULES:
+                    raise ValueError(f"unknown rule {rule}, expected one of {', '.join(RULES)}")
+                rule = RULES[rule]()
+            
+            self.rules.append(rule)
+            
+            if rule.perLine:
+                self.lineRules.append(rule)
+                continue
+            
+            for kind in rule.kinds:
+                if kind in self.groupRules:
+                    raise ValueError(f"rules {self.groupRules[kind].name} and {rule.name} both rewrite {kind.__name__}s")
+                self.groupRules[kind] = rule
+        
+        #Symbols are collected last, from the lines as the other rules left them
+        if self.indexSymbols:
+            self.lineRules.append(SymbolRule())
+
+    def __getstate__(self):
+        
+        #Worker processes only need the settings, not the inputs (which may be a generator) or the cache
+        state = self.__dict__.copy()
+        state['input'] = None
+        state['output'] = None
+        state['cache'] = None
+        state['symbolIndex'] = None
+        state['projectWidths'] = {}
+        
+        return state
+    
+    def copy(self):
+        """
+        A shallow copy of this formatter, with the same settings, rules and cache. Unlike pickling it keeps everything
+        """
+        
+        formatter = type(self).__new__(type(self))
+        formatter.__dict__.update(self.__dict__)
+        
+        return formatter
+    
+    def format_files(self):
+        """
+        Format every input file, and return a FormatResult for each one in the same order as the inputs.
+        See iter_format_files
+        """
+        
+        return list(self.iter_format_files())
+    
+    def iter_format_files(self):
+        """
+        Format every input file, yielding a FormatResult for each one in the same order as the inputs.
+        
+        The inputs are only read as they are needed, so they can be a generator like discover_files, and
+        formatting starts with the first file rather than once every path is known.
+        
+        With more than one job, files are handed to a pool of processes in small batches. Only a couple of
+        batches per worker are queued at a time, and a result is yielded once every file before it is done.
+        Files bigger than chunkSize are split and formatted by the whole pool instead, see _submit_chunks.
+        A file that fails to format does not stop the others; its error is recorded in its result instead.
+        
+        When formatting in place with a cache, files whose contents the cache already knows to be formatted
+        are skipped, and files that come out unchanged are added to it.
+        
+        With projectIndent, every input has to be scanned before any can be formatted, so the inputs are all
+        gathered first. See find_project_line_len
+        """
+        
+        if self.projectIndent or self.output:
+            self.input = list(self.input)
+        
+        #Each input needs an output of its own, and zip would quietly drop whichever files are left over
+        if self.output and len(self.output) != len(self.input):
+            raise ValueError(f"{len(self.input)} input files, but {len(self.output)} output files")
+        
+        outputs = self.output if self.output else repeat(None)
+        pairs = zip(self.input, outputs)
+        
+        if self.jobs == 1:
+            if self.projectIndent:
+                self.projectLineLen = self.find_project_line_len(self.input, map)
+            
+            while True:
+                batch = list(islice(pairs, BATCH_SIZE))
+                
+                if not batch:
+                    break
+                
+                entries, pending = self._check_batch(batch)
+                yield from self._collect_batch(entries, self._format_batch(pending))
+            
+            return
+        
+        #A jobs value of 0 means use every core
+        workers = self.jobs if self.jobs > 0 else os.cpu_count()
+        inFlight = deque()
+        
+        from concurrent.futures import ProcessPoolExecutor
+        
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            
+            if self.projectIndent:
+                self.projectLineLen = self.find_project_line_len(self.input, lambda scan, files: pool.map(scan, files, chunksize=BATCH_SIZE))
+            
+            while True:
+                batch = list(islice(pairs, BATCH_SIZE))
+                
+                if not batch:
+                    break
+                
+                entries, pending = self._check_batch(batch)
+                collect = self._submit_batch(pool, pending) if pending else None
+                inFlight.append((entries, collect))
+                
+                #Wait on the oldest batch once enough work is queued, so that a long walk doesn't queue every file at once
+                if len(inFlight) >= workers * 2:
+                    entries, collect = inFlight.popleft()
+                    yield from self._collect_batch(entries, collect() if collect else [])
+            
+            while inFlight:
+                entries, collect = inFlight.popleft()
+                yield from self._collect_batch(entries, collect() if collect else [])
+    
+    def find_project_line_len(self, files, mapper):
+        """
+        Find the global indent shared by every file, as a map-reduce: the map finds the code width of each file
+        with _find_features, and the reduce takes the widest. mapper is map, or the map of a process pool.
+        
+        With a cache, the width of contents that were scanned before is looked up instead, so only new or changed
+        files are scanned. As the cache's keys for formatted files include the project indent, files are only
+        formatted again when a change moves the indent. Files that can't be read are left for formatting to report.
+        """
+        
+        self.projectLineLen = None
+        self.projectWidths = {}
+        keys = {}
+        
+        for inputFile in files:
+            
+            if self.cache is None:
+                keys[inputFile] = None
+                continue
+            
+            try:
+                key = self.scan_key(inputFile)
+            
+            except OSError:
+                continue
+            
+            width = self.cache.width(key)
+            
+            if width is None:
+                keys[inputFile] = key
+            else:
+                self.projectWidths[inputFile] = width
+        
+        for inputFile, width in zip(keys, mapper(self._scan_file, list(keys))):
+            
+            if width is None:
+                continue
+            
+            self.projectWidths[inputFile] = width
+            
+            if keys[inputFile] is not None:
+                self.cache.set_width(keys[inputFile], width)
+        
+        #A project without any readable files still gets the indent of an empty file
+        return max(self.projectWidths.values(), default=1)
+    
+    def scan_key(self, inputFile):
+        """
+        The cache key for the scanned width of a file
+        """
+        
+        return self.cache.key(inputFile, f"{FORMATTER_VERSION}:scan:encoding={self.encoding}")
+    
+    def _scan_file(self, inputFile):
+        """
+        The map step of find_project_line_len. Returns the code width of one file, or None if it can't be read
+        """
+        
+        try:
+            with open(inputFile, 'r', encoding=self.encoding) as f:
+                return self._find_features(f)
+        
+        except (OSError, UnicodeError):
+            return None
+    
+    def _check_batch(self, batch):
+        """
+        Look a batch of (input, output) pairs up in the cache. Returns the (key, result) cache entry of each pair,
+        and the pairs that still need formatting
+        """
+        
+        entries = []
+        pending = []
+        
+        for inputFile, output in batch:
+            key, result = self._check_cache(inputFile)
+            entries.append((key, result))
+            
+            if result is None:
+                pending.append((inputFile, output))
+        
+        return (entries, pending)
+    
+    def _format_batch(self, pairs):
+        """
+        Format a batch of (input, output) pairs, in this process or a worker. The inputs that changed are all
+        replaced together once the batch is formatted, see WriteBack
+        """
+        
+        with self.writeBack.batch() as errors:
+            results = [self._format_file(inputFile, output) for inputFile, output in pairs]
+        
+        for result in results:
+            if result.inputFile in errors:
+                result.error = errors[result.inputFile]
+                result.changed = None
+                result.symbols = None
+            
+            elif result.symbols is not None:
+                #Only now that the batch is replaced is the input what its symbols describe
+                try:
+                    result.fingerprint = file_fingerprint(result.inputFile)
+                except OSError:
+                    result.symbols = None
+        
+        return results
+    
+    def _submit_batch(self, pool, pending):
+        """
+        Start formatting a batch of (input, output) pairs on the pool, and return a function that waits for the batch
+        and returns its results. Files bigger than chunkSize are split into chunks that are each a task of their own
+        """
+        
+        huge = [self.chunkSize is not None and self._is_huge(inputFile) for inputFile, output in pending]
+        small = [pair for pair, isHuge in zip(pending, huge) if not isHuge]
+        future = pool.submit(self._format_batch, small) if small else None
+        chunked = [self._submit_chunks(pool, inputFile, output) if isHuge else None for (inputFile, output), isHuge in zip(pending, huge)]
+        
+        def collect():
+            results = iter(future.result() if future else [])
+            return [next(results) if finish is None else finish() for finish in chunked]
+        
+        return collect
+    
+    def _is_huge(self, inputFile):
+        
+        if self.check or self.diff or self.lineRanges is not None:
+            return False
+        
+        try:
+            return os.path.getsize(inputFile) > self.chunkSize
+        except OSError:
+            return False
+    
+    def _submit_chunks(self, pool, inputFile, output):
+        """
+        Split one file into chunks of about chunkSize bytes, and start formatting them on the pool. Returns a function
+        that waits for the chunks, writes them out in order and returns the FormatResult of the file.
+        
+        Groups only depend on their own lines, so a file can be cut anywhere one group ends and the next begins,
+        and each chunk formatted on its own gives exactly the bytes the whole file would have. The global indent is
+        the one thing that depends on every line; it is found first as a parallel reduction, the widest code of any chunk.
+        
+        Chunks are cut at line ends found in the bytes of the file, so files in an encoding that is not a superset of
+        ASCII, or with carriage returns (which text mode would turn into newlines) are formatted whole by one worker.
+        """
+        
+        try:
+            spans = self._chunk_spans(inputFile)
+        
+        except (OSError, UnicodeError) as e:
+            error = FormatResult(inputFile, output, e)
+            return lambda: error
+        
+        if spans is None:
+            future = pool.submit(self._format_batch, [(inputFile, output)])
+            return lambda: future.result()[0]
+        
+        globalLineLen = self.projectLineLen or 0
+        
+        if self.globalIndent and self.projectLineLen is None:
+            globalLineLen = max(pool.map(self._scan_chunk, repeat(inputFile), *zip(*spans)))
+        
+        futures = [pool.submit(self._format_chunk, inputFile, start, end, globalLineLen) for start, end in spans]
+        
+        def finish():
+            try:
+                return self._write_chunks(inputFile, output, futures)
+            except (OSError, UnicodeError) as e:
+                return FormatResult(inputFile, output, e)
+        
+        return finish
+    
+    def _chunk_spans(self, inputFile):
+        """
+        Find where to cut a file into chunks of at least chunkSize bytes, as a list of [start, end) byte offsets.
+        Each cut is at the first line that starts a new group within a short window from a multiple of chunkSize bytes on.
+        Where no group ends in the window, the chunk runs on to the next one, and once 2 * chunkSize bytes have been searched
+        since the last cut without finding another the rest of the file is one chunk. Returns None if the file can't be cut
+        """
+        
+        if not is_ascii_compatible(self.encoding) or os.linesep != '\n':
+            return None
+        
+        import mmap
+        
+        with open(inputFile, 'rb') as f:
+            
+            try:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                return None
+            
+            with buffer:
+                
+                if buffer.find(b'\r') != -1:
+                    return None
+                
+                #Lines are lexed as bytes when they can be, as the bytes engine would, and only decoded for the line rules
+                if not self.lineRules and is_bytes_safe(buffer):
+                    record = lambda start, end: lex_line(buffer[start:end], BYTES_CHARS)
+                else:
+                    record = lambda start, end: self._apply_line_rules(lex_line(buffer[start:end].decode(self.encoding)), STR_CHARS)
+                
+                size = len(buffer)
+                window = max(self.chunkSize // 4, 1)
+                budget = 2 * self.chunkSize
+                spans = []
+                pos = 0
+                target = self.chunkSize
+                
+                while target < size and budget > 0:
+                    
+                    #The line the target falls in
+                    lineStart = max(buffer.rfind(b'\n', 0, target) + 1, pos)
+                    lineEnd = buffer.find(b'\n', lineStart) + 1 or size
+                    prev = record(lineStart, lineEnd)
+                    searchEnd = min(target + window, size)
+                    cut = None
+                    
+                    #Move down a line at a time until one starts a new group
+                    while lineEnd < searchEnd:
+                        nextEnd = buffer.find(b'\n', lineEnd) + 1 or size
+                        current = record(lineEnd, nextEnd)
+                        
+                        if not continues_group(prev, current):
+                            cut = lineEnd
+                            break
+                        
+                        prev = current
+                        lineEnd = nextEnd
+                    
+                    if cut is None:
+                        budget -= lineEnd - lineStart
+                        target += self.chunkSize
+                        continue
+                    
+                    spans.append((pos, cut))
+                    budget = 2 * self.chunkSize
+                    pos = cut
+                    target = cut + self.chunkSize
+                
+                if pos < size:
+                    spans.append((pos, size))
+        
+        #A file that couldn't be cut is formatted whole, by the bytes engine when it allows
+        return spans if len(spans) > 1 else None
+    
+    def _read_chunk(self, inputFile, start, end):
+        """
+        Read bytes start to end of a file, as ASCII bytes for the bytes engine when they allow it and as text otherwise
+        """
+        
+        with open(inputFile, 'rb') as f:
+            f.seek(start)
+            chunk = f.read(end - start)
+        
+        if self.bytesMode and is_bytes_safe(chunk):
+            return chunk
+        
+        return chunk.decode(self.encoding)
+    
+    def _scan_chunk(self, inputFile, start, end):
+        """
+        The map step of the global indent of a chunked file. Returns the code width of one chunk
+        """
+        
+        chunk = self._read_chunk(inputFile, start, end)
+        
+        if isinstance(chunk, bytes):
+            return self._find_features(chunk.splitlines(True), BYTES_CHARS)
+        
+        return self._find_features(io.StringIO(chunk), STR_CHARS)
+    
+    def _format_chunk(self, inputFile, start, end, globalLineLen):
+        """
+        Format bytes start to end of a file in a worker, and return the formatted bytes, the number of lines changed, the FileStats,
+        the problems found with the number of lines they are counted from, and the symbols found
+        """
+        
+        chunk = self._read_chunk(inputFile, start, end)
+        atEnd = end >= os.path.getsize(inputFile)
+        state = self.new_state(inputFile, None)
+        state.globalLineLen = globalLineLen
+        
+        if isinstance(chunk, bytes):
+            o = io.BytesIO()
+            lines = io.BytesIO(chunk) if self.lineRules else iter_line_runs(chunk)
+            self._format_lines(lines, o, state, chars=BYTES_CHARS, atEnd=atEnd)
+            return (o.getvalue(), state.linesChanged, state.stats, state.problems, state.lineNumber, state.symbols)
+        
+        o = io.StringIO()
+        self._format_lines(io.StringIO(chunk), o, state, atEnd=atEnd)
+        return (o.getvalue().encode(self.encoding), state.linesChanged, state.stats, state.problems, state.lineNumber, state.symbols)
+    
+    def _write_chunks(self, inputFile, output, futures):
+        """
+        Write the formatted chunks of a file in order, to the output or over the input if any of them changed
+        """
+        
+        start = time.perf_counter()
+        
+        if output:
+            outputFile = output
+        else:
+            tmpFilePackage = tempfile.mkstemp(dir=os.path.abspath(os.path.dirname(inputFile)))
+            outputFile = tmpFilePackage[1]
+        
+        linesChanged = 0
+        bytesWritten = 0
+        stats = FileStats() if self.stats else None
+        problems = []
+        lineNumber = 0
+        symbols = [] if self.indexSymbols and not output else None
+        outputLine = 0
+        waitTime = 0.0
+        
+        try:
+            with open(outputFile, 'wb') as o:
+                for future in futures:
+                    
+                    waitStart = time.perf_counter()
+                    data, chunkChanged, chunkStats, chunkProblems, chunkLines, chunkSymbols = future.result()
+                    waitTime += time.perf_counter() - waitStart
+                    
+                    o.write(data)
+                    linesChanged += chunkChanged
+                    bytesWritten += len(data)
+                    
+                    #Each chunk counts its lines from its own start
+                    problems.extend((lineNumber + chunkLine, message) for chunkLine, message in chunkProblems)
+                    lineNumber += chunkLines
+                    
+                    #Symbols are numbered by the lines that were written, and every chunk but the last ends with a newline
+                    if symbols is not None:
+                        symbols.extend((name, outputLine + line, kind) for name, line, kind in chunkSymbols)
+                        outputLine += data.count(b'\n')
+                    
+                    if stats is not None:
+                        stats.merge(chunkStats)
+        
+        except:
+            if not output:
+                self.remove_tempfile(tmpFilePackage)
+            raise
+        
+        replaceStart = time.perf_counter()
+        
+        if not output:
+            if linesChanged:
+                self.rename_and_remove_tempfile(tmpFilePackage, inputFile)
+            else:
+                self.remove_tempfile(tmpFilePackage)
+        
+        if stats is not None:
+            #The chunks' own phases ran in parallel, this is the time the stitching took on top of waiting for them
+            stats.files = 1
+            stats.add_time('stitch', replaceStart - start - waitTime)
+            stats.add_time('replace', time.perf_counter() - replaceStart)
+            stats.bytesRead = os.path.getsize(inputFile)
+            stats.bytesWritten = bytesWritten
+            stats.rewritten = bool(output or linesChanged)
+        
+        fingerprint = file_fingerprint(inputFile) if symbols is not None else None
+        
+        return FormatResult(inputFile, output, changed=linesChanged > 0, stats=stats, problems=problems, symbols=symbols, fingerprint=fingerprint)
+    
+    def _collect_batch(self, entries, formatted):
+        """
+        Yield the results of a batch in input order, merged with the files the cache skipped
+        """
+        
+        formatted = iter(formatted)
+        
+        for key, result in entries:
+            
+            if result is None:
+                result = next(formatted)
+                self._update_cache(key, result)
+                self._update_symbols(result)
+            
+            yield result
+    
+    def _check_cache(self, inputFile):
+        """
+        Look a file up in the cache. Returns its cache key, and a skipped result if it is known to be formatted.
+        The key is None when the cache is not in use
+        """
+        
+        if self.cache is None or self.output or self.lineRanges is not None:
+            return (None, None)
+        
+        try:
+            key = self.cache.key(inputFile, self.options_signature())
+        
+        except OSError:
+            #Let the formatter report the error against the file
+            return (None, None)
+        
+        #A file whose symbols are out of date is formatted anyway, as that is how they are found
+        if (self.symbolIndex is None or self.symbolIndex.is_current(inputFile)) and self.cache.is_formatted(key):
+            return (key, FormatResult(inputFile, None, changed=False, skipped=True))
+        
+        return (key, None)
+    
+    def _update_cache(self, key, result):
+        
+        if key is not None and result.changed is False and not result.problems:
+            self.cache.mark_formatted(key)
+        
+        #Formatting never changes the width of code, so the width of a file that was just rewritten is already known
+        if key is not None and result.changed and result.inputFile in self.projectWidths and not (self.check or self.diff):
+            try:
+                self.cache.set_width(self.scan_key(result.inputFile), self.projectWidths[result.inputFile])
+            except OSError:
+                pass
+    
+    def _update_symbols(self, result):
+        
+        if self.symbolIndex is not None and result.symbols is not None and result.fingerprint is not None:
+            self.symbolIndex.update(result.inputFile, result.fingerprint, result.symbols)
+    
+    def options_signature(self):
+        """
+        The formatter settings that affect its output, as a string that cache keys are built from
+        """
+        
+        signature = f"{FORMATTER_VERSION}:globalIndent={int(self.globalIndent)}:encoding={self.encoding}"
+        signature += ":rules=" + ",".join(rule.signature() for rule in self.rules)
+        
+        if self.projectLineLen is not None:
+            signature += f":projectLineLen={self.projectLineLen}"
+        
+        return signature
+    
+    def _format_file(self, inputFile, output):
+        """
+        Format one file, catching any error so that it can be reported against that file
+        """
+        
+        diff = None
+        ranges = None
+        
+        if self.lineRanges is not None:
+            ranges = self.lineRanges.get(self.normalise_path(inputFile))
+            
+            if ranges is None:
+                return FormatResult(inputFile, output, changed=False)
+        
+        try:
+            if self.check or self.diff or ranges is not None:
+                state, original, formatted = self.format_asm_in_memory(inputFile, ranges)
+                
+                if self.diff and state.linesChanged:
+                    diff = self.make_diff(original, formatted, inputFile)
+                
+                if not self.check and not self.diff:
+                    self.write_formatted(inputFile, output, formatted, state)
+            
+            else:
+                state = self.format_asm(inputFile, output)
+            
+        except (OSError, UnicodeError) as e:
+            return FormatResult(inputFile, output, e)
+        
+        #Symbols are only kept when the input is left as they describe it: formatted in place, or unchanged
+        symbols = None
+        if state.symbols is not None and output is None and ranges is None and not (state.linesChanged and (self.check or self.diff)):
+            symbols = state.symbols
+        
+        return FormatResult(inputFile, output, changed=state.linesChanged > 0, diff=diff, stats=state.stats, problems=state.problems, symbols=symbols)
+        
+    def format_asm(self, inputFile, output):
+        """
+        Format an asm file to comply with the following standards
+        
+        1) if a comment is preceeded by code, that comment must be indented to the local or global comment level
+        2) If the comment is not proceeded by code, it must be surrounded like so
+    
+        ;-------------------;
+        ; This is a comment ;
+        ; nice, huh?        ;
+        ;-------------------;
+        
+        2.1) Must start with a ;-...-;
+        2.2) lines with text must start and end with a ;
+        2.3) must end with a ;-...-;
+        2.4) Whitespace before the leading semicolon, and after the semicolon but preceeding any text is preserved as is
+        
+        The input is streamed: it is read once, and only the group currently being built is held in memory.
+        Each group is written out as soon as the first line that does not belong to it is seen. The one exception
+        is the global indent, which depends on every line in the file, so a width scan is made first when it is enabled.
+        
+        When formatting in place, the input is only replaced if formatting changed it, so unchanged files keep their mtime.
+        
+        Returns the FileState used for the file.
+        """
+        
+        if output:
+            outputFile = output
+            
+        else:
+            inputPath = os.path.abspath(os.path.dirname(inputFile))            
+            tmpFilePackage = tempfile.mkstemp(dir=inputPath)
+            outputFile = tmpFilePackage[1]         
+
+        state = self.new_state(inputFile, outputFile)
+        
+        try:
+            self._format_stream(state)
+        
+        except:
+            #Don't leave a half written temp file next to the input
+            if not output:
+                self.remove_tempfile(tmpFilePackage)
+            raise
+        
+        start = time.perf_counter()
+        
+        if not output:
+            if state.linesChanged:
+                self.rename_and_remove_tempfile(tmpFilePackage, inputFile)
+            
+            else:
+                self.remove_tempfile(tmpFilePackage)
+        
+        if state.stats is not None:
+            state.stats.add_time('replace', time.perf_counter() - start)
+            state.stats.rewritten = bool(output or state.linesChanged)
+            
+        return state
+    
+    def new_state(self, inputFile, outputFile):
+        """
+        Make the FileState for formatting one file, with a FileStats when stats are being collected
+        """
+        
+        state = FileState(inputFile, outputFile)
+        state.globalLineLen = self.projectLineLen or 0
+        
+        if self.stats:
+            state.stats = FileStats()
+        
+        if self.indexSymbols:
+            state.symbols = []
+        
+        return state
+    
+    def format_asm_in_memory(self, inputFile, ranges=None):
+        """
+        Format an asm file without writing anything. Returns the FileState, the original text and the formatted text
+        """
+        
+        start = time.perf_counter()
+        
+        with open(inputFile, 'r', encoding=self.encoding) as f:
+            original = f.read()
+            size = os.fstat(f.fileno()).st_size
+        
+        readTime = time.perf_counter() - start
+        
+        state, formatted = self.format_text(original, ranges)
+        state.inputFile = inputFile
+        
+        if state.stats is not None:
+            state.stats.add_time('read', readTime)
+            state.stats.bytesRead += size
+        
+        return (state, original, formatted)
+    
+    def write_formatted(self, inputFile, output, text, state):
+        """
+        Write text that was formatted in memory to the output, or over the input if it changed
+        """
+        
+        stats = state.stats
+        start = time.perf_counter()
+        
+        if output:
+            with open(output, 'w', encoding=self.encoding) as o:
+                o.write(text)
+            
+            if stats is not None:
+                stats.add_time('write', time.perf_counter() - start)
+                stats.bytesWritten += os.path.getsize(output)
+                stats.rewritten = True
+            return
+        
+        if not state.linesChanged:
+            return
+        
+        inputPath = os.path.abspath(os.path.dirname(inputFile))
+        tmpFilePackage = tempfile.mkstemp(dir=inputPath)
+        
+        try:
+            with open(tmpFilePackage[1], 'w', encoding=self.encoding) as o:
+                o.write(text)
+        
+        except:
+            self.remove_tempfile(tmpFilePackage)
+            raise
+        
+        if stats is not None:
+            stats.add_time('write', time.perf_counter() - start)
+            stats.bytesWritten += os.path.getsize(tmpFilePackage[1])
+            start = time.perf_counter()
+        
+        self.rename_and_remove_tempfile(tmpFilePackage, inputFile)
+        
+        if stats is not None:
+            stats.add_time('replace', time.perf_counter() - start)
+            stats.rewritten = True
+    
+    def format_text(self, text, ranges=None):
+        """
+        Format asm source held in a string. Returns the FileState and the formatted text.
+        
+        ranges is an optional list of (first, last) line numbers, counting from 1. When it is given only the groups
+        that touch those lines are formatted, and every other line is copied as is.
+        
+        Line endings are read the same way as from a file, so \\r\\n and \\r are treated as \\n
+        """
+        
+        state = self.new_state(None, None)
+        
+        if ranges is not None:
+            return (state, self._format_ranges(io.StringIO(text, newline=None).readlines(), ranges, state))
+        
+        if self.globalIndent and self.projectLineLen is None:
+            state.globalLineLen = self._scan(io.StringIO(text, newline=None), state)
+        
+        o = io.StringIO()
+        self._format_lines(io.StringIO(text, newline=None), o, state)
+        
+        return (state, o.getvalue())
+    
+    def text_edits(self, text, ranges=None):
+        """
+        Format asm source held in a string, and return the FileState and the changes as a list of TextEdits, in order
+        and not overlapping. An editor can apply them to its buffer as they are, see lsp_text_edits, and apply_edits
+        applies them to the text.
+        
+        The edits come straight from the groups: each group is formatted on its own, and its lines are matched up
+        with the lines it was written as, using the number of lines its rule added before and after it (see
+        FormatRule.format_group). Only the characters that differ within a line are replaced, so padding a comment
+        is an insertion of spaces, and a border is an insertion of a line. Nothing is diffed beyond a single line.
+        
+        ranges limits the formatting to the groups that touch them, as for format_text. Line endings are read the same
+        way too, so the edits are made against the text with \r\n and \r read as \n
+        """
+        
+        state = self.new_state(None, None)
+        lines = io.StringIO(text, newline=None).readlines()
+        
+        if self.globalIndent and self.projectLineLen is None:
+            state.globalLineLen = self._scan(lines, state)
+        
+        spans = [(0, len(lines))] if ranges is None else self._expand_ranges(lines, ranges)
+        edits = []
+        
+        for start, end in spans:
+            for edit in self._group_edits(lines, start, end, state):
+                
+                #Edits that meet, such as a newline added to the last line and a border added after it, become one
+                if edits and (edits[-1].endLine, edits[-1].endColumn) == (edit.startLine, edit.startColumn):
+                    edits[-1].endLine = edit.endLine
+                    edits[-1].endColumn = edit.endColumn
+                    edits[-1].text += edit.text
+                else:
+                    edits.append(edit)
+        
+        return (state, edits)
+    
+    def _group_edits(self, lines, start, end, state):
+        """
+        Format lines[start:end], which start and end on group boundaries, and yield the TextEdits for each group
+        """
+        
+        lineIdx = start
+        state.lineNumber = start
+        
+        for group, records in self._get_candidate_groups(self._lex_lines(lines[start:end], STR_CHARS, state), end == len(lines)):
+            
+            rule = self.groupRules.get(type(group))
+            numRows = len(records)
+            
+            if rule is None:
+                #Only the line rules can have changed these lines
+                written = [record.text for record in records]
+                before, after = (0, 0)
+            
+            else:
+                o = io.StringIO()
+                before, after = rule.format_group(self, o, group, records, state) or (0, 0)
+                written = o.getvalue().splitlines(True)
+                
+                #A last line that a line rule emptied is written as nothing at all
+                written.extend([''] * (before + numRows + after - len(written)))
+            
+            if before:
+                yield TextEdit(lineIdx, 0, lineIdx, 0, ''.join(written[:before]))
+            
+            for i in range(numRows):
+                
+                original = lines[lineIdx + i]
+                line = written[before + i]
+                
+                if line != original:
+                    yield line_edit(lineIdx + i, original, line)
+            
+            lineIdx += numRows
+            
+            if after:
+                last = lines[lineIdx - 1]
+                
+                if last.endswith('\n'):
+                    yield TextEdit(lineIdx, 0, lineIdx, 0, ''.join(written[before + numRows:]))
+                else:
+                    yield TextEdit(lineIdx - 1, len(last), lineIdx - 1, len(last), ''.join(written[before + numRows:]))
+    
+    def _format_ranges(self, lines, ranges, state):
+        """
+        Format the groups of a list of lines that touch any of the ranges, and return the whole text.
+        
+        Each range is widened to the boundaries of the groups at its ends, which only means lexing the lines
+        around the range; the rest of the file is never grouped. The exception is the global indent, which still
+        needs every line.
+        """
+        
+        if self.globalIndent and self.projectLineLen is None:
+            state.globalLineLen = self._scan(lines, state)
+        
+        pieces = []
+        prevEnd = 0
+        
+        for start, end in self._expand_ranges(lines, ranges):
+            
+            pieces.extend(lines[prevEnd:start])
+            
+            o = io.StringIO()
+            state.lineNumber = start
+            self._format_lines(lines[start:end], o, state, atEnd=end == len(lines))
+            pieces.append(o.getvalue())
+            
+            prevEnd = end
+        
+        pieces.extend(lines[prevEnd:])
+        
+        return ''.join(pieces)
+    
+    def _expand_ranges(self, lines, ranges):
+        """
+        Turn (first, last) line numbers into sorted, non overlapping [start, end) indexes that begin and end on group boundaries
+        """
+        
+        records = {}
+        
+        def record(i):
+            if i not in records:
+                records[i] = self._apply_line_rules(lex_line(lines[i]), STR_CHARS)
+            return records[i]
+        
+        def continues(i):
+            return continues_group(record(i - 1), record(i))
+        
+        spans = []
+        
+        for first, last in sorted(ranges):
+            
+            start = max(first - 1, 0)
+            end = min(last, len(lines))
+            
+            if start >= end:
+                continue
+            
+            while start > 0 and continues(start):
+                start -= 1
+            
+            while end < len(lines) and continues(end):
+                end += 1
+            
+            if spans and start <= spans[-1][1]:
+                spans[-1] = (spans[-1][0], max(end, spans[-1][1]))
+            else:
+                spans.append((start, end))
+        
+        return spans
+    
+    def normalise_path(self, path):
+        return os.path.normcase(os.path.abspath(path))
+    
+    def make_diff(self, original, formatted, name):
+        """
+        Build a unified diff between two versions of a file, marking a last line that has no newline the same way diff does
+        """
+        
+        import difflib
+        
+        diffLines = []
+        
+        for line in difflib.unified_diff(io.StringIO(original).readlines(), io.StringIO(formatted).readlines(), name, name):
+            diffLines.append(line)
+            
+            if not line.endswith('\n'):
+                diffLines.append('\n\\ No newline at end of file\n')
+        
+        return ''.join(diffLines)
+    
+    def _format_stream(self, state):
+        """
+        Read state.inputFile once, group by group, and write the formatted result to state.outputFile
+        """
+        
+        if not self.format_asm_bytes(state):
+            
+            if self.globalIndent and self.projectLineLen is None:
+                with open(state.inputFile, 'r', encoding=self.encoding) as f:
+                    state.globalLineLen = self._scan(f, state)
+            
+            with open(state.inputFile, 'r', encoding=self.encoding) as f:
+                with open(state.outputFile, 'w', encoding=self.encoding) as o:
+                    self._format_lines(f, o, state)
+        
+        if state.stats is not None:
+            state.stats.bytesRead += os.path.getsize(state.inputFile)
+            state.stats.bytesWritten += os.path.getsize(state.outputFile)
+    
+    def format_asm_bytes(self, state):
+        """
+        The bytes engine. Memory maps state.inputFile and formats it without decoding it, so that lines that
+        don't change are copied from the map to state.outputFile as bytes and never become str. Only the lines that
+        are rewritten are decoded.
+        
+        This only works when columns are byte offsets and the output would be written with the same line endings,
+        so it is limited to ASCII files without carriage returns, in an encoding that is a superset of ASCII,
+        on platforms where text mode writes \\n. It returns False without writing anything for any other file,
+        which is then formatted as text. Checking the file only takes a couple of fast scans of the map.
+        """
+        
+        if not self.bytesMode or os.linesep != '\n':
+            return False
+        
+        import mmap
+        
+        with open(state.inputFile, 'rb') as f:
+            
+            try:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            
+            except (ValueError, OSError):
+                #Empty files can't be mapped, and nor can some special files
+                return False
+            
+            with buffer:
+                
+                if not is_bytes_safe(buffer):
+                    return False
+                
+                if self.globalIndent and self.projectLineLen is None:
+                    state.globalLineLen = self._scan(iter(buffer.readline, b''), state, BYTES_CHARS)
+                    buffer.seek(0)
+                
+                #A run of lines is lexed as one line, so line rules need the lines one by one
+                lines = iter(buffer.readline, b'') if self.lineRules else iter_line_runs(buffer)
+                
+                with open(state.outputFile, 'wb') as o:
+                    self._format_lines(lines, o, state, chars=BYTES_CHARS)
+        
+        return True
+    
+    def _scan(self, lines, state, chars=STR_CHARS):
+        """
+        Find the global indent of the lines, timing it when stats are being collected
+        """
+        
+        if state.stats is None:
+            return self._find_features(lines, chars)
+        
+        with state.stats.timed('scan'):
+            return self._find_features(lines, chars)
+    
+    def _format_lines(self, lines, o, state, chars=STR_CHARS, atEnd=True):
+        """
+        Format an iterable of lines, writing the result to o as each group is completed.
+        The lines are bytes when chars is BYTES_CHARS, and atEnd is False when they stop short of the end of the file.
+        
+        Whether the file ends with a newline is left as it is, apart from the newline a reformatted comment always ends with.
+        Adding one when the file had none, or worse, one more every time it already ended with one, would mean
+        formatting a formatted file could still change it
+        """
+        
+        stats = state.stats
+        
+        if stats is not None:
+            start = time.perf_counter()
+            writeTime = 0.0
+            linesChanged = state.linesChanged
+        
+        groupRules = self.groupRules
+        
+        #When symbols are collected, the places group rules add lines are kept to number the symbols by the lines written
+        collecting = state.symbols is not None
+        if collecting:
+            lineIdx = state.lineNumber
+            firstSymbol = len(state.symbols)
+            shifts = []
+        
+        for group, records in self._get_candidate_groups(self._lex_lines(lines, chars, state), atEnd):
+            
+            rule = groupRules.get(type(group))
+            
+            if stats is not None:
+                stats.count_group(group, records)
+                writeStart = time.perf_counter()
+                ruleChanged = state.linesChanged
+            
+            if rule is None:
+                o.writelines(record.text for record in records)
+            else:
+                added = rule.format_group(self, o, group, records, state)
+                
+                if collecting and added:
+                    shifts.append((lineIdx, added[0]))
+                    shifts.append((lineIdx + len(records), added[1]))
+            
+            if collecting:
+                lineIdx += len(records)
+            
+            if stats is not None:
+                writeTime += time.perf_counter() - writeStart
+                
+                if rule is not None:
+                    stats.add_rule(rule.name, time.perf_counter() - writeStart, state.linesChanged - ruleChanged)
+        
+        if stats is not None:
+            #The lines are lexed, grouped and passed through the line rules by the generator, so everything but the writing is lexing
+            stats.add_time('lex', time.perf_counter() - start - writeTime)
+            stats.add_time('write', writeTime)
+            stats.linesModified += state.linesChanged - linesChanged
+        
+        if collecting and shifts:
+            state.symbols[firstSymbol:] = shift_symbols(state.symbols[firstSymbol:], shifts)
+    
+    def _lex_lines(self, lines, chars=STR_CHARS, state=None):
+        """
+        Lex an iterable of lines into LineRecords, passing each one through the line rules. This is the one pass
+        every rule shares. Lines changed by the rules are added to state.linesChanged when a state is given
+        """
+        
+        if not self.lineRules:
+            return map(lex_line, lines, repeat(chars))
+        
+        return (self._apply_line_rules(lex_line(line, chars), chars, state) for line in lines)
+    
+    def _apply_line_rules(self, record, chars, state=None):
+        """
+        Run the line rules over one LineRecord, lexing the line again after each rule that changes it
+        """
+        
+        stats = state.stats if state is not None else None
+        changed = False
+        
+        if state is not None:
+            state.lineNumber += 1
+        
+        for rule in self.lineRules:
+            
+            if record.kind not in rule.kinds:
+                continue
+            
+            if rule.lints or rule.collects:
+                #Lines are only checked when they are formatted, not when they are scanned
+                if state is not None:
+                    self._check_line(rule, record, state)
+                continue
+            
+            if stats is not None:
+                start = time.perf_counter()
+            
+            line = as_str(record.text)
+            newLine = rule.format_line(line, record)
+            ruleChanged = newLine != line
+            
+            if ruleChanged:
+                record = lex_line(like(newLine, record.text), chars)
+                changed = True
+            
+            if stats is not None:
+                stats.add_rule(rule.name, time.perf_counter() - start, int(ruleChanged))
+        
+        if changed and state is not None:
+            state.linesChanged += 1
+        
+        return record
+    
+    def _check_line(self, rule, record, state):
+        
+        if state.stats is not None:
+            start = time.perf_counter()
+        
+        line = as_str(record.text)
+        
+        if rule.collects:
+            rule.collect_line(line, record, state)
+        else:
+            for message in rule.check_line(line, record):
+                state.problems.append((state.lineNumber, message))
+        
+        if state.stats is not None:
+            state.stats.add_rule(rule.name, time.perf_counter() - start, 0)
+    
+    def _write_comment_group(self, o, group, records, state):
+        """
+        Rule 2 Implementation. Returns the number of borders added above and below the group
+        """
+        
+        first = records[0]
+        whiteSpace = as_str(first.text[:first.commentStart])
+        
+        """
+        Check to see if this line contains a newline. If not (such as if the comment is at the end of the file),
+        then we need to set the offset differently
+        """
+        newLineOffset = 1 if first.hasNewline else 0
+
+        #Subtract 1-newLineOffset from the maxlength because one character is already a semicolon, one might be a newline
+        borderString = whiteSpace + ';' + '-' * (group.maxLen - 1 - newLineOffset - len(whiteSpace)) + ';\n'
+        borderString = like(borderString, first.text)
+        
+        if not group.hasTopBorder:
+            o.write(borderString)
+            state.linesChanged += 1
+        
+        for record in records:
+            
+            groupLine = record.text
+            
+            if not self.is_comment_formatted(record):
+                groupLine = self.format_comment(record, group.maxLen)
+                state.linesChanged += 1
+            
+            o.write(groupLine)
+        
+        if not group.hasBottomBorder:
+            
+            #A last line that is already formatted keeps its text, which at the end of a file has no newline to end it
+            if not record.hasNewline and groupLine is record.text:
+                o.write(like('\n', record.text))
+            
+            o.write(borderString)
+            state.linesChanged += 1
+        
+        return (int(not group.hasTopBorder), int(not group.hasBottomBorder))
+    
+    def _write_code_group(self, o, cGroup, records, state):
+        """
+        Rule 1 Implementation
+        """
+        
+        indentType = state.globalLineLen if self.globalIndent else cGroup.maxSemiColonIdx
+        
+        for record in records:
+            
+            cGroupLine = record.text
+            
+            if record.commentStart != -1 and not self.is_code_formatted(record, indentType):
+                paddedLine = self.pad_line_with_spaces(record, indentType)
+                
+                if paddedLine != cGroupLine:
+                    cGroupLine = paddedLine
+                    state.linesChanged += 1
+            
+            o.write(cGroupLine)
+            
+    def rename_and_remove_tempfile(self, tf, inputFile):
+        
+        #tf is tuple returned by the tempfile mksftemp function.
+        #First index is a file descriptor, second is the filename
+        self.writeBack.add(tf, inputFile)
+    
+    def remove_tempfile(self, tf):
+        
+        #Throw away a temp file that is not going to replace the input
+        os.close(tf[0])
+        os.remove(tf[1])
+        
+    
+    def pad_line_with_spaces(self, record, indent):
+        line = as_str(record.text)
+        idx = record.commentStart
+        code = line[:idx]
+        code += " " * (indent - len(code))
+        line = code + line[idx:]
+        
+        return like(line, record.text)
+    
+    def format_comment(self, record, length):
+        """
+        If a line has a newline char at the end, we want to strip that out. Otherwise,
+        leave the line as is. This is needed for the edgecase of a comment at the end of a file. 
+        """
+        line = as_str(record.text)
+        linePortion = None
+        offset = 0
+        
+        if not record.hasNewline:
+            linePortion = line
+            offset = length - len(line) -1
+            
+        else:
+            linePortion = line[:-1]
+            offset = length - len(line)
+        
+        return  like(linePortion + (offset * ' ') + ';\n', record.text)
+    
+    def is_code_formatted(self, record, indent):
+        """
+        Identify if a line of code with a comment has possibly already been formatted by this tool.
+        
+        This function looks to see if the semicolon on a given line is at the indent the comments are being
+        aligned to, either the group's or the global one. If so, we assume that this string has already been formatted, and skip it
+        """
+        
+        return record.commentStart == indent
+        
+    def is_comment_formatted(self, record):
+        """
+        Identifies if a comment has possibly already been formatted by this tool
+        
+        This functions checks for the existence of a second semicolon in a comment line. If this exists
+        it assumes that it has already been formatted by this tool.
+        
+        This also lets users escape this comment formatting, by using a double semicolon instead of just one
+        """
+        semiColon = ';' if isinstance(record.text, str) else b';'
+        secondSCIdx = record.text.find(semiColon, record.commentStart + 1)
+        
+        return secondSCIdx != -1
+        
+    
+    def _find_features(self, lines, chars=STR_CHARS):
+        """
+        Finds and returns the maximum length of all lines containing code, which is the column comments are moved to
+        when the global indent is turned on. lines is any iterable of lines, such as an open file.
+        
+        Only code matters here: comment groups and code groups are found while the file is being written,
+        see _get_candidate_groups
+        """    
+        
+        globalLineLen = 0
+        
+        for record in self._lex_lines(lines, chars):
+            
+            if record.kind is CodeGroup and record.codeEnd > globalLineLen:
+                globalLineLen = record.codeEnd
+        
+        
+        #Add one extra space so that the semicolon is not immediately against the end of the code
+        return globalLineLen + 1
+    
+    def _get_candidate_groups(self, lineRecords, atEnd=True):
+        """
+        Scan through a stream of LineRecords, see _lex_lines, and yield (group, records) pairs, one for each run of consecutive lines that
+        belong together. group is a CommentGroup, a CodeGroup, or None for lines that belong to no group, and records
+        holds the LineRecord of each line in the run.
+        
+        All ; characters in a comment group must be at the same indent level. Different
+        indent levels will denote different comment groups
+        
+        A comment group is considered ended when
+        1) The next line contains code
+        2) The next line contains a differently indented comment group
+        
+        Code groups follow the same rules: leading whitespace is the main criteria for determining blocks of code,
+        and a blank line only continues a group that is not indented.
+        
+        Only the lines of the current group are kept, so memory is bounded by the largest group rather than the file.
+        atEnd is False when the records stop short of the end of the file, see _close_group.
+        """
+        
+        group = None
+        groupKind = None
+        records = []
+        prevWhiteSpaceSig = None
+        
+        for record in lineRecords:
+            
+            line = record.text
+            kind = record.kind
+            whiteSpaceSig = line[:record.indentEnd]
+            
+            if records and kind is groupKind and (kind is None or whiteSpaceSig == prevWhiteSpaceSig):
+                
+                """
+                The line continues the current group, so update the group's maximum length if necessary
                 """
                 
-                group.numRows += 1
-                currentLineLen = len(currentLine)
+                if kind is CommentGroup:
+                    group.numRows += 1
+                    group.maxLen = max(group.maxLen, len(line))
                 
-                if currentLineLen > group.maxLen:
+                elif kind is CodeGroup:
+                    group.numRows += 1
+                    group.maxSemiColonIdx = max(group.maxSemiColonIdx, record.commentStart)
+                
+                records.append(record)
+                continue
+            
+            """
+            Either the kind of line or the whitespace signature changed. This means the current group
+            is completed.
+            """
+            
+            if records:
+                yield self._close_group(group, records)
+            
+            if kind is CommentGroup:
+                group = CommentGroup(1, len(line))
+                
+                #Started a new group, so see if the line is a border
+                group.hasTopBorder = record.isBorder
                     
-                    group.maxLen = currentLineLen
+            elif kind is CodeGroup:
+                group = CodeGroup(1, record.commentStart)
+            
+            else:
+                group = None
+            
+            groupKind = kind
+            records = [record]
+            prevWhiteSpaceSig = whiteSpaceSig
+        
+        if records:
+            yield self._close_group(group, records, atEnd)
+    
+    def _close_group(self, group, records, last=False):
+        """
+        Finish off a group once its last line is known. last is True for the group that ends the file
+        """
+        
+        if isinstance(group, CommentGroup):
+            
+            # The second clause here rules out a degenerate case: one row in a comment that is just a border. By convention, we'll consider 
+            # this the top border in a comment group. A border that is the last line of the file is both, so it's left as it is
+            if records[-1].isBorder and not (group.numRows == 1 and group.hasTopBorder and not last):
+                group.hasBottomBorder = True
+        
+        return (group, records)
+
+
+def format_string(text, global_indent=False):
+    """
+    Format asm source held in a string, and return the formatted source. Nothing is read from or written to disk
+    """
+    
+    return AsmFormatter([], globalIndent=global_indent).format_text(text)[1]
+
+def line_edit(lineIdx, original, line):
+    """
+    The TextEdit that turns original, line lineIdx of a text, into line, replacing only what differs between them
+    """
+    
+    prefix = 0
+    limit = min(len(original), len(line))
+    
+    while prefix < limit and original[prefix] == line[prefix]:
+        prefix += 1
+    
+    suffix = 0
+    limit -= prefix
+    
+    while suffix < limit and original[-1 - suffix] == line[-1 - suffix]:
+        suffix += 1
+    
+    end = len(original) - suffix
+    
+    #An edit that reaches the newline ends at the start of the next line
+    if end == len(original) and original.endswith('\n'):
+        return TextEdit(lineIdx, prefix, lineIdx + 1, 0, line[prefix:len(line) - suffix])
+    
+    return TextEdit(lineIdx, prefix, lineIdx, end, line[prefix:len(line) - suffix])
+
+def apply_edits(text, edits):
+    """
+    Apply a list of TextEdits, in order and not overlapping, to text and return the result.
+    The text is read with \r\n and \r as \n, the same as when the edits were made
+    """
+    
+    lines = io.StringIO(text, newline=None).readlines()
+    offsets = [0]
+    
+    for line in lines:
+        offsets.append(offsets[-1] + len(line))
+    
+    text = ''.join(lines)
+    pieces = []
+    pos = 0
+    
+    for edit in edits:
+        start = offsets[edit.startLine] + edit.startColumn
+        pieces.append(text[pos:start])
+        pieces.append(edit.text)
+        pos = offsets[edit.endLine] + edit.endColumn
+    
+    pieces.append(text[pos:])
+    
+    return ''.join(pieces)
+
+def lsp_text_edits(text, edits):
+    """
+    Turn TextEdits of text into the TextEdit objects of the Language Server Protocol, as dicts ready to be sent as JSON.
+    The protocol counts columns in UTF-16 code units, so columns after characters outside the BMP are moved to match
+    """
+    
+    lines = io.StringIO(text, newline=None).readlines()
+    
+    def position(lineIdx, column):
+        
+        if lineIdx < len(lines) and not lines[lineIdx][:column].isascii():
+            column = len(lines[lineIdx][:column].encode('utf-16-le')) // 2
+        
+        return {'line': lineIdx, 'character': column}
+    
+    return [{'range': {'start': position(edit.startLine, edit.startColumn), 'end': position(edit.endLine, edit.endColumn)}, 'newText': edit.text} for edit in edits]
+
+async def iter_format_many(paths, jobs=1, formatter=None, executor=None, limit=None):
+    """
+    Format files in place without blocking the event loop, yielding a FormatResult for each file as it finishes.
+    
+    paths can be any iterable, or an async iterable, of paths. They are only taken as there is room for them: at most
+    limit files (twice the number of workers by default) are being formatted at once, so a large or endless source of
+    paths can't flood the executor.
+    
+    The formatting, reading and writing all happen on an executor: one worker thread with a jobs of 1, otherwise
+    a pool of jobs processes (0 means one per core). An executor of your own can be passed instead, and is not shut down.
+    formatter holds the settings to format with, and an AsmFormatter can be shared between any number of calls.
+    With projectIndent, the project indent of paths is found on a copy of it, so concurrent calls don't overwrite each other's.
+    
+    When the caller stops early or is cancelled, files that have not started are cancelled, while the ones already
+    being formatted run to the end (so no file is left half written) but their results are dropped.
+    """
+    
+    import asyncio
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    
+    loop = asyncio.get_running_loop()
+    formatter = formatter if formatter is not None else AsmFormatter([])
+    workers = jobs if jobs > 0 else os.cpu_count()
+    limit = limit or workers * 2
+    
+    ownExecutor = executor is None
+    if ownExecutor:
+        executor = ThreadPoolExecutor(max_workers=1) if workers == 1 else ProcessPoolExecutor(max_workers=workers)
+    
+    if hasattr(paths, '__aiter__'):
+        source = paths.__aiter__()
+    else:
+        source = iter(paths)
+    
+    async def next_path():
+        
+        if hasattr(source, '__anext__'):
+            try:
+                return await source.__anext__()
+            except StopAsyncIteration:
+                return None
+        
+        return next(source, None)
+    
+    pending = set()
+    
+    try:
+        if formatter.projectIndent:
+            #Every file needs scanning before any can be formatted
+            paths = [path async for path in source] if hasattr(source, '__anext__') else list(source)
+            source = iter(paths)
+            formatter = formatter.copy()
+            formatter.projectLineLen = await loop.run_in_executor(executor, formatter.find_project_line_len, paths, map)
+        
+        exhausted = False
+        
+        while pending or not exhausted:
+            
+            while not exhausted and len(pending) < limit:
+                path = await next_path()
+                
+                if path is None:
+                    exhausted = True
+                else:
+                    pending.add(loop.run_in_executor(executor, formatter._format_file, path, None))
+            
+            if not pending:
+                break
+            
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            
+            for future in done:
+                yield future.result()
+    
+    finally:
+        for future in pending:
+            future.cancel()
+        
+        if ownExecutor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+async def format_many(paths, jobs=1, formatter=None, executor=None, limit=None):
+    """
+    Format files in place without blocking the event loop, and return their FormatResults in the order of paths.
+    See iter_format_many, which gives the results as they finish instead
+    """
+    
+    paths = list(paths)
+    order = {}
+    results = [None] * len(paths)
+    
+    for i, path in enumerate(paths):
+        order.setdefault(path, deque()).append(i)
+    
+    async for result in iter_format_many(paths, jobs, formatter, executor, limit):
+        results[order[result.inputFile].popleft()] = result
+    
+    return results
+
+def format_stdin(args):
+    """
+    Filter mode: format stdin to stdout. With --check or --diff nothing is printed except the diff.
+    Problems found by lint rules are printed to stderr. Returns True if check mode found changes, or there were problems
+    """
+    
+    formatter = AsmFormatter([], globalIndent=args.global_indent, encoding=args.encoding, rules=args.rules)
+    
+    #Read and write the streams in the encoding that was asked for, not the locale's
+    sys.stdin.reconfigure(encoding=args.encoding)
+    sys.stdout.reconfigure(encoding=args.encoding)
+    
+    original = sys.stdin.read()
+    state, formatted = formatter.format_text(original, args.lines)
+    
+    if args.diff and state.linesChanged:
+        sys.stdout.write(formatter.make_diff(original, formatted, '<stdin>'))
+    
+    if not args.check and not args.diff:
+        sys.stdout.write(formatted)
+    
+    for lineNumber, message in state.problems:
+        print(f"<stdin>:{lineNumber}: {message}", file=sys.stderr)
+    
+    return (args.check and state.linesChanged > 0) or bool(state.problems)
+
+def format_request(request, formatters):
+    """
+    Handle one request sent to the daemon. A request is a dict with either
+    
+    text: asm source to format and send back (or with edits true, the changes to make to it, as Language Server Protocol TextEdits), or
+    path: a file to format in place (or just check, if check is true)
+    
+    plus the optional global_indent, lines and rules settings. rules is a list of rule names, and DEFAULT_RULES when it is missing.
+    When a lint rule finds problems, the response has them as a list of [line number, message] under problems.
+    formatters caches an AsmFormatter for each combination of settings.
+    """
+    
+    globalIndent = bool(request.get('global_indent', False))
+    rules = tuple(request.get('rules') or DEFAULT_RULES)
+    
+    if (globalIndent, rules) not in formatters:
+        try:
+            formatters[(globalIndent, rules)] = AsmFormatter([], globalIndent=globalIndent, rules=rules)
+        except ValueError as e:
+            return {'error': str(e)}
+    
+    formatter = formatters[(globalIndent, rules)]
+    ranges = [tuple(lineRange) for lineRange in request['lines']] if request.get('lines') else None
+    
+    if 'text' in request and request.get('edits'):
+        state, edits = formatter.text_edits(request['text'], ranges)
+        response = {'edits': lsp_text_edits(request['text'], edits), 'changed': state.linesChanged > 0}
+    
+    elif 'text' in request:
+        state, formatted = formatter.format_text(request['text'], ranges)
+        response = {'text': formatted, 'changed': state.linesChanged > 0}
+    
+    elif 'path' in request:
+        state, original, formatted = formatter.format_asm_in_memory(request['path'], ranges)
+        
+        if not request.get('check'):
+            formatter.write_formatted(request['path'], None, formatted, state)
+        
+        response = {'changed': state.linesChanged > 0}
+    
+    else:
+        return {'error': 'a request needs either text or path'}
+    
+    if state.problems:
+        response['problems'] = [list(problem) for problem in state.problems]
+    
+    return response
+
+def daemon_server(socketPath):
+    """
+    Make the server for run_daemon, bound to socketPath but not yet serving. Its handler reads requests from a daemon
+    client, one JSON object per line, and answers each with one JSON object per line.
+    
+    The socket modules are only imported here and in the client, so formatting files never pays for them
+    """
+    
+    import socketserver
+    
+    class FormatRequestHandler(socketserver.StreamRequestHandler):
+        
+        def handle(self):
+            
+            for line in self.rfile:
+                
+                try:
+                    response = format_request(json.loads(line), self.server.formatters)
+                
+                except (ValueError, TypeError, KeyError) as e:
+                    response = {'error': f"bad request: {e}"}
                 
-                prevIdx = i
-                prevLine = currentLine
+                except (OSError, UnicodeError) as e:
+                    response = {'error': str(e)}
                 
+                self.wfile.write(json.dumps(response).encode() + b'\n')
+                self.wfile.flush()
+    
+    server = socketserver.ThreadingUnixStreamServer(socketPath, FormatRequestHandler)
+    server.daemon_threads = True
+    server.formatters = {}
+    
+    return server
+
+def remove_stale_socket(socketPath):
+    """
+    Remove a socket left behind by a daemon that was killed, which would stop a new one from binding. Only a socket that
+    refuses connections is removed; raises OSError if anything else is at the path, including a daemon that is still running
+    """
+    
+    try:
+        mode = os.lstat(socketPath).st_mode
+    except FileNotFoundError:
+        return
+    
+    if not stat.S_ISSOCK(mode):
+        raise OSError(f"{socketPath} already exists and is not a socket")
+    
+    import socket
+    
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socketPath)
+        except ConnectionRefusedError:
+            os.remove(socketPath)
+            return
+    
+    raise OSError(f"a daemon is already listening on {socketPath}")
+
+def run_daemon(socketPath):
+    """
+    Serve format requests on a unix socket until interrupted. The formatter stays loaded between requests,
+    so a request only costs the formatting itself
+    """
+    
+    import signal
+    import socket
+    
+    if not hasattr(socket, 'AF_UNIX'):
+        print('the daemon needs unix socket support', file=sys.stderr)
+        return 1
+    
+    try:
+        remove_stale_socket(socketPath)
+    except OSError as e:
+        print(e, file=sys.stderr)
+        return 1
+    
+    with daemon_server(socketPath) as server:
+        
+        #Exit through the finally below when killed, so the socket file is cleaned up
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        
+        try:
+            server.serve_forever()
+        
+        except KeyboardInterrupt:
+            pass
+        
+        finally:
+            os.remove(socketPath)
+    
+    return 0
+
+def request_format(socketPath, request):
+    """
+    Send one request to a running daemon and return its response. See format_request for what a request holds
+    """
+    
+    import socket
+    
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socketPath)
+        
+        with sock.makefile('rwb') as stream:
+            stream.write(json.dumps(request).encode() + b'\n')
+            stream.flush()
+            
+            return json.loads(stream.readline())
+
+def format_stdin_via_daemon(args):
+    """
+    Filter mode, but with the formatting done by a running daemon. Returns True if check mode found changes, or there were problems
+    """
+    
+    original = sys.stdin.read()
+    response = request_format(args.connect, {'text': original, 'global_indent': args.global_indent, 'lines': args.lines, 'rules': args.rules})
+    
+    if 'error' in response:
+        print(response['error'], file=sys.stderr)
+        return True
+    
+    if args.diff and response['changed']:
+        sys.stdout.write(AsmFormatter([]).make_diff(original, response['text'], '<stdin>'))
+    
+    if not args.check and not args.diff:
+        sys.stdout.write(response['text'])
+    
+    for lineNumber, message in response.get('problems', ()):
+        print(f"<stdin>:{lineNumber}: {message}", file=sys.stderr)
+    
+    return (args.check and response['changed']) or 'problems' in response
+
+def run_git(args, directory=None, input=None):
+    """
+    Run a git command in directory and return its output as bytes. Raises OSError if git fails or is not installed
+    """
+    
+    import subprocess
+    
+    result = subprocess.run(['git'] + args, cwd=directory, input=input, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    
+    if result.returncode != 0:
+        raise OSError(f"git {args[0]} failed: {result.stderr.decode(errors='replace').strip()}")
+    
+    return result.stdout
+
+def staged_files(directory=None, pathspecs=(), extensions=DEFAULT_EXTENSIONS, include=None, exclude=None):
+    """
+    The files that are added or modified in the index, as (mode, blob id, path) with paths relative to the top of
+    the repository. Only regular files with one of the extensions that match the include globs and none of the exclude globs are listed
+    """
+    
+    output = run_git(['diff', '--cached', '--raw', '-z', '--no-abbrev', '--no-renames', '--diff-filter=AM', '--'] + list(pathspecs), directory)
+    fields = output.split(b'\0')
+    files = []
+    
+    #Each file is a :oldmode newmode oldblob newblob status field followed by a path field
+    for info, path in zip(fields[0::2], fields[1::2]):
+        
+        mode, blob = info.split()[1:4:2]
+        path = os.fsdecode(path)
+        
+        #Skip symlinks and submodules, whose blobs are not files
+        if not mode.startswith(b'100') or not is_selected(path, extensions, include, exclude):
+            continue
+        
+        files.append((mode.decode(), blob.decode(), path))
+    
+    return files
+
+def read_blobs(blobs, directory=None):
+    """
+    Read the contents of a list of blobs with a single git cat-file --batch, and return them in the same order
+    """
+    
+    if not blobs:
+        return []
+    
+    output = run_git(['cat-file', '--batch'], directory, ''.join(blob + '\n' for blob in blobs).encode())
+    contents = []
+    pos = 0
+    
+    for blob in blobs:
+        
+        headerEnd = output.index(b'\n', pos)
+        header = output[pos:headerEnd].split()
+        
+        if len(header) != 3:
+            raise OSError(f"git cat-file could not read blob {blob}")
+        
+        size = int(header[2])
+        contents.append(output[headerEnd + 1:headerEnd + 1 + size])
+        pos = headerEnd + 1 + size + 1
+    
+    return contents
+
+def format_staged(formatter, directory=None, pathspecs=(), extensions=DEFAULT_EXTENSIONS, include=None, exclude=None):
+    """
+    Format the staged version of each file in the index, for a pre-commit hook, and return a FormatResult for each one.
+    
+    The staged contents are read from git in one go and formatted in memory, so the working tree is never read.
+    In check or diff mode nothing is written. Otherwise each file that changes has its formatted version staged in its place,
+    and written to the working tree too. A file with unstaged changes is left alone and reported as an error instead,
+    as formatting it would mean either losing those changes or staging them.
+    """
+    
+    root = os.fsdecode(run_git(['rev-parse', '--show-toplevel'], directory).rstrip(b'\n'))
+    files = staged_files(directory, pathspecs, extensions, include, exclude)
+    results = []
+    formatted = []
+    
+    for (mode, blob, path), content in zip(files, read_blobs([blob for mode, blob, path in files], directory)):
+        
+        try:
+            original = content.decode(formatter.encoding)
+            state, text = formatter.format_text(original)
+        
+        except UnicodeError as e:
+            results.append(FormatResult(path, None, e))
+            continue
+        
+        diff = formatter.make_diff(original, text, path) if formatter.diff and state.linesChanged else None
+        results.append(FormatResult(path, None, changed=state.linesChanged > 0, diff=diff, problems=state.problems))
+        
+        if state.linesChanged:
+            formatted.append((mode, path, text, state, results[-1]))
+    
+    if formatter.check or formatter.diff or not formatted:
+        return results
+    
+    pathspecs = [':(top,literal)' + path for mode, path, text, state, result in formatted]
+    unstaged = set(os.fsdecode(path) for path in run_git(['diff', '--name-only', '-z', '--'] + pathspecs, directory).split(b'\0'))
+    indexInfo = []
+    
+    for mode, path, text, state, result in formatted:
+        
+        if path in unstaged:
+            result.error = RuntimeError('not reformatted, as it has unstaged changes')
+            result.changed = None
+            continue
+        
+        try:
+            blob = run_git(['hash-object', '-w', '--stdin'], directory, text.encode(formatter.encoding)).decode().strip()
+            formatter.write_formatted(os.path.join(root, path), None, text, state)
+        
+        except OSError as e:
+            result.error = e
+            result.changed = None
+            continue
+        
+        indexInfo.append(f"{mode} {blob}\t".encode() + os.fsencode(path) + b'\0')
+    
+    if indexInfo:
+        run_git(['update-index', '-z', '--index-info'], root, b''.join(indexInfo))
+    
+    return results
+
+class Watcher:
+    """
+    Polls a set of paths and formats each file in place once it has stopped changing for a while.
+    
+    Each poll walks the paths with discover_files and compares the modification time and size of every file
+    with the previous poll. A changed file is only formatted once it has gone debounce seconds without
+    changing again, so that a burst of saves only formats it once.
+    """
+    
+    def __init__(self, formatter, discover, interval=0.5, debounce=0.3):
+        self.formatter = formatter
+        
+        #Called with no arguments to get the files to watch
+        self.discover = discover
+        
+        self.interval = interval
+        self.debounce = debounce
+        
+        self.known = {}
+        self.pending = {}
+    
+    def snapshot(self):
+        
+        stamps = {}
+        
+        for path in self.discover():
+            try:
+                stat = os.stat(path)
+            except OSError:
                 continue
             
-            """
-            Either we skipped a line, indicating that there was some code in the original document
-            or we found a comment that has a different amount of whitespace. This means we've
-            started a new 
-            """
+            stamps[path] = (stat.st_mtime_ns, stat.st_size)
+        
+        return stamps
+    
+    def poll(self):
+        """
+        Check for changes once, and format the files that have settled. Returns the FormatResults of those files
+        """
+        
+        now = time.monotonic()
+        
+        for path, stamp in self.snapshot().items():
+            if self.known.get(path) != stamp:
+                self.known[path] = stamp
+                self.pending[path] = now
+        
+        results = []
+        
+        for path, changedAt in list(self.pending.items()):
             
-            bottomBorder = re.match(self.commentBorder, prevLine)
+            if now - changedAt < self.debounce:
+                continue
             
-            # The second clause here rules out a degenerate case: one row in a comment that is just a border. By convention, we'll consider 
-            # this the top border in a comment group
-            if bottomBorder and not (group.numRows == 1 and group.hasTopBorder):
-                group.hasBottomBorder = True
-                
-            self.commentGroups[startIdx] = deepcopy(group)
+            del self.pending[path]
+            results.append(self.formatter._format_file(path, None))
             
-            startIdx = i
-            group = CommentGroup(1, len(currentLine))            
-            prevIdx = i
-            prevLine = currentLine
-            prevWhiteSpaceSig = whiteSpaceSig
+            #Remember our own write so it isn't picked up as another change
+            try:
+                stat = os.stat(path)
+                self.known[path] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                self.known.pop(path, None)
+        
+        return results
+    
+    def run(self):
+        """
+        Watch until interrupted. Files that exist when watching starts are not formatted until they change
+        """
+        
+        self.known = self.snapshot()
+        
+        try:
+            while True:
+                time.sleep(self.interval)
+                
+                for result in self.poll():
+                    if result.error is not None:
+                        print(f"{result.inputFile}: {result.error}", file=sys.stderr)
+                    
+                    elif result.changed:
+                        print(f"formatted {result.inputFile}", file=sys.stderr)
+                    
+                    for lineNumber, message in result.problems:
+                        print(f"{result.inputFile}:{lineNumber}: {message}", file=sys.stderr)
+        
+        except KeyboardInterrupt:
+            pass
+
+def parse_size(value):
+    """
+    Parse a size such as 512, 64K or 8M into a number of bytes
+    """
+    
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    value = value.strip().upper()
+    
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    
+    return int(value)
+
+def parse_line_range(value):
+    """
+    Parse a START:END line range given on the command line
+    """
+    
+    try:
+        first, last = (int(part) for part in value.split(':'))
+    
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid line range '{value}', expected START:END")
+    
+    if first < 1 or last < first:
+        raise argparse.ArgumentTypeError(f"invalid line range '{value}', lines count from 1 and END can't be before START")
+    
+    return (first, last)
+
+def parse_diff_ranges(diffText):
+    """
+    Map each file in a unified diff (such as the output of git diff -U0) to the lines its hunks cover in the new version of the file
+    """
+    
+    ranges = {}
+    current = None
+    
+    for line in diffText.splitlines():
+        
+        if line.startswith('+++ '):
+            path = line[4:].split('\t')[0]
             
+            if path == '/dev/null':
+                current = None
+                continue
             
-            #Started a new group, so see if the line is a border
-            match = re.match(self.commentBorder, prevLine)
+            if path.startswith('b/'):
+                path = path[2:]
             
-            if match:
-                group.hasTopBorder = True
+            current = ranges.setdefault(path, [])
         
+        elif line.startswith('@@') and current is not None:
+            match = re.match(r"@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@", line)
             
-        if startIdx not in self.commentGroups:
-            
-            #We exited before we were able to add the group to the list of groups.
-            #Means that the check to see if the last line was a border was not performed
-            #so do that here.
+            if not match:
+                continue
             
-            match = re.match(self.commentBorder, prevLine)
+            start = int(match.group(1))
+            count = int(match.group(2)) if match.group(2) is not None else 1
             
-            if match:
-                group.hasBottomBorder = True
-                
-            self.commentGroups[startIdx] = deepcopy(group)
+            #A hunk that only removes lines still changes the group around it, so take the lines on either side
+            if count == 0:
+                current.append((max(start, 1), start + 1))
+            else:
+                current.append((start, start + count - 1))
+    
+    return ranges
+
+def ranges_from_diff(diffText, extensions=DEFAULT_EXTENSIONS, include=None, exclude=None, directory=None):
+    """
+    The line ranges of a unified diff, see parse_diff_ranges, with each path made absolute, and the files in it that a walk
+    with discover_files would pick up. git gives paths relative to the top of the repository, so they are resolved
+    against that rather than the cwd, or against directory (the cwd by default) outside a repository.
+    Returns the ranges and the list of files
+    """
+    
+    try:
+        root = os.fsdecode(run_git(['rev-parse', '--show-toplevel'], directory).rstrip(b'\n'))
+    except OSError:
+        root = os.path.abspath(directory or os.curdir)
+    
+    lineRanges = {}
+    files = []
+    
+    for path, ranges in parse_diff_ranges(diffText).items():
         
-        #TODO: Remove this    
-        pass
-                
-    def _get_candidate_code_groups(self):
+        fullPath = os.path.join(root, path)
+        lineRanges[fullPath] = ranges
+        
+        if is_selected(path, extensions, include, exclude):
+            files.append(fullPath)
+    
+    return (lineRanges, files)
+
+def gitignore_regex(pattern):
+    """
+    Translate a .gitignore pattern (without any leading ! or trailing /) into a regex that matches paths relative
+    to the directory of the .gitignore file, using / as the separator
+    """
+    
+    #A pattern with a slash anywhere but the end only matches relative to its .gitignore, otherwise it matches at any depth
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+    
+    regex = ''
+    i = 0
+    
+    while i < len(pattern):
+        c = pattern[i]
         
-        indices = list(self.codeLines.keys())
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+            continue
         
-        #There might not be any code groups, in which case we can just skip this
-        if not indices:
-            return
+        if pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+            continue
         
-        indices.sort()
+        if c == '*':
+            regex += '[^/]*'
         
-        startIdx = indices[0]
-        prevIdx = indices[0]
-        prevLine = self.codeLines[prevIdx]
-        group = CodeGroup(1,prevLine.find(';'))
-        prevWhiteSpaceSig = re.match(self.leadingWhiteSpace, prevLine).group()
+        elif c == '?':
+            regex += '[^/]'
         
-        for i in indices[1:]:
+        elif c == '[' and pattern.find(']', i + 1) != -1:
+            end = pattern.find(']', i + 1)
+            charClass = pattern[i + 1:end]
             
-            currentLine = self.codeLines[i]
-            whiteSpaceSig = re.match(self.leadingWhiteSpace, currentLine).group()
+            if charClass.startswith('!'):
+                charClass = '^' + charClass[1:]
             
-            """
-            The second or clause cover the case where we have a blank line between some lines of code that 
-            are at the same indent level, like
+            regex += '[' + charClass.replace('\\', '\\\\') + ']'
+            i = end + 1
+            continue
+        
+        elif c == '\\' and i + 1 < len(pattern):
+            regex += re.escape(pattern[i + 1])
+            i += 2
+            continue
+        
+        else:
+            regex += re.escape(c)
+        
+        i += 1
+    
+    prefix = '' if anchored else '(?:.*/)?'
+    
+    return re.compile(prefix + regex + '$')
+
+def git_dir(root):
+    """
+    Find the git directory of the repository whose top is root, or None if it can't be read. In a worktree or a submodule
+    .git is a file pointing at it, and a worktree's git directory points at the shared one, where info/exclude is kept
+    """
+    
+    gitDir = os.path.join(root, '.git')
+    
+    if not os.path.isdir(gitDir):
+        try:
+            with open(gitDir, 'r') as f:
+                pointer = f.readline().strip()
+        
+        except OSError:
+            return None
+        
+        if not pointer.startswith('gitdir:'):
+            return None
+        
+        gitDir = os.path.join(root, pointer[len('gitdir:'):].strip())
+    
+    try:
+        with open(os.path.join(gitDir, 'commondir'), 'r') as f:
+            gitDir = os.path.join(gitDir, f.readline().strip())
+    
+    except OSError:
+        pass
+    
+    return os.path.normpath(gitDir)
+
+class IgnoreRules:
+    """
+    The .gitignore patterns that apply inside a directory, in the order git applies them: parent directories first,
+    and later patterns overriding earlier ones.
+    
+    Each rule is a tuple of (directory of the .gitignore, regex, negated, only matches directories).
+    """
+    
+    def __init__(self, rules=()):
+        self.rules = list(rules)
+    
+    @classmethod
+    def for_directory(cls, directory):
+        """
+        Load the rules from the .gitignore files above a directory, up to the root of the git repository it is in,
+        after the ones in the repository's info/exclude. The directory's own .gitignore is left for extended
+        """
+        
+        directory = os.path.abspath(directory)
+        ancestors = []
+        current = directory
+        
+        #.git is a directory in a plain repository, and a file in a worktree or a submodule
+        while not os.path.exists(os.path.join(current, '.git')):
             
-            ld a, b
-            xor a
+            parent = os.path.dirname(current)
             
-            bit 0, [rLCDC]
+            #Only use these if the directory is actually inside a repository
+            if parent == current:
+                return cls()
             
-            Leading whitespace is the main criteria for determining blocks of code
-            """
+            current = parent
+            ancestors.append(current)
+        
+        rules = cls()
+        gitDir = git_dir(current)
+        
+        if gitDir is not None:
+            rules = rules.extended(current, os.path.join(gitDir, 'info', 'exclude'))
+        
+        for ancestor in reversed(ancestors):
+            rules = rules.extended(ancestor)
+        
+        return rules
+    
+    def extended(self, directory, ignoreFile=None):
+        """
+        Return the rules for directory: these rules plus the ones in its own .gitignore, if it has one.
+        ignoreFile reads the patterns from another file instead, with paths still relative to directory
+        """
+        
+        directory = os.path.abspath(directory)
+        
+        try:
+            with open(ignoreFile or os.path.join(directory, '.gitignore'), 'r', errors='replace') as f:
+                lines = f.read().splitlines()
+        
+        except OSError:
+            return self
+        
+        newRules = []
+        
+        for line in lines:
+            pattern = line.rstrip(' ')
             
-            if i == prevIdx + 1 and (whiteSpaceSig == prevWhiteSpaceSig or whiteSpaceSig == '\n'):
-                
-                group.numRows += 1
-                currentLineIdx = currentLine.find(';')
-                
-                if currentLineIdx > group.maxSemiColonIdx:
-                    group.maxSemiColonIdx = currentLineIdx
-                
-                prevIdx = i
-                prevLine = currentLine
-                
+            if not pattern or pattern.startswith('#'):
                 continue
             
-            """
-            Either we skipped a line, or the whitespace signature changed. This means the current group
-            is completed.
-            """
+            negated = pattern.startswith('!')
+            if negated:
+                pattern = pattern[1:]
             
-            self.codeGroups[startIdx] = deepcopy(group)
+            elif pattern.startswith('\\!') or pattern.startswith('\\#'):
+                pattern = pattern[1:]
             
-            startIdx = i
-            group = CodeGroup(1, currentLine.find(';'))
+            dirOnly = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
             
-            prevIdx = i
-            prevLine = currentLine
-            prevWhiteSpaceSig = whiteSpaceSig
+            if pattern:
+                newRules.append((directory, gitignore_regex(pattern), negated, dirOnly))
+        
+        if not newRules:
+            return self
+        
+        return IgnoreRules(self.rules + newRules)
+    
+    def is_ignored(self, path, isDir):
+        """
+        Check an absolute path against every rule. The last rule that matches decides
+        """
+        
+        ignored = False
+        
+        for directory, regex, negated, dirOnly in self.rules:
+            
+            if dirOnly and not isDir:
+                continue
+            
+            if not path.startswith(directory + os.sep):
+                continue
+            
+            relPath = path[len(directory) + 1:].replace(os.sep, '/')
             
-        if startIdx not in self.codeGroups:
-            self.codeGroups[startIdx] = group
+            if regex.match(relPath):
+                ignored = not negated
+        
+        return ignored
+
+def matches_any(relPath, name, globs):
+    """
+    Check a path against a list of globs, either as a path relative to the directory being walked or as a bare name
+    """
+    
+    return any(fnmatchcase(relPath, glob) or fnmatchcase(name, glob) for glob in globs)
+
+def is_selected(relPath, extensions=DEFAULT_EXTENSIONS, include=None, exclude=None):
+    """
+    Whether a walk with discover_files would pick up the file at relPath, a / separated path relative to the top of the walk:
+    it has one of the extensions, matches an include glob if any are given, and neither it nor a directory above it is excluded
+    """
+    
+    parts = relPath.split('/')
+    name = parts[-1]
+    
+    if not name.lower().endswith(tuple(extension.lower() for extension in extensions)):
+        return False
+    
+    if include and not matches_any(relPath, name, include):
+        return False
+    
+    if exclude and any(matches_any('/'.join(parts[:i + 1]), parts[i], exclude) for i in range(len(parts))):
+        return False
+    
+    return True
+
+def discover_files(paths, extensions=DEFAULT_EXTENSIONS, include=None, exclude=None, gitignore=True):
+    """
+    Yield the files to format from a list of paths. Files are yielded as given, and directories are walked
+    lazily, in name order, one directory at a time.
+    
+    Inside a directory, a file is only picked up if it has one of the extensions and matches one of the include
+    globs (if any are given). Anything that matches an exclude glob or is ignored by git is skipped, and so is the
+    whole of an excluded directory.
+    """
+    
+    extensions = tuple(extension.lower() for extension in extensions)
+    
+    for path in paths:
+        
+        if not os.path.isdir(path):
+            yield path
+            continue
+        
+        rules = IgnoreRules.for_directory(path) if gitignore else None
+        yield from _walk_directory(path, os.path.abspath(path), path, rules, extensions, include, exclude)
 
+def _walk_directory(directory, absDirectory, root, rules, extensions, include, exclude):
+    
+    if rules is not None:
+        rules = rules.extended(absDirectory)
+    
+    try:
+        with os.scandir(directory) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+    
+    except OSError as e:
+        print(f"{directory}: {e}", file=sys.stderr)
+        return
+    
+    for entry in entries:
+        
+        if entry.name == '.git':
+            continue
+        
+        #Don't follow links to directories, they can loop back on themselves
+        isDir = entry.is_dir(follow_symlinks=False)
+        relPath = os.path.relpath(entry.path, root).replace(os.sep, '/')
+        absPath = os.path.join(absDirectory, entry.name)
+        
+        if exclude and matches_any(relPath, entry.name, exclude):
+            continue
+        
+        if rules is not None and rules.is_ignored(absPath, isDir):
+            continue
+        
+        if isDir:
+            yield from _walk_directory(entry.path, absPath, root, rules, extensions, include, exclude)
+        
+        elif entry.name.lower().endswith(extensions) and (not include or matches_any(relPath, entry.name, include)):
+            yield entry.path
 
 def parse_args(args):
     parser = argparse.ArgumentParser(description='Format an ASM file.')
-    parser.add_argument( 'input', nargs='*', help='Location(s) of the ASM file(s) to be imported')
+    parser.add_argument( 'input', nargs='*', help='Location(s) of the ASM file(s) to be imported. Directories are searched recursively. Use - to format stdin to stdout')
     parser.add_argument('-o', '--output', nargs='*', help='Location(s) of output ASM file(s)')
     parser.add_argument('-g', '--global_indent', action="store_true", help='Adjust comments at the end of code lines to a global indent level')
+    parser.add_argument('--project_indent', action="store_true", help='Like --global_indent, but with one indent level shared by every input file')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of files to format in parallel. 0 uses every core')
+    parser.add_argument('--chunk_size', type=parse_size, metavar='SIZE', help='With more than one job, split files bigger than SIZE (such as 512K) into chunks that are formatted in parallel')
+    parser.add_argument('--cache', nargs='?', const='.asmfmt_cache.json', help='Skip files that a previous in-place run found already formatted, using this cache file')
+    parser.add_argument('--check', action="store_true", help="Don't write anything, exit with a non-zero status if any file would be reformatted")
+    parser.add_argument('--diff', action="store_true", help="Don't write anything, print a unified diff of the changes to each file instead")
+    parser.add_argument('--extensions', default=','.join(DEFAULT_EXTENSIONS), help='Comma separated file extensions to pick up when searching a directory')
+    parser.add_argument('--include', action='append', help='Only format files in searched directories that match this glob. Can be given more than once')
+    parser.add_argument('--exclude', action='append', help='Skip files and directories that match this glob. Can be given more than once')
+    parser.add_argument('--no_gitignore', action="store_true", help="Don't skip files that are ignored by git when searching a directory")
+    parser.add_argument('--lines', action='append', type=parse_line_range, help='Only format the groups that touch lines START:END, counting from 1. Can be given more than once. Needs a single input')
+    parser.add_argument('--lines_from_diff', help='Only format the groups that touch the hunks of this unified diff (- for stdin), such as the output of git diff -U0. With no inputs, the files in the diff are formatted')
+    parser.add_argument('--watch', action="store_true", help='Keep running, and format the inputs in place whenever they change')
+    parser.add_argument('--interval', type=float, default=0.5, help='Seconds between checks for changes in watch mode')
+    parser.add_argument('--daemon', metavar='SOCKET', help='Keep running, and format requests sent to this unix socket')
+    parser.add_argument('--connect', metavar='SOCKET', help='With - as the input, have the daemon listening on this socket do the formatting')
+    parser.add_argument('--encoding', default='utf-8', help='Encoding of the files being formatted (default %(default)s)')
+    parser.add_argument('--no_mmap', action="store_true", help="Always format files as text, instead of memory mapping ASCII files and formatting them as bytes")
+    parser.add_argument('--fsync', choices=WriteBack.POLICIES, default='none', help='How hard to make sure files formatted in place are on disk: none, fsync each file, or also fsync their directories once per batch')
+    parser.add_argument('--stats', nargs='?', const='-', metavar='PATH', help='Write JSON timings and counters for every file and in total to this file, or stderr when no file is given')
+    parser.add_argument('--profile', choices=PROFILERS, help='Run under cProfile or tracemalloc, printing a summary to stderr. With more than one job only this process is profiled')
+    parser.add_argument('--profile_output', metavar='PATH', help='Save the raw cProfile data to this file instead of printing a summary, for pstats or snakeviz')
+    parser.add_argument('--staged', action="store_true", help='Format the files staged in git, for a pre-commit hook. The staged versions are formatted and staged again, or just checked with --check or --diff. Inputs limit it to those paths')
+    parser.add_argument('--enable', action='append', default=[], metavar='RULE', help=f"Turn a rule on. Can be given more than once. Rules: {', '.join(RULES)}")
+    parser.add_argument('--disable', action='append', default=[], metavar='RULE', help=f"Turn a rule off. Can be given more than once. On by default: {', '.join(DEFAULT_RULES)}")
+    parser.add_argument('--symbols', nargs='?', const=DEFAULT_SYMBOL_INDEX, metavar='PATH', help='Keep an index of the labels, sections, constants and includes of the files formatted in place in this file')
+    parser.add_argument('--definition', metavar='NAME', help='Print where NAME is defined, from the symbol index, without formatting anything')
+    parser.add_argument('--includes', metavar='FILE', help='Print the files FILE includes, from the symbol index, without formatting anything')
+    parser.add_argument('--included_by', metavar='FILE', help='Print the files that include FILE, from the symbol index, without formatting anything')
+
+    parsed = parser.parse_args(args)
+    
+    if parsed.output and any(os.path.isdir(path) for path in parsed.input):
+        parser.error('output files can only be given when every input is a file')
+    
+    if parsed.output and len(parsed.output) != len(parsed.input):
+        parser.error(f"{len(parsed.input)} input files, but {len(parsed.output)} output files: give one output for each input")
+    
+    if '-' in parsed.input and (len(parsed.input) > 1 or parsed.output):
+        parser.error('- (stdin) must be the only input, and is always written to stdout')
+    
+    if parsed.lines and (len(parsed.input) != 1 or os.path.isdir(parsed.input[0])):
+        parser.error('--lines needs exactly one input file')
+    
+    if parsed.lines and parsed.lines_from_diff:
+        parser.error('--lines and --lines_from_diff can not be used together')
+    
+    if parsed.connect and parsed.input != ['-']:
+        parser.error('--connect only works with - as the input')
+    
+    if (parsed.definition or parsed.includes or parsed.included_by) and parsed.input:
+        parser.error('--definition, --includes and --included_by are answered from the symbol index, and take no inputs')
+    
+    if parsed.staged and (parsed.output or '-' in parsed.input or parsed.lines or parsed.lines_from_diff or parsed.watch or parsed.project_indent):
+        parser.error('--staged can not be used with -, output files, --lines, --lines_from_diff, --watch or --project_indent')
+    
+    try:
+        parsed.rules = select_rules(parsed.enable, parsed.disable)
+    except ValueError as e:
+        parser.error(str(e))
+    
+    return parsed
+
+def query_symbols(args):
+    """
+    Answer --definition, --includes and --included_by from the symbol index, printing path:line: kind name for each match.
+    Returns True if nothing matched
+    """
+    
+    index = SymbolIndex(args.symbols or DEFAULT_SYMBOL_INDEX)
+    found = False
+    
+    if args.definition:
+        for path, line, kind in index.definitions(args.definition):
+            print(f"{path}:{line}: {kind} {args.definition}")
+            found = True
+    
+    if args.includes:
+        for name, line in index.includes(args.includes):
+            print(f"{os.path.abspath(args.includes)}:{line}: include {name}")
+            found = True
+    
+    if args.included_by:
+        for path, line in index.included_by(args.included_by):
+            print(f"{path}:{line}: include {args.included_by}")
+            found = True
+    
+    return not found
+
+def report_results(results, check, diff):
+    """
+    Print diffs to stdout, and the files that could not be formatted or (in check mode) would be reformatted to stderr,
+    as each result arrives, along with any problems the lint rules found. Returns True if there were any of the latter three
+    """
+    
+    failed = False
+    
+    for result in results:
+        
+        if result.error is not None:
+            print(f"{result.inputFile}: {result.error}", file=sys.stderr)
+            failed = True
+        
+        if diff and result.diff:
+            sys.stdout.write(result.diff)
+        
+        if check and result.changed:
+            print(f"would reformat {result.inputFile}", file=sys.stderr)
+            failed = True
+        
+        for lineNumber, message in result.problems:
+            print(f"{result.inputFile}:{lineNumber}: {message}", file=sys.stderr)
+            failed = True
+    
+    return failed
+
+def collect_stats(results, collected):
+    """
+    Pass results through unchanged, adding each one to the list collected on the way
+    """
+    
+    for result in results:
+        collected.append(result)
+        yield result
+
+def stats_report(results):
+    """
+    Build the --stats JSON for a list of FormatResults: the stats of every file, and the stats of all of them added up
+    """
+    
+    files = []
+    total = FileStats()
+    total.files = 0
+    
+    for result in results:
+        entry = {'file': result.inputFile, 'skipped': result.skipped, 'error': None if result.error is None else str(result.error)}
+        
+        if result.stats is not None:
+            entry.update(result.stats.as_dict())
+            total.merge(result.stats)
+        
+        files.append(entry)
+    
+    summary = total.as_dict()
+    summary['files'] = len(files)
+    summary['files_formatted'] = total.files
+    summary['files_skipped'] = sum(1 for result in results if result.skipped)
+    
+    return {'files': files, 'total': summary}
 
-    return parser.parse_args(args)
+PROFILERS = ('cprofile', 'tracemalloc')
+
+@contextmanager
+def profiling(profiler, output=None):
+    """
+    Run the body of the with statement under a profiler, and report on it when it ends.
+    
+    cprofile prints the 25 functions with the most cumulative time to stderr, or saves the raw data to output.
+    tracemalloc prints the peak memory and the 25 lines that allocated the most to stderr.
+    None runs the body without a profiler, so the profiler can be picked at runtime without editing any code.
+    
+    The profilers are only imported when they are used.
+    """
+    
+    if profiler is None:
+        yield
+    
+    elif profiler == 'cprofile':
+        import cProfile
+        import pstats
+        
+        profile = cProfile.Profile()
+        profile.enable()
+        
+        try:
+            yield
+        
+        finally:
+            profile.disable()
+            
+            if output:
+                profile.dump_stats(output)
+            else:
+                pstats.Stats(profile, stream=sys.stderr).sort_stats('cumulative').print_stats(25)
+    
+    elif profiler == 'tracemalloc':
+        import tracemalloc
+        
+        tracemalloc.start()
+        
+        try:
+            yield
+        
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            
+            print(f"peak traced memory: {peak / 1024:.1f} KiB, still allocated: {current / 1024:.1f} KiB", file=sys.stderr)
+            
+            for stat in snapshot.statistics('lineno')[:25]:
+                print(stat, file=sys.stderr)
+    
+    else:
+        raise ValueError(f"unknown profiler {profiler}, expected one of {', '.join(PROFILERS)}")
 
 if __name__ == '__main__':
     
     args = parse_args(sys.argv[1:])
-    formatter = AsmFormatter(args.input, args.output, args.global_indent)
-    formatter.format_files()
+    
+    if args.daemon:
+        sys.exit(run_daemon(args.daemon))
+    
+    if args.definition or args.includes or args.included_by:
+        sys.exit(1 if query_symbols(args) else 0)
+    
+    if args.input == ['-']:
+        filterMode = format_stdin_via_daemon if args.connect else format_stdin
+        sys.exit(1 if filterMode(args) else 0)
+    
+    cache = FormatCache(args.cache) if args.cache else None
+    symbolIndex = SymbolIndex(args.symbols) if args.symbols else None
+    
+    lineRanges = None
+    
+    if args.lines:
+        lineRanges = {args.input[0]: args.lines}
+    
+    extensions = [extension.strip() for extension in args.extensions.split(',') if extension.strip()]
+    
+    if args.lines_from_diff:
+        if args.lines_from_diff == '-':
+            diffText = sys.stdin.read()
+        else:
+            with open(args.lines_from_diff, 'r') as f:
+                diffText = f.read()
+        
+        lineRanges, diffFiles = ranges_from_diff(diffText, extensions, args.include, args.exclude)
+        
+        if not args.input:
+            args.input = diffFiles
+    
+    if args.staged:
+        formatter = AsmFormatter([], globalIndent=args.global_indent, check=args.check, diff=args.diff, encoding=args.encoding, rules=args.rules)
+        
+        try:
+            results = format_staged(formatter, None, args.input, extensions, args.include, args.exclude)
+        except OSError as e:
+            print(e, file=sys.stderr)
+            sys.exit(2)
+        
+        sys.exit(1 if report_results(results, args.check, args.diff) else 0)
+    
+    if args.watch:
+        formatter = AsmFormatter([], globalIndent=args.global_indent, encoding=args.encoding, bytesMode=not args.no_mmap, fsync=args.fsync, rules=args.rules)
+        discover = lambda: discover_files(args.input, extensions, args.include, args.exclude, not args.no_gitignore)
+        Watcher(formatter, discover, args.interval).run()
+        sys.exit(0)
+    
+    files = discover_files(args.input, extensions, args.include, args.exclude, not args.no_gitignore)
+    
+    formatter = AsmFormatter(files, args.output, globalIndent=args.global_indent, jobs=args.jobs, cache=cache, check=args.check, diff=args.diff, lineRanges=lineRanges, stats=args.stats is not None,
+                             encoding=args.encoding, bytesMode=not args.no_mmap, fsync=args.fsync, projectIndent=args.project_indent, rules=args.rules, chunkSize=args.chunk_size, symbols=symbolIndex)
+    results = formatter.iter_format_files()
+    
+    if args.stats:
+        collected = []
+        results = collect_stats(results, collected)
+    
+    with profiling(args.profile, args.profile_output):
+        failed = report_results(results, args.check, args.diff)
+    
+    if cache:
+        cache.save()
+    
+    if symbolIndex:
+        symbolIndex.save()
+    
+    if args.stats:
+        report = json.dumps(stats_report(collected), indent=2)
+        
+        if args.stats == '-':
+            print(report, file=sys.stderr)
+        else:
+            with open(args.stats, 'w') as f:
+                f.write(report + '\n')
+    
+    if failed:
+        sys.exit(1)
     
     
     
\ No newline at end of file
@@ -1,22 +1,203 @@
+import argparse
 from collections import Counter as count
+import hashlib
 import json
-import mariadb
-import requests
+import os
 import sys
+import tempfile
+import time
 
+#Where the opcode table is fetched from when no other source is given
+OPCODES_URL = 'https://gbdev.io/gb-opcodes/Opcodes.json'
+
+#The local copy of the fetched opcode table. What is known about it is kept next to it, in the same path plus .meta
+DEFAULT_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'opcodes_cache', 'Opcodes.json')
+
+
+class FileSource:
+    """
+    The opcode table from a local file, for machines with no network at all
+    """
+    
+    def __init__(self, path):
+        self.path = path
+    
+    def __str__(self):
+        return self.path
+    
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+
+class UrlSource:
+    """
+    The opcode table fetched from a URL every time it is read
+    """
+    
+    def __init__(self, url=OPCODES_URL, timeout=10):
+        self.url = url
+        
+        #Seconds to wait to connect, and then between bytes, before giving up
+        self.timeout = timeout
+    
+    def __str__(self):
+        return self.url
+    
+    def fetch(self, headers=None):
+        #Only needed when something is actually fetched, so a run from a file or a fresh cache works without it
+        import requests
+        
+        return requests.get(self.url, headers=headers or {}, timeout=self.timeout)
+    
+    def read(self):
+        response = self.fetch()
+        response.raise_for_status()
+        return response.content
+
+
+class CachedSource:
+    """
+    The opcode table from a UrlSource, with a copy kept in cachePath.
+    
+    A copy that was checked against the URL less than maxAge seconds ago is used as it is, without touching the network.
+    An older one is revalidated with its ETag and Last-Modified, so an unchanged table costs one request and no download.
+    If the URL can't be reached or sends something that isn't JSON, or offline is set, the copy is used however old it is.
+    
+    The sha256 of the copy is kept with it and checked every time it is read, so a truncated or edited copy is never used
+    """
+    
+    def __init__(self, source, cachePath=DEFAULT_CACHE, maxAge=24 * 60 * 60, offline=False):
+        self.source = source
+        self.cachePath = cachePath
+        self.metaPath = cachePath + '.meta'
+        self.maxAge = maxAge
+        self.offline = offline
+    
+    def __str__(self):
+        return f"{self.source} (cached in {self.cachePath})"
+    
+    def read(self):
+        
+        (cached, meta) = self.load_cache()
+        
+        if cached is not None and (self.offline or time.time() - meta['checked'] < self.maxAge):
+            return cached
+        
+        if self.offline:
+            raise OSError(f"no usable copy of {self.source} in {self.cachePath}, and fetching it is turned off")
+        
+        headers = {}
+        
+        if cached is not None and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        
+        if cached is not None and meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        
+        try:
+            response = self.source.fetch(headers)
+            
+            if response.status_code == 304 and cached is not None:
+                data = cached
+            
+            else:
+                response.raise_for_status()
+                data = response.content
+                
+                #A body that isn't a table must never be cached, or it would be used without a fetch until it is maxAge old
+                json.loads(data)
+                meta = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+        
+        #The errors requests raises are all OSErrors, and a body that isn't JSON raises a ValueError
+        except (OSError, ValueError) as e:
+            if cached is None:
+                raise
+            
+            print(f"Could not revalidate {self.source}, using the cached copy: {e}")
+            return cached
+        
+        self.save_cache(data, meta)
+        
+        return data
+    
+    def load_cache(self):
+        """
+        Return the cached copy and what is known about it, or (None, None) if there is no copy or it doesn't match its hash
+        """
+        
+        try:
+            with open(self.metaPath, 'r') as f:
+                meta = json.load(f)
+            
+            with open(self.cachePath, 'rb') as f:
+                data = f.read()
+        
+        except (OSError, ValueError):
+            return (None, None)
+        
+        if hashlib.sha256(data).hexdigest() != meta.get('sha256'):
+            print(f"The cached copy in {self.cachePath} does not match its hash, ignoring it")
+            return (None, None)
+        
+        return (data, meta)
+    
+    def save_cache(self, data, meta):
+        
+        meta = dict(meta, url=str(self.source), sha256=hashlib.sha256(data).hexdigest(), checked=time.time())
+        
+        os.makedirs(os.path.dirname(os.path.abspath(self.cachePath)), exist_ok=True)
+        
+        #The copy is written before the meta that holds its hash, each to a temp file first, so a killed run leaves a copy
+        #that is either whole or ignored
+        for path, content in ((self.cachePath, data), (self.metaPath, json.dumps(meta).encode())):
+            fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+            
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            
+            os.replace(tmpPath, path)
+
+
+def opcode_source(source=OPCODES_URL, cachePath=DEFAULT_CACHE, timeout=10, maxAge=24 * 60 * 60, offline=False):
+    """
+    Make the source for a path or URL. URLs are cached in cachePath, unless it is None
+    """
+    
+    if not source.startswith(('http://', 'https://')):
+        return FileSource(source)
+    
+    if cachePath is None:
+        return UrlSource(source, timeout)
+    
+    return CachedSource(UrlSource(source, timeout), cachePath, maxAge, offline)
 
 
 class DBPopulater:
     
-    def __init__(self):
-        cmdRefUrl='https://gbdev.io/gb-opcodes/Opcodes.json'
-        refPage = requests.get(cmdRefUrl)
-        #print(refPage.text)
-        self.opcodes = json.loads(refPage.text)
+    def __init__(self, source=None):
+        #source is anything with a read method that returns the opcode table as JSON, by default the cached gbdev table
+        if source is None:
+            source = opcode_source()
+        
+        try:
+            data = source.read()
+            self.opcodes = json.loads(data)
+        
+        except (OSError, ValueError) as e:
+            print(f"Error reading the opcode table from {source}: {e}")
+            sys.exit(-1)
+        
+        #So a run can be tied to the exact table it was populated from
+        self.opcodesHash = hashlib.sha256(data).hexdigest()
+        print(f"read the opcode table from {source}, sha256 {self.opcodesHash}")
         
         self.connect()
         
     def connect(self):
+        #Only imported once there is a database to connect to, so the opcode sources work, and can be tested, without it
+        import mariadb
+        
         try:
             self.conn = mariadb.connect(
                 user='root',
@@ -36,6 +217,22 @@ class DBPopulater:
     def clean_up(self):
         self.cur.close()
         self.conn.close()
+    
+    def get_id_map(self, query):
+        """
+        Run a query that selects an id followed by the columns that identify a row, and map each value of those columns
+        (a tuple when there is more than one) to the list of ids that have it. Looking rows up in the map instead of selecting
+        each one keeps a stage to one round trip, however many opcodes there are
+        """
+        
+        self.cur.execute(query)
+        idMap = {}
+        
+        for row in self.cur.fetchall():
+            key = tuple(row[1:]) if len(row) > 2 else row[1]
+            idMap.setdefault(key, []).append(row[0])
+        
+        return idMap
         
         
     def get_operands(self):
@@ -92,14 +289,9 @@ class DBPopulater:
     def get_operations(self):
         #Get the unique operations from the set of opcodes and populate the operation table
         
-        getFlagsIDQuery = """
-        select flag_action_id from flag_action
-        where 
-        zero_flag = ? and 
-        subtract_flag = ? and
-        half_carry_flag = ? and
-        carry_flag = ?
-        """
+        flagActionIds = self.get_id_map("""
+        select flag_action_id, zero_flag, subtract_flag, half_carry_flag, carry_flag from flag_action
+        """)
         uniqueOperations = []
         
         for type in ['unprefixed', 'cbprefixed']:
@@ -109,8 +301,7 @@ class DBPopulater:
                 currentFlags = [flags['Z'], flags['N'], flags['H'], flags['C']]
                 currentFlags = tuple(['' if x == '-' else x for x in currentFlags])
                 
-                self.cur.execute(getFlagsIDQuery, currentFlags)
-                results = self.cur.fetchall()
+                results = flagActionIds.get(currentFlags, [])
                 
                 if len(results) > 1:
                     print(f"Error when fetching flags for operation {code} {self.opcodes[type][code]['mnemonic']}: multiple flag ids identified")
@@ -121,7 +312,7 @@ class DBPopulater:
                     sys.exit(-1)
                     
                 else:
-                    flagActionId = results[0][0]
+                    flagActionId = results[0]
                 
                 if type == 'cbprefixed':
                     name = code[0:2] + "CB" + code[2:]
@@ -179,16 +370,13 @@ class DBPopulater:
         print('getting instructions')
         instructionsToInsert = []
         
-        operationQuery = """
-        select operation_id from operation
-        where
-        code=?
-        """
+        operationIds = self.get_id_map("""
+        select operation_id, code from operation
+        """)
         
-        operandQuery = """
-        select operand_id from operand
-        where operand_name=?
-        """
+        operandIds = self.get_id_map("""
+        select operand_id, operand_name from operand
+        """)
         
         operandActionQuery = """
         select operand_action_id, operand_action_symbol from operand_action
@@ -219,8 +407,7 @@ class DBPopulater:
                 else:
                      codeToSelect = code
                 
-                self.cur.execute(operationQuery, (str(codeToSelect),))
-                results = self.cur.fetchall()
+                results = operationIds.get(str(codeToSelect), [])
                 if len(results) > 1:
                     print(f"Error when finding identifier for {code}. Multiple IDs were found")
                     sys.exit(-1)
@@ -229,7 +416,7 @@ class DBPopulater:
                     print(f"Error when finding identifier for {code}. No IDs found")
                     sys.exit(-1)
                 else:
-                    operationId = results[0][0]
+                    operationId = results[0]
                 
                 
                 if not self.opcodes[type][code]['operands']:
@@ -241,11 +428,11 @@ class DBPopulater:
                         name = operand['name']
                         #print(name)
                         # Get the operand id
-                        self.cur.execute(operandQuery, (name,))
-                        results = self.cur.fetchall()
+                        results = operandIds.get(name, [])
                         
                         operandId = None
                         immediate = None
+                        action = None
                         if len(results) > 1:
                             print(f"Error when finding identifier for {name}. Multiple IDs were found")
                             sys.exit(-1)
@@ -254,13 +441,11 @@ class DBPopulater:
                             pass
                         
                         else:
-                            operandId = results[0][0]
+                            operandId = results[0]
                             immediate = operand['immediate']
                             
                             #Handling the case when there is an additional action to perform on an operand
                             #such as incrementing it after it is accessed
-                            action = None
-                            
                             if 'increment' in operand:
                                 action = actionMapping['increment']
                             
@@ -289,8 +474,22 @@ class DBPopulater:
                     
 
 
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Populate the opcode DB from the gbdev opcode table')
+    parser.add_argument('--source', default=OPCODES_URL, help='Path or URL of the opcode table (default %(default)s)')
+    parser.add_argument('--cache', default=DEFAULT_CACHE, help='Where to keep the copy of a fetched table (default %(default)s)')
+    parser.add_argument('--no_cache', action='store_true', help='Fetch the table every run, and keep no copy of it')
+    parser.add_argument('--offline', action='store_true', help='Never fetch the table, only use the cached copy')
+    parser.add_argument('--max_age', type=float, default=24 * 60 * 60, help='Seconds a cached copy is used for before it is revalidated (default %(default)s)')
+    parser.add_argument('--timeout', type=float, default=10, help='Seconds to wait on the network before giving up (default %(default)s)')
+    
+    return parser.parse_args(args)
+
+
 if __name__ == '__main__':
-    codes = DBPopulater()
+    args = parse_args(sys.argv[1:])
+    source = opcode_source(args.source, None if args.no_cache else args.cache, args.timeout, args.max_age, args.offline)
+    codes = DBPopulater(source)
 
     codes.get_operands()
     codes.get_flag_actions()
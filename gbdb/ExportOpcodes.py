@@ -0,0 +1,44 @@
+import json
+import os
+import sys
+
+from DBComparer import connect
+
+#The snapshot asmfmt's opcode lint reads, so that it never needs a connection to the DB
+DEFAULT_SNAPSHOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'asmfmt', 'sm83_opcodes.json')
+
+COLUMNS = ['code', 'mnemonic', 'operand_name', 'op_order', 'op_immediate', 'operand_action_symbol']
+
+
+def export_opcodes(cur, path):
+    """
+    Write every row of opcodes_v that describes the shape of an instruction to a JSON snapshot: one row per operand,
+    in order, and a single row with no operand for operations that take none
+    """
+    
+    cur.execute(f"select {', '.join(COLUMNS)} from opcodes_v")
+    rows = [list(row) for row in cur.fetchall()]
+    
+    for row in rows:
+        #op_immediate comes back as 0 or 1, or None for operations without operands
+        row[4] = None if row[4] is None else int(row[4])
+    
+    #One row per line, so a change to the table shows up as a readable diff
+    with open(path, 'w') as f:
+        f.write('{\n  "columns": ' + json.dumps(COLUMNS) + ',\n  "rows": [\n')
+        f.write(',\n'.join('    ' + json.dumps(row) for row in rows))
+        f.write('\n  ]\n}\n')
+    
+    return len(rows)
+
+
+if __name__ == '__main__':
+    
+    path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_SNAPSHOT
+    
+    (conn, cur) = connect('MDB_GBDB')
+    
+    print(f'exported {export_opcodes(cur, path)} rows to {path}')
+    
+    cur.close()
+    conn.close()
@@ -0,0 +1,201 @@
+from contextlib import redirect_stdout
+import io
+import json
+import os
+import tempfile
+import time
+import unittest
+
+import DBPopulator
+
+TABLE = json.dumps({'unprefixed': {}, 'cbprefixed': {}}).encode()
+NEW_TABLE = json.dumps({'unprefixed': {'0x00': {}}, 'cbprefixed': {}}).encode()
+
+class StubResponse:
+    """
+    Stands in for a requests response
+    """
+    
+    def __init__(self, statusCode, content=b'', headers=None):
+        self.status_code = statusCode
+        self.content = content
+        self.headers = headers or {}
+    
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise OSError(f"HTTP {self.status_code}")
+
+class StubSource:
+    """
+    Stands in for a UrlSource: each fetch gives the next response, or raises it if it is an exception, and records the headers it was sent
+    """
+    
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+    
+    def __str__(self):
+        return 'stub'
+    
+    def fetch(self, headers=None):
+        self.requests.append(headers)
+        response = self.responses.pop(0)
+        
+        if isinstance(response, Exception):
+            raise response
+        
+        return response
+
+class TestCachedSource(unittest.TestCase):
+    
+    def setUp(self):
+        self.workDir = tempfile.TemporaryDirectory()
+        self.cachePath = os.path.join(self.workDir.name, 'cache', 'Opcodes.json')
+    
+    def tearDown(self):
+        self.workDir.cleanup()
+    
+    def read(self, source, **options):
+        """
+        Read through a CachedSource on source, and return what it read and what it printed
+        """
+        
+        with redirect_stdout(io.StringIO()) as out:
+            data = DBPopulator.CachedSource(source, self.cachePath, **options).read()
+        
+        return (data, out.getvalue())
+    
+    def test_fresh_copy(self):
+        """
+        Tests that a copy checked less than maxAge ago is used without fetching
+        
+        Input: A first read that fetches the table, and a second read
+        Output: The table both times, from a single fetch with no validators
+        """
+        
+        source = StubSource(StubResponse(200, TABLE, {'ETag': '"v1"'}))
+        
+        self.assertEqual(self.read(source)[0], TABLE)
+        self.assertEqual(self.read(source)[0], TABLE)
+        self.assertEqual(source.requests, [{}])
+    
+    def test_revalidate(self):
+        """
+        Tests revalidating a copy older than maxAge with its ETag and Last-Modified
+        
+        Input: A fetched table, then an unchanged one (304), then a changed one (200)
+        Output: Both validators sent, the copy reused after the 304, and the new table cached after the 200
+        """
+        
+        source = StubSource(StubResponse(200, TABLE, {'ETag': '"v1"', 'Last-Modified': 'Mon, 01 Jan 2024 00:00:00 GMT'}),
+                            StubResponse(304),
+                            StubResponse(200, NEW_TABLE, {'ETag': '"v2"'}))
+        
+        self.read(source, maxAge=0)
+        self.assertEqual(self.read(source, maxAge=0)[0], TABLE)
+        self.assertEqual(source.requests[1], {'If-None-Match': '"v1"', 'If-Modified-Since': 'Mon, 01 Jan 2024 00:00:00 GMT'})
+        
+        self.assertEqual(self.read(source, maxAge=0)[0], NEW_TABLE)
+        self.assertEqual(self.read(StubSource())[0], NEW_TABLE)
+    
+    def test_network_error(self):
+        """
+        Tests a fetch that fails, with and without a copy to fall back on
+        
+        Input: A failed fetch with nothing cached, then a fetched table, then a failed revalidation
+        Output: The error the first time, and the cached copy with a message the last time
+        """
+        
+        with self.assertRaises(OSError):
+            self.read(StubSource(ConnectionError('unreachable')))
+        
+        self.read(StubSource(StubResponse(200, TABLE)))
+        data, printed = self.read(StubSource(ConnectionError('unreachable')), maxAge=0)
+        
+        self.assertEqual(data, TABLE)
+        self.assertIn('using the cached copy', printed)
+    
+    def test_offline(self):
+        """
+        Tests that offline mode never fetches
+        
+        Input: An offline read with nothing cached, then an offline read of a copy older than maxAge
+        Output: An error the first time, and the copy the second, without any fetch
+        """
+        
+        source = StubSource()
+        
+        with self.assertRaises(OSError):
+            self.read(source, offline=True)
+        
+        self.read(StubSource(StubResponse(200, TABLE)))
+        
+        self.assertEqual(self.read(source, maxAge=0, offline=True)[0], TABLE)
+        self.assertEqual(source.requests, [])
+    
+    def test_hash_mismatch(self):
+        """
+        Tests that a copy that doesn't match the hash kept with it is never used
+        
+        Input: A fetched table whose copy is then truncated, read again within maxAge
+        Output: The copy is ignored with a message, and the table is fetched again without validators
+        """
+        
+        self.read(StubSource(StubResponse(200, TABLE, {'ETag': '"v1"'})))
+        
+        with open(self.cachePath, 'wb') as f:
+            f.write(TABLE[:10])
+        
+        source = StubSource(StubResponse(200, TABLE))
+        data, printed = self.read(source)
+        
+        self.assertEqual(data, TABLE)
+        self.assertIn('does not match its hash', printed)
+        self.assertEqual(source.requests, [{}])
+    
+    def test_invalid_json(self):
+        """
+        Tests that a body that isn't JSON is never cached
+        
+        Input: A 200 with a body that isn't JSON with nothing cached, then the same when revalidating a copy
+        Output: A ValueError and nothing cached the first time, then the copy, which is still revalidated on the next read
+        """
+        
+        with self.assertRaises(ValueError):
+            self.read(StubSource(StubResponse(200, b'<html>maintenance</html>')))
+        
+        self.assertFalse(os.path.exists(self.cachePath))
+        
+        self.read(StubSource(StubResponse(200, TABLE)))
+        
+        with open(self.cachePath + '.meta') as f:
+            checked = json.load(f)['checked']
+        
+        time.sleep(0.01)
+        data, printed = self.read(StubSource(StubResponse(200, b'<html>maintenance</html>')), maxAge=0)
+        
+        self.assertEqual(data, TABLE)
+        self.assertIn('using the cached copy', printed)
+        
+        with open(self.cachePath + '.meta') as f:
+            self.assertEqual(json.load(f)['checked'], checked)
+    
+    def test_opcode_source(self):
+        """
+        Tests choosing the source for a path or URL
+        
+        Input: A path, a URL without a cache, and a URL with one
+        Output: A FileSource, a UrlSource and a CachedSource around a UrlSource
+        """
+        
+        self.assertIsInstance(DBPopulator.opcode_source('Opcodes.json'), DBPopulator.FileSource)
+        self.assertIsInstance(DBPopulator.opcode_source('https://example.com/Opcodes.json', None), DBPopulator.UrlSource)
+        
+        source = DBPopulator.opcode_source('https://example.com/Opcodes.json', self.cachePath, maxAge=5, offline=True)
+        
+        self.assertIsInstance(source, DBPopulator.CachedSource)
+        self.assertIsInstance(source.source, DBPopulator.UrlSource)
+        self.assertEqual((source.cachePath, source.maxAge, source.offline), (self.cachePath, 5, True))
+
+if __name__ == '__main__':
+    unittest.main()